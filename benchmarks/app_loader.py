@@ -0,0 +1,29 @@
+"""Locates and imports the application script for the benchmarks."""
+import glob
+import importlib.util
+import os
+import re
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+
+def find_app_script():
+    """Returns the path of the newest project_assistant_v*.py script."""
+    scripts = glob.glob(os.path.join(ROOT_DIR, 'project_assistant_v*.py'))
+    if not scripts:
+        sys.exit("project_assistant_v*.py not found")
+    return max(scripts, key=lambda p: [int(x) for x in re.findall(r'\d+', os.path.basename(p))])
+
+def app_version(script):
+    """Returns the version in the script's file name, e.g. '1.2'."""
+    return re.search(r'v([\d.]+)\.py$', script).group(1)
+
+def load_app():
+    """Imports the application script as the module 'project_assistant' and returns it."""
+    script = find_app_script()
+    spec = importlib.util.spec_from_file_location('project_assistant', script)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['project_assistant'] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,289 @@
+"""Benchmarks the UI and engine costs of Gemini Project Assistant against the local fake backend.
+
+Measures, at several history and file sizes:
+- send_overhead: time from send_message() until the response is displayed, minus the fake backend's latency
+- send_blocking: time send_message() blocks the GUI thread
+- update_chat_window: time to re-render the chat window
+- display_chat_history: time to build the chat history dialog
+- file_ingestion: time to read files into context (throughput in MB/s is reported too)
+- history_save / history_load: time to save and load a JSON chat history
+- session_memory: memory held by a displayed session, per message (bytes, not timed)
+- render_regex / render_markdown / render_markdown_cached: time to format a large code-heavy reply with the
+  v1.2 regex chain, the Markdown renderer and the renderer's cache
+
+The report is written as JSON so runs can be compared with --compare.
+
+Usage: python benchmarks/benchmark_suite.py [--quick] [--output report.json] [--compare previous.json]
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import tracemalloc
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from app_loader import BENCHMARK_DIR, find_app_script, app_version, load_app
+
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, 'results')
+
+# Deterministic message bodies, the model reply mixes prose, markdown and code like a typical answer
+USER_MESSAGE = "Can you review this function and suggest improvements? I'm seeing a slow down when the list is large. " * 3
+MODEL_MESSAGE = (
+    "Here are a few **improvements** for `process_items`:\n\n"
+    "1. Use a set for membership tests instead of a list.\n"
+    "2. Avoid re-reading the _config_ inside the loop.\n\n"
+    "```python\n"
+    "def process_items(items, config):\n"
+    "    seen = set()\n"
+    "    limit = config['limit']\n"
+    "    for item in items:\n"
+    "        if item.key in seen or len(seen) >= limit:\n"
+    "            continue\n"
+    "        seen.add(item.key)\n"
+    "        yield transform(item, config)\n"
+    "```\n\n"
+    "This makes the loop O(n) instead of O(n^2) for large inputs. " * 2
+) * 3
+
+def legacy_render(message):
+    """The regex chain display_message used before the Markdown renderer, kept as the render baseline."""
+    message = re.sub(r'```(.*?)```', r"<span style='white-space: pre-wrap;'>\1</span>", message, flags=re.DOTALL)
+    message = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', message)
+    return re.sub(r'_(.*?)_', r'<em>\1</em>', message)
+
+def stats(samples):
+    """Summarizes a list of durations in seconds."""
+    samples = sorted(samples)
+    return {
+        "runs": len(samples),
+        "mean": statistics.fmean(samples),
+        "median": statistics.median(samples),
+        "min": samples[0],
+        "max": samples[-1],
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+    }
+
+def timed(fn, runs):
+    """Runs fn `runs` times and returns the stats of its durations."""
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return stats(samples)
+
+class Benchmark:
+    def __init__(self, app, args):
+        from PyQt6.QtWidgets import QApplication
+        self.app = app
+        self.args = args
+        self.qapp = QApplication.instance() or QApplication([])
+        self.tmp = tempfile.TemporaryDirectory()
+
+        # Skip the modal dialogs, the benchmark can't answer them
+        app.MainWindow.show_warnings_and_agreement = lambda window: None
+        app.ViewHistoryDialog.exec = lambda dialog: 0
+        app.QMessageBox.information = staticmethod(lambda *a, **k: None)
+        app.QMessageBox.warning = staticmethod(lambda *a, **k: None)
+
+        app.FAKE_BACKEND_OPTIONS.update(latency=args.latency, output_tokens=args.output_tokens)
+        self.window = app.MainWindow(fake_backend=True)
+        self.pump_until(lambda: self.window.model_ready, timeout=10)
+
+    def pump_until(self, condition, timeout=30):
+        """Processes Qt events until condition() is true."""
+        deadline = time.perf_counter() + timeout
+        while not condition():
+            if time.perf_counter() > deadline:
+                raise TimeoutError("Timed out waiting for the application")
+            self.qapp.processEvents()
+            time.sleep(0.0005)
+
+    def history_file(self, size):
+        """Writes a chat history file with `size` messages and returns its path."""
+        path = os.path.join(self.tmp.name, f'history_{size}.json')
+        if not os.path.exists(path):
+            messages = [
+                {"role": "User", "content": USER_MESSAGE, "tokens": 60} if i % 2 == 0 else {"role": "Model", "content": MODEL_MESSAGE, "tokens": 400}
+                for i in range(size)
+            ]
+            with open(path, 'w') as f:
+                json.dump({"total_session_cost": 0.0, "chat_history": messages}, f)
+        return path
+
+    def reset(self):
+        """Empties the session."""
+        self.window.messages.clear()
+        self.window.chat_history.clear()
+
+    def populate(self, size):
+        """Resets the session and fills it with `size` messages, displayed like a loaded session."""
+        self.reset()
+        self.window.read_chat_history(self.history_file(size))
+        self.window.chat_history.extend(self.window.messages)
+        self.window.update_chat_window()
+
+    def bench_send(self, size):
+        self.populate(size)
+        overhead = []
+        blocking = []
+        for _ in range(self.args.runs):
+            count = len(self.window.messages)
+            self.window.input_box.setPlainText(USER_MESSAGE)
+            started = time.perf_counter()
+            self.window.send_message()
+            blocking.append(time.perf_counter() - started)
+            self.pump_until(lambda: len(self.window.messages) >= count + 2 and not self.window.request_in_progress)
+            overhead.append(time.perf_counter() - started - self.args.latency)
+        return stats(overhead), stats(blocking)
+
+    def bench_update_chat_window(self, size):
+        self.populate(size)
+        return timed(self.window.update_chat_window, self.args.runs)
+
+    def bench_display_chat_history(self, size):
+        self.populate(size)
+        return timed(self.window.display_chat_history, self.args.runs)
+
+    def bench_history_save(self, size):
+        self.populate(size)
+        path = os.path.join(self.tmp.name, 'saved.json')
+        return timed(lambda: self.window.write_chat_history(path, "JSON (*.json)"), self.args.runs)
+
+    def bench_history_load(self, size):
+        path = self.history_file(size)
+        def load():
+            self.reset()
+            self.window.read_chat_history(path)
+        return timed(load, self.args.runs)
+
+    def bench_file_ingestion(self, size_kb):
+        files = []
+        for i in range(4):
+            path = os.path.join(self.tmp.name, f'source_{size_kb}_{i}.py')
+            with open(path, 'w') as f:
+                f.write((MODEL_MESSAGE + "\n") * max(1, size_kb * 1024 // len(MODEL_MESSAGE)))
+            files.append(path)
+        total_mb = sum(os.path.getsize(p) for p in files) / 1_000_000
+        result = timed(lambda: self.window.read_files_context(files), self.args.runs)
+        result["megabytes"] = total_mb
+        result["throughput_mb_per_s"] = total_mb / result["median"]
+        return result
+
+    def bench_session_memory(self, size):
+        """Returns the memory allocated to load and display a session of `size` messages."""
+        path = self.history_file(size)
+        self.reset()
+        self.app.RENDERER.clear()
+        tracemalloc.start()
+        self.window.read_chat_history(path)
+        self.window.chat_history.extend(self.window.messages)
+        for m in self.window.chat_history:
+            m.render()
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return {"bytes": allocated, "bytes_per_message": allocated / size}
+
+    def bench_render(self, size_kb):
+        reply = MODEL_MESSAGE * max(1, size_kb * 1024 // len(MODEL_MESSAGE))
+        renderer = self.app.RENDERER
+        def cold():
+            renderer.clear()
+            renderer.render(reply)
+        renderer.render(reply) # Warm up the Pygments import and lexer
+        return timed(lambda: legacy_render(reply), self.args.runs), timed(cold, self.args.runs), timed(lambda: renderer.render(reply), self.args.runs)
+
+    def run(self):
+        results = {}
+        def record(name, size, result):
+            results.setdefault(name, {})[str(size)] = result
+            print(f"  {name:22} {size:>6}  median {result['median'] * 1000:9.3f} ms  p95 {result['p95'] * 1000:9.3f} ms")
+
+        sizes = self.args.sizes
+        for size in sizes:
+            overhead, blocking = self.bench_send(size)
+            record("send_overhead", size, overhead)
+            record("send_blocking", size, blocking)
+        for size in sizes:
+            record("update_chat_window", size, self.bench_update_chat_window(size))
+        for size in sizes:
+            record("display_chat_history", size, self.bench_display_chat_history(size))
+        for size in sizes:
+            record("history_save", size, self.bench_history_save(size))
+        for size in sizes:
+            record("history_load", size, self.bench_history_load(size))
+        for size in sizes:
+            memory = self.bench_session_memory(size)
+            results.setdefault("session_memory", {})[str(size)] = memory
+            print(f"  {'session_memory':22} {size:>6}  {memory['bytes'] / 1024:9.1f} KB    per message {memory['bytes_per_message'] / 1024:7.2f} KB")
+        for size_kb in self.args.file_sizes:
+            record("file_ingestion", f"{size_kb}KB", self.bench_file_ingestion(size_kb))
+        for size_kb in self.args.render_sizes:
+            regex, markdown, cached = self.bench_render(size_kb)
+            record("render_regex", f"{size_kb}KB", regex)
+            record("render_markdown", f"{size_kb}KB", markdown)
+            record("render_markdown_cached", f"{size_kb}KB", cached)
+        return results
+
+def compare(report, previous):
+    """Prints median ratios between two reports."""
+    print(f"Compared to {previous['version']} ({previous['date']}), median time ratio (lower is faster):")
+    for name, sizes in report["results"].items():
+        for size, result in sizes.items():
+            old = previous["results"].get(name, {}).get(size)
+            if old and 'median' in result:
+                print(f"  {name:22} {size:>6}  {result['median'] / old['median']:6.2f}x")
+            elif old and 'bytes' in result:
+                print(f"  {name:22} {size:>6}  {result['bytes'] / old['bytes']:6.2f}x memory")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help="Fewer runs and smaller sizes")
+    parser.add_argument('--runs', type=int, default=10, help="Runs per measurement")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help="History sizes in messages")
+    parser.add_argument('--file-sizes', type=int, nargs='+', default=[10, 100, 1000], help="File sizes in KB for file ingestion")
+    parser.add_argument('--render-sizes', type=int, nargs='+', default=[8, 32, 128], help="Model reply sizes in KB for rendering, 32KB is about an 8k token reply")
+    parser.add_argument('--latency', type=float, default=0.0, help="Fake backend latency in seconds")
+    parser.add_argument('--output-tokens', type=int, default=400, help="Fake backend reply length in tokens")
+    parser.add_argument('--output', help="Report path, defaults to benchmarks/results/benchmark_v<version>_<timestamp>.json")
+    parser.add_argument('--compare', help="A previous report to compare with")
+    args = parser.parse_args()
+    if args.quick:
+        args.runs = 3
+        args.sizes = [10, 100]
+        args.file_sizes = [10, 100]
+        args.render_sizes = [8, 32]
+
+    version = app_version(find_app_script())
+    app = load_app()
+    print(f"Gemini Project Assistant v{version} benchmark ({args.runs} runs per measurement)")
+    benchmark = Benchmark(app, args)
+
+    report = {
+        "version": version,
+        "date": datetime.now().isoformat(timespec='seconds'),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "settings": {"runs": args.runs, "latency": args.latency, "output_tokens": args.output_tokens},
+        "results": benchmark.run(),
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, f"benchmark_v{version}_{datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Saved to {output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(report, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Measures startup time of Gemini Project Assistant and tracks it across releases.
+
+Runs the application with the fake backend on an offscreen display, recording:
+- time to window shown and time to model ready (time-to-interactive), measured from process launch
+- an `-X importtime` report of the slowest imports at startup
+- the cost of the deferred google.generativeai import, which happens on a background thread
+
+Results are appended to benchmarks/startup_history.json, keyed by application version.
+
+Usage: python benchmarks/startup_benchmark.py [--runs 5] [--top 15] [--no-save]
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from datetime import date
+
+from app_loader import BENCHMARK_DIR, ROOT_DIR, find_app_script, app_version
+
+HISTORY_FILE = os.path.join(BENCHMARK_DIR, 'startup_history.json')
+
+def parse_importtime(stderr):
+    """Parses `-X importtime` output into {module: (self_us, cumulative_us)}, keeping top level imports only."""
+    imports = {}
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)', line)
+        if match and not match.group(3): # Nested imports are indented
+            imports[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+    return imports
+
+def run_startup(script):
+    """Launches the application once and returns its startup timings and import report."""
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get('QT_QPA_PLATFORM', 'offscreen'))
+    launched = time.time()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', script, '--fake-backend', '--benchmark-startup'],
+        capture_output=True, text=True, env=env, cwd=ROOT_DIR, timeout=120
+    )
+    timings = None
+    for line in result.stdout.splitlines():
+        if line.startswith('STARTUP_TIMINGS '):
+            timings = json.loads(line[len('STARTUP_TIMINGS '):])
+    if timings is None:
+        sys.exit(f"Application did not report startup timings:\n{result.stdout}\n{result.stderr[-2000:]}")
+    return {
+        "time_to_window": timings['window_shown'] - launched,
+        "time_to_interactive": timings['model_ready'] - launched,
+        "module_load": timings['start'] - launched, # Interpreter startup before the script's first line
+    }, parse_importtime(result.stderr)
+
+def measure_deferred_import():
+    """Returns the cumulative import time of google.generativeai in seconds, or None if it isn't installed."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import google.generativeai'], capture_output=True, text=True)
+    imports = parse_importtime(result.stderr)
+    if 'google.generativeai' not in imports:
+        return None
+    return imports['google.generativeai'][1] / 1_000_000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help="Number of launches to take the median of")
+    parser.add_argument('--top', type=int, default=15, help="Number of slowest imports to report")
+    parser.add_argument('--no-save', action='store_true', help=f"Don't append the result to {os.path.relpath(HISTORY_FILE, ROOT_DIR)}")
+    args = parser.parse_args()
+
+    script = find_app_script()
+    version = app_version(script)
+
+    runs = []
+    import_runs = []
+    for _ in range(args.runs):
+        timings, imports = run_startup(script)
+        runs.append(timings)
+        import_runs.append(imports)
+
+    # Median of each import across runs
+    modules = set().union(*import_runs)
+    import_report = {
+        m: statistics.median(r[m][1] for r in import_runs if m in r) / 1_000_000
+        for m in modules
+    }
+    slowest = sorted(import_report.items(), key=lambda item: item[1], reverse=True)[:args.top]
+
+    result = {
+        "version": version,
+        "date": date.today().isoformat(),
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "time_to_window": statistics.median(r['time_to_window'] for r in runs),
+        "time_to_interactive": statistics.median(r['time_to_interactive'] for r in runs),
+        "interpreter_startup": statistics.median(r['module_load'] for r in runs),
+        "startup_import_total": sum(import_report.values()),
+        "deferred_genai_import": measure_deferred_import(),
+        "slowest_imports": dict(slowest),
+    }
+
+    print(f"Gemini Project Assistant v{version} startup ({args.runs} runs, median)")
+    print(f"  Time to window:       {result['time_to_window'] * 1000:8.1f} ms")
+    print(f"  Time to interactive:  {result['time_to_interactive'] * 1000:8.1f} ms")
+    print(f"  Startup imports:      {result['startup_import_total'] * 1000:8.1f} ms")
+    if result['deferred_genai_import'] is not None:
+        print(f"  Deferred SDK import:  {result['deferred_genai_import'] * 1000:8.1f} ms (background thread)")
+    print("  Slowest imports:")
+    for module, seconds in slowest:
+        print(f"    {seconds * 1000:8.1f} ms  {module}")
+
+    history = []
+    if os.path.exists(HISTORY_FILE):
+        with open(HISTORY_FILE, 'r') as f:
+            history = json.load(f)
+    if history:
+        previous = history[-1]
+        print(f"Compared to v{previous['version']} ({previous['date']}):")
+        for key in ('time_to_window', 'time_to_interactive', 'startup_import_total'):
+            print(f"  {key}: {(result[key] - previous[key]) * 1000:+.1f} ms")
+
+    if not args.no_save:
+        history.append(result)
+        with open(HISTORY_FILE, 'w') as f:
+            json.dump(history, f, indent=4)
+        print(f"Saved to {HISTORY_FILE}")
+
+if __name__ == '__main__':
+    main()
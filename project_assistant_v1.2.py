@@ -1,20 +1,34 @@
+import time
+STARTUP_TIME = time.time() # Recorded before any other imports for the startup benchmark
 import traceback
+import datetime
 import sys
 import os
 import json
 import asyncio
 import re
 import subprocess
+import argparse
+import uuid
+import threading
+import hashlib
+import html
+import zlib
+import collections
+import types
+import io
+import importlib.util
+import random
+import concurrent.futures
+import urllib.parse
+from html.parser import HTMLParser
 from print_color import print
-import google.generativeai as genai
 from dotenv import load_dotenv, set_key
-from google.generativeai.types import HarmCategory, HarmBlockThreshold, generation_types
-from google.api_core.exceptions import DeadlineExceeded, InvalidArgument
 from PyQt6.QtWidgets import ( QApplication, QMainWindow, QProgressBar, QWidget, QPushButton, QScrollArea, QLabel, QVBoxLayout, QLineEdit, QMessageBox, QFileDialog, QTextEdit,
-                              QFontDialog, QColorDialog, QInputDialog, QListWidget, QStatusBar, QHBoxLayout, QComboBox, QSpinBox, QDoubleSpinBox, QDialog, QSizePolicy, QCheckBox
+                              QFontDialog, QColorDialog, QInputDialog, QListWidget, QStatusBar, QHBoxLayout, QComboBox, QSpinBox, QDoubleSpinBox, QDialog, QSizePolicy, QCheckBox, QListWidgetItem
                             )
-from PyQt6.QtCore import Qt, QSize, QEvent, QTimer, QThread, pyqtSignal, QProcess
-from PyQt6.QtGui import QFont, QColor, QAction
+from PyQt6.QtCore import Qt, QSize, QEvent, QTimer, QThread, pyqtSignal
+from PyQt6.QtGui import QFont, QColor, QAction, QTextCursor
 
 
 
@@ -28,36 +42,37 @@ API_KEY = os.getenv('API_KEY')
 DEBUG = False if os.getenv('DEBUG') == None or os.getenv('DEBUG').lower() == 'false' else True
 
 # Gemini Safety Settings - for more info visit https://ai.google.dev/gemini-api/docs/safety-settings
+# Categories and thresholds are given by name so google.generativeai doesn't need to be imported at startup
 #  No safety settings
 NO_SAFETY = {
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE
+    "HARM_CATEGORY_HARASSMENT": "BLOCK_NONE",
+    "HARM_CATEGORY_HATE_SPEECH": "BLOCK_NONE",
+    "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_NONE",
+    "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_NONE"
 }
 
 # Low safety settings
 LOW_SAFETY = {
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH
+    "HARM_CATEGORY_HARASSMENT": "BLOCK_ONLY_HIGH",
+    "HARM_CATEGORY_HATE_SPEECH": "BLOCK_ONLY_HIGH",
+    "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_ONLY_HIGH",
+    "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_ONLY_HIGH"
 }
 
 # Medium safety settings
 MEDIUM_SAFETY = {
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
+    "HARM_CATEGORY_HARASSMENT": "BLOCK_MEDIUM_AND_ABOVE",
+    "HARM_CATEGORY_HATE_SPEECH": "BLOCK_MEDIUM_AND_ABOVE",
+    "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_MEDIUM_AND_ABOVE",
+    "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_MEDIUM_AND_ABOVE"
 }
 
 # High safety settings
 HIGH_SAFETY = {
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_LOW_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_LOW_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_LOW_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_LOW_AND_ABOVE
+    "HARM_CATEGORY_HARASSMENT": "BLOCK_LOW_AND_ABOVE",
+    "HARM_CATEGORY_HATE_SPEECH": "BLOCK_LOW_AND_ABOVE",
+    "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_LOW_AND_ABOVE",
+    "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_LOW_AND_ABOVE"
 }
 
 # Gemini 1.5 Pro Latest Pricing per 1 million tokens (as of July 15, 2024)
@@ -110,12 +125,36 @@ WARNINGS = '''
 
 SI_TOKENS = 0
 
+VERSION = '1.2'
+
+# google.generativeai takes around a second to import, so it is loaded by load_genai() when the model is initialized
+genai = None
+
+# Stand-ins until load_genai() replaces them with the google.api_core exceptions
+class DeadlineExceeded(Exception):
+    pass
+
+class InvalidArgument(Exception):
+    pass
+
+def load_genai():
+    """Imports the Gemini SDK on first use. Safe to call from any thread."""
+    global genai, DeadlineExceeded, InvalidArgument
+    if genai is None:
+        import google.generativeai
+        from google.api_core.exceptions import DeadlineExceeded, InvalidArgument
+        genai = google.generativeai
+
+# Default system instructions, used when config.json does not provide any
+DEFAULT_SYSTEM_INSTRUCTIONS = "You are an expert AI programming assistant specializing in: 1. Code Generation (high-quality, well-formatted code in any language, following best practices and user's style, producing snippets, functions, classes, or modules as needed, adapting to user's style); 2. Debugging (analyzing code for errors, providing clear explanations and fixes, considering broader context); 3. Project Management (helping with task breakdown, milestones, code organization, suggesting structures and tools); 4. Conceptual Understanding (grasping core ideas, suggesting patterns, structures, libraries, explaining complex concepts); 5. Interactive Collaboration (asking clarifying questions, proposing multiple solutions with explanations, adapting to feedback). Additional Capabilities (on request): Code Refactoring, Unit Test Generation, Code Documentation, External Resource Search. Formatting: You should not output newlines at the start or end of your response. Context: Access relevant code files and project context. Conciseness: Keep responses short, avoid emojis unless specifically requested. Do not add newlines to the end of responses."
+
 def calculate_cost(tokens, pricing, messages):
     """Calculates the cost based on token usage.
 
     Args:
         tokens (int): The number of tokens used.
         pricing (dict): A dictionary containing the pricing tiers for input or output tokens.
+        messages (MessageStore): The conversation, its size decides the pricing tier.
 
     Returns:
         float: The calculated cost.
@@ -123,24 +162,1501 @@ def calculate_cost(tokens, pricing, messages):
     million_tokens = tokens / 1_000_000 # Convert tokens to millions of tokens
 
     # Calculate based on total input tokens
-    total_tokens = 0
-    total_tokens += SI_TOKENS
-    for m in messages:
-        total_tokens += m['tokens']
+    total_tokens = SI_TOKENS + messages.total_tokens
     
     if total_tokens <= 128_000: # Check if token usage falls within the lower pricing tier
         return million_tokens * pricing['upto_128k'] # Calculate cost using the lower tier pricing
     else: 
         return million_tokens * pricing['over_128k'] # Calculate cost using the higher tier pricing
 
+def get_pricing(model_name):
+    """Looks up the pricing tables for a model.
+
+    Args:
+        model_name (str): The name of the Gemini model.
+
+    Returns:
+        tuple: (pricing date, pricing model, input pricing, output pricing), or Nones if the model is unknown.
+    """
+    match model_name:
+        case 'gemini-1.5-pro-latest' | 'gemini-1.5-pro-exp-0801':
+            return G1_5_PRO_PRICING_DATE, G1_5_PRO_PRICING_MODEL, G1_5_PRO_INPUT_PRICING, G1_5_PRO_OUTPUT_PRICING
+        case 'gemini-1.5-flash-latest':
+            return G1_5_FLASH_PRICING_DATE, G1_5_FLASH_PRICING_MODEL, G1_5_FLASH_INPUT_PRICING, G1_5_FLASH_OUTPUT_PRICING
+        case _:
+            return None, None, None, None
+
+class ModelRouter:
+    """Picks the model for each request, sending simple prompts to a fast model and hard ones to a strong model.
+
+    Rules, in order:
+    - A message starting with #hard or #easy uses the strong or fast model.
+    - Messages with code or file context use the strong model.
+    - Messages of at most fast_max_tokens tokens use the fast model, longer ones the strong model.
+
+    The conversation is plain contents shared by both models, so each request can go to either one.
+    """
+    TAGS = {"#hard": "hard", "#easy": "easy"}
+
+    def __init__(self, fast_model='gemini-1.5-flash-latest', strong_model='gemini-1.5-pro-latest', fast_max_tokens=2000):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.fast_max_tokens = fast_max_tokens
+        self.decisions = collections.Counter() # (model, reason) -> requests
+
+    def parse_tag(self, text):
+        """Splits a leading difficulty tag off a message.
+
+        Returns:
+            tuple: (difficulty or None, the message without the tag)
+        """
+        first, _, rest = text.partition(' ')
+        difficulty = self.TAGS.get(first.strip().lower())
+        return (difficulty, rest.strip()) if difficulty else (None, text)
+
+    def route(self, message_tokens, has_code, difficulty=None):
+        """Chooses the model for a message and counts the decision. See choose()."""
+        decision = self.choose(message_tokens, has_code, difficulty)
+        self.decisions[decision] += 1
+        return decision
+
+    def choose(self, message_tokens, has_code, difficulty=None):
+        """Chooses the model for a message.
+
+        Args:
+            message_tokens (int): Tokens of the new message.
+            has_code (bool): The message contains code or file context.
+            difficulty (str, optional): "hard" or "easy" if the user tagged the message.
+
+        Returns:
+            tuple: (model name, reason)
+        """
+        if difficulty == "hard":
+            decision = self.strong_model, "tagged #hard"
+        elif difficulty == "easy":
+            decision = self.fast_model, "tagged #easy"
+        elif has_code:
+            decision = self.strong_model, "code or files"
+        elif message_tokens <= self.fast_max_tokens:
+            decision = self.fast_model, "short message"
+        else:
+            decision = self.strong_model, "long message"
+        return decision
+
+class OutputPolicy:
+    """Picks the output token cap and stop sequences of each request from the kind of prompt.
+
+    Prompts are classified, in order:
+    - Messages asking for a review, critique or bug hunt are "review".
+    - Messages asking to write, implement, fix or refactor something are "code".
+    - Other messages with code or file context are "review", they are usually about the code.
+    - Everything else is a "question".
+
+    Leading tags in a message override the policy: #question, #code or #review pick the kind,
+    #max:N sets the cap and #stop:SEQ adds a stop sequence (\\n for a newline). Caps never exceed
+    the configured max_output_tokens unless #max asks for more.
+    """
+    KINDS = ("question", "code", "review")
+    TAGS = {"#question": "question", "#code": "code", "#review": "review"}
+    MAX_STOP_SEQUENCES = 5 # The API rejects more
+    REVIEW_WORDS = re.compile(r"\b(review|critique|audit|find (?:the )?bugs?|what'?s wrong|code smells?|feedback on)\b", re.IGNORECASE)
+    CODE_WORDS = re.compile(r"\b(write|implement|generate|create|refactor|rewrite|fix|convert|port|add (?:a|an|the|support)|build)\b", re.IGNORECASE)
+
+    def __init__(self, caps=None, stop_sequences=None):
+        self.caps = dict({"question": 1024, "code": 8192, "review": 4096}, **(caps or {}))
+        self.stop_sequences = dict({kind: [] for kind in self.KINDS}, **(stop_sequences or {}))
+        self.requests = collections.Counter() # kind -> requests
+        self.replies = collections.Counter() # kind -> replies received
+        self.capped = collections.Counter() # kind -> replies cut off at the cap
+        self.output_tokens = collections.Counter() # kind -> output tokens of the replies
+        self.reasons = collections.Counter() # (kind, reason) -> requests
+
+    def parse_overrides(self, text):
+        """Takes the policy tags off the start of a message, leaving other tags such as #hard in place.
+
+        Returns:
+            tuple: (overrides dict with kind, max_output_tokens and stop_sequences if given, the message without the tags)
+        """
+        overrides = {}
+        kept = []
+        rest = text.lstrip()
+        while rest.startswith('#'):
+            match = re.match(r'(\S+)\s*', rest)
+            word = match.group(1)
+            lower = word.lower()
+            if lower in self.TAGS:
+                overrides['kind'] = self.TAGS[lower]
+            elif re.fullmatch(r'#max[:=]\d+', lower):
+                overrides['max_output_tokens'] = max(1, int(lower[5:]))
+            elif re.fullmatch(r'#stop[:=].+', lower):
+                overrides.setdefault('stop_sequences', []).append(word[6:].replace('\\n', '\n'))
+            else:
+                kept.append(word)
+            rest = rest[match.end():]
+        return overrides, " ".join(kept + [rest]).strip() if kept else rest
+
+    def classify(self, text, has_code):
+        """Classifies a prompt.
+
+        Args:
+            text (str): The message, without file context.
+            has_code (bool): The message contains code or file context.
+
+        Returns:
+            tuple: (kind, reason)
+        """
+        if self.REVIEW_WORDS.search(text):
+            return "review", "asks for a review"
+        if self.CODE_WORDS.search(text):
+            return "code", "asks for code"
+        if has_code:
+            return "review", "code or files"
+        return "question", "question"
+
+    def choose(self, text, has_code, max_output_tokens, stop_sequences, overrides=None):
+        """Chooses the output settings of a request.
+
+        Args:
+            text (str): The message, without file context.
+            has_code (bool): The message contains code or file context.
+            max_output_tokens (int): The configured cap, the policy caps are lowered to it.
+            stop_sequences (list): The configured stop sequences, always included.
+            overrides (dict, optional): Overrides from parse_overrides().
+
+        Returns:
+            tuple: (kind, reason, output token cap, stop sequences)
+        """
+        overrides = overrides or {}
+        if 'kind' in overrides:
+            kind, reason = overrides['kind'], f"tagged #{overrides['kind']}"
+        else:
+            kind, reason = self.classify(text, has_code)
+        cap = overrides.get('max_output_tokens') or min(self.caps[kind], max_output_tokens)
+        if 'max_output_tokens' in overrides:
+            reason += ", #max"
+        stops = list(dict.fromkeys(list(stop_sequences) + self.stop_sequences[kind] + overrides.get('stop_sequences', [])))
+        return kind, reason, cap, [s for s in stops if s][:self.MAX_STOP_SEQUENCES]
+
+    def apply(self, text, has_code, max_output_tokens, stop_sequences, overrides=None):
+        """Chooses the output settings of a request and counts it. See choose()."""
+        kind, reason, cap, stops = self.choose(text, has_code, max_output_tokens, stop_sequences, overrides)
+        self.requests[kind] += 1
+        self.reasons[kind, reason] += 1
+        return kind, reason, cap, stops
+
+    def record(self, kind, output_tokens, hit_cap):
+        """Counts the reply to a request of `kind`."""
+        self.replies[kind] += 1
+        self.output_tokens[kind] += output_tokens
+        if hit_cap:
+            self.capped[kind] += 1
+
+    @staticmethod
+    def hit_cap(response, cap):
+        """Returns whether a reply stopped at its output token cap.
+
+        Uses the finish reason (MAX_TOKENS) when the response has one, cached replies are compared with the cap.
+        """
+        candidates = getattr(response, 'candidates', None)
+        if candidates:
+            reason = candidates[0].finish_reason
+            return getattr(reason, 'name', reason) in ('MAX_TOKENS', 2)
+        return response.usage_metadata.candidates_token_count >= cap
+
+class SpendLedger:
+    """Daily spending, persisted so daily and monthly budgets hold across sessions.
+
+    Stored as {"YYYY-MM-DD": dollars} in a JSON file, days older than KEEP_DAYS are dropped.
+    """
+    KEEP_DAYS = 400
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.days = None # Loaded on first use
+
+    def load(self):
+        if self.days is None:
+            try:
+                with open(self.path, 'r') as f:
+                    self.days = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self.days = {}
+
+    def record(self, cost):
+        """Adds the cost of a request to today's spending and saves the ledger."""
+        if not cost:
+            return
+        with self.lock:
+            self.load()
+            today = time.strftime('%Y-%m-%d')
+            self.days[today] = self.days.get(today, 0.0) + cost
+            oldest = time.strftime('%Y-%m-%d', time.localtime(time.time() - self.KEEP_DAYS * 86400))
+            self.days = {day: spent for day, spent in self.days.items() if day >= oldest}
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                temp_path = f"{self.path}.{threading.get_ident()}.tmp"
+                with open(temp_path, 'w') as f:
+                    json.dump(self.days, f, indent=4)
+                os.replace(temp_path, self.path) # Never leave a half written ledger
+            except OSError as e:
+                if DEBUG:
+                    print(f"Unable to save spending: {e}", tag='Debug', tag_color='red')
+
+    def spent(self):
+        """Returns (spent today, spent this month) in dollars."""
+        with self.lock:
+            self.load()
+            today = time.strftime('%Y-%m-%d')
+            return self.days.get(today, 0.0), sum(spent for day, spent in self.days.items() if day[:7] == today[:7])
+
+class RequestQueue:
+    """Requests that failed for lack of connectivity or quota, saved in a JSON file until they are sent.
+
+    Each job keeps the conversation up to its user message, so queued requests survive a restart.
+    MainWindow.flush_queue sends the jobs one at a time, in order, retrying with backoff.
+    """
+    BACKOFF = (10, 30, 60, 120, 300, 600) # Seconds before each retry, the last one repeats
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.jobs = None # Loaded on first use
+
+    def load(self):
+        if self.jobs is None:
+            try:
+                with open(self.path, 'r') as f:
+                    self.jobs = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self.jobs = []
+
+    def save(self):
+        """Writes the queue atomically, deleting the file when it is empty."""
+        try:
+            if not self.jobs:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = f"{self.path}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(self.jobs, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            if DEBUG:
+                print(f"Unable to save the request queue: {e}", tag='Debug', tag_color='red')
+
+    def add(self, branch, model_name, history, error, generation_config=None, diff_mode=False, output_kind=None):
+        """Queues a request and returns its job.
+
+        Args:
+            branch (str): Name of the branch the request belongs to.
+            model_name (str): The model to send it to.
+            history (list): The conversation up to and including the user message, as saved in chat history files.
+            error (str): Why the request could not be sent.
+            generation_config (dict, optional): The request's generation config, the current one is used if None.
+            diff_mode (bool): The request asked for diff-only replies.
+            output_kind (str, optional): The OutputPolicy kind of the request.
+        """
+        with self.lock:
+            self.load()
+            job = {"id": uuid.uuid4().hex, "branch": branch, "model": model_name, "created": time.time(),
+                   "attempts": 0, "next_attempt": time.time() + self.BACKOFF[0], "error": error, "history": history,
+                   "generation_config": generation_config, "diff_mode": diff_mode, "output_kind": output_kind}
+            self.jobs.append(job)
+            self.save()
+            return job
+
+    def retry_later(self, job, error):
+        """Schedules the next attempt of a job that failed again."""
+        with self.lock:
+            job['attempts'] += 1
+            job['error'] = error
+            job['next_attempt'] = time.time() + self.BACKOFF[min(job['attempts'], len(self.BACKOFF) - 1)]
+            self.save()
+
+    def remove(self, job):
+        with self.lock:
+            self.load()
+            self.jobs = [j for j in self.jobs if j['id'] != job['id']]
+            self.save()
+
+    def pending(self, branch=None):
+        """Returns the queued jobs, of one branch if given, oldest first."""
+        with self.lock:
+            self.load()
+            return [j for j in self.jobs if branch is None or j['branch'] == branch]
+
+    def next_due(self):
+        """Returns the oldest job if it is due, jobs are sent strictly in order."""
+        with self.lock:
+            self.load()
+            if self.jobs and self.jobs[0]['next_attempt'] <= time.time():
+                return self.jobs[0]
+            return None
+
+# Errors meaning the API was unreachable or out of quota, so the request can be sent later. Matched by class name
+# because they come from google.api_core, grpc, aiohttp or the standard library.
+RETRYABLE_ERRORS = ('ServiceUnavailable', 'ResourceExhausted', 'TooManyRequests', 'InternalServerError', 'BadGateway', 'GatewayTimeout',
+                    'RetryError', 'ConnectionError', 'TimeoutError', 'ClientConnectorError', 'ServerDisconnectedError', 'gaierror')
+
+def is_retryable(error):
+    """Returns whether a request error is a connectivity or quota problem worth retrying.
+
+    Args:
+        error (Exception): The error raised by the request.
+
+    Returns:
+        bool: True if the request can be queued and sent later.
+    """
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+QUEUE = RequestQueue(os.path.join(SCRIPT_DIR, 'cache', 'queue.json'))
+
+class UnifiedDiff:
+    """Parses unified diffs from model replies and applies them to files.
+
+    Hunks are located by their context and removed lines rather than trusting the line numbers, which models often
+    get wrong, and lines are compared without trailing whitespace. A hunk that matches nowhere fails the patch.
+    """
+    HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+    # Instructions added to the last turn of requests in diff-only mode, not stored with the message
+    INSTRUCTIONS = (
+        "(Reply mode: when changing files, reply only with unified diffs in ```diff blocks, with --- a/<path> and +++ b/<path> "
+        "headers using the paths of the files as given, @@ hunk headers and 3 lines of context. Don't repeat unchanged code or whole files. "
+        "Keep explanations to one short sentence.)"
+    )
+
+    @classmethod
+    def instruct(cls, contents):
+        """Returns request contents with INSTRUCTIONS added as a part of the last turn, leaving `contents` unchanged."""
+        last = contents[-1]
+        return contents[:-1] + [dict(last, parts=list(last['parts']) + [{'text': cls.INSTRUCTIONS}])]
+
+    @classmethod
+    def parse(cls, text):
+        """Extracts the file patches of a reply.
+
+        Args:
+            text (str): The reply, with diffs in ```diff or ```patch blocks, or a bare diff.
+
+        Returns:
+            list: Patches as {"old_path", "new_path", "hunks"}, each hunk {"old_start", "lines": [(tag, line)]}.
+            Empty if the reply has no diff. Raises ValueError for a malformed diff.
+        """
+        blocks = re.findall(r'```(?:diff|patch|udiff)[^\n]*\n(.*?)```', text, flags=re.DOTALL)
+        if not blocks and re.search(r'^--- .*\n\+\+\+ ', text, flags=re.MULTILINE):
+            blocks = [text]
+        patches = []
+        for block in blocks:
+            patch = None
+            hunk = None
+            headed = False # Whether the patch has its +++ line, new_path is None for a deleted file too
+            for line in block.splitlines():
+                if line.startswith('--- ') and (hunk is None or not line[4:].strip() or cls.hunk_complete(hunk)):
+                    patch = {"old_path": cls.strip_prefix(line[4:]), "new_path": None, "hunks": []}
+                    hunk = None
+                    headed = False
+                    patches.append(patch)
+                elif line.startswith('+++ ') and patch is not None and not headed:
+                    patch['new_path'] = cls.strip_prefix(line[4:])
+                    headed = True
+                elif line.startswith('@@'):
+                    match = cls.HUNK_HEADER.match(line)
+                    if not headed:
+                        raise ValueError("a hunk comes before its --- and +++ file headers")
+                    if not match:
+                        raise ValueError(f"malformed hunk header: {line}")
+                    hunk = {"old_start": int(match.group(1)), "old_count": int(match.group(2) or 1), "lines": []}
+                    patch['hunks'].append(hunk)
+                elif hunk is not None and line[:1] in (' ', '-', '+', ''):
+                    hunk['lines'].append((line[:1] or ' ', line[1:])) # Models drop the space of empty context lines
+                elif line.startswith('\\') or line.startswith('diff ') or line.startswith('index '):
+                    continue
+                elif hunk is not None:
+                    raise ValueError(f"unexpected line in a hunk of {patch['new_path']}: {line[:80]}")
+        for patch in patches:
+            if not patch['hunks']:
+                raise ValueError(f"the diff of {patch['new_path'] or patch['old_path']} has no hunks")
+            for hunk in patch['hunks']: # Trailing blank lines of a block aren't context
+                while hunk['lines'] and hunk['lines'][-1] == (' ', ''):
+                    hunk['lines'].pop()
+        return patches
+
+    @staticmethod
+    def hunk_complete(hunk):
+        """Returns whether a hunk has all the old lines its header announced, so a "--- " line after it starts a new file."""
+        return sum(1 for tag, _ in hunk['lines'] if tag != '+') >= hunk['old_count']
+
+    @staticmethod
+    def strip_prefix(path):
+        """Returns a diff header path without its a/ or b/ prefix and timestamp, or None for /dev/null."""
+        path = path.split('\t')[0].strip()
+        if path == '/dev/null':
+            return None
+        return path[2:] if path[:2] in ('a/', 'b/') else path
+
+    @staticmethod
+    def apply(source, hunks):
+        """Applies hunks to a file's text.
+
+        Args:
+            source (str): The current contents, '' for a new file.
+            hunks (list): The hunks of a patch, in file order.
+
+        Returns:
+            str: The patched contents. Raises ValueError naming the first hunk that doesn't match.
+        """
+        lines = source.splitlines()
+        result = []
+        position = 0
+        for number, hunk in enumerate(hunks, 1):
+            old = [text.rstrip() for tag, text in hunk['lines'] if tag != '+']
+            new = [text for tag, text in hunk['lines'] if tag != '-']
+            expected = min(max(position, hunk['old_start'] - 1 if old else hunk['old_start']), len(lines) - len(old))
+            start = None
+            # Search outwards from where the header says the hunk is
+            for distance in range(len(lines) + 1):
+                for candidate in (expected - distance, expected + distance) if distance else (expected,):
+                    if position <= candidate <= len(lines) - len(old) and [l.rstrip() for l in lines[candidate:candidate + len(old)]] == old:
+                        start = candidate
+                        break
+                if start is not None:
+                    break
+            if start is None:
+                raise ValueError(f"hunk {number} (@@ -{hunk['old_start']}) doesn't match the file, its context and removed lines must be copied exactly")
+            result += lines[position:start] + new
+            position = start + len(old)
+        result += lines[position:]
+        text = '\n'.join(result)
+        return text + '\n' if result and (source.endswith('\n') or not source) else text
+
+    @staticmethod
+    def write(results):
+        """Writes patched files all together or not at all.
+
+        Every new file is written to a temporary file first, and only then are they moved into place. If a move or
+        delete fails, the files already changed are put back to their original contents.
+
+        Args:
+            results (dict): {path: (original, new)}, original None for a file to create and new None for one to delete.
+
+        Raises:
+            OSError: If a file couldn't be written. No file is left changed.
+        """
+        temp_paths = {}
+        try:
+            for path, (_, new) in results.items():
+                if new is not None:
+                    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                    temp_paths[path] = f"{path}.{threading.get_ident()}.tmp"
+                    with open(temp_paths[path], 'w', encoding='utf-8', newline='') as f:
+                        f.write(new)
+            done = []
+            try:
+                for path, (original, new) in results.items():
+                    if new is None:
+                        os.remove(path)
+                    else:
+                        os.replace(temp_paths.pop(path), path)
+                    done.append((path, original))
+            except OSError:
+                for path, original in reversed(done): # Best effort, the original error is the one reported
+                    try:
+                        if original is None:
+                            os.remove(path)
+                        else:
+                            with open(f"{path}.{threading.get_ident()}.tmp", 'w', encoding='utf-8', newline='') as f:
+                                f.write(original)
+                            os.replace(f"{path}.{threading.get_ident()}.tmp", path)
+                    except OSError:
+                        pass
+                raise
+        finally:
+            for temp_path in temp_paths.values():
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+def get_safety_settings(safety_level):
+    """Maps a safety level from config.json ("none", "low", "medium", "high") to Gemini safety settings.
+
+    Args:
+        safety_level (str): The configured safety level.
+
+    Returns:
+        dict: The safety settings, defaulting to medium for unknown levels.
+    """
+    match safety_level:
+        case "none":
+            return NO_SAFETY
+        case "low":
+            return LOW_SAFETY
+        case "medium":
+            return MEDIUM_SAFETY
+        case "high":
+            return HIGH_SAFETY
+        case _:
+            return MEDIUM_SAFETY
+
+def read_config_file():
+    """Reads config.json from the installation directory.
+
+    Returns:
+        dict: The parsed configuration, or an empty dict if the file does not exist.
+    """
+    config_file = os.path.join(SCRIPT_DIR, 'config.json')
+    try:
+        with open(config_file, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+# Formats chat histories can be saved in. Zstandard needs the optional zstandard package.
+HISTORY_FORMATS = ["JSON (*.json)", "JSON Lines (*.jsonl)", "Compressed JSON Lines (*.jsonl.gz)", "Text (*.txt)", "Markdown (*.md)", "CSV (*.csv)"]
+if importlib.util.find_spec('zstandard'):
+    HISTORY_FORMATS.insert(3, "Zstandard JSON Lines (*.jsonl.zst)")
+
+def history_stream(raw, filename, mode):
+    """Wraps a binary file in a text stream, compressing or decompressing by the file name's extension.
+
+    Args:
+        raw (file): The binary file, opened with mode.
+        filename (str): The file name, ending with .gz or .zst for compressed files.
+        mode (str): 'rb' or 'wb'.
+
+    Returns:
+        io.TextIOWrapper: A UTF-8 text stream. Close it before raw, which finishes compressed files.
+    """
+    if filename.endswith('.gz'):
+        import gzip
+        raw = gzip.GzipFile(fileobj=raw, mode=mode, compresslevel=6)
+    elif filename.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("Reading and writing .zst files needs the zstandard package (pip install zstandard).")
+        if mode == 'wb':
+            raw = zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=False)
+        else:
+            raw = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, closefd=False))
+    return io.TextIOWrapper(raw, encoding='utf-8', errors='surrogatepass', newline='\n')
+
+def iter_chat_history(raw, filename):
+    """Yields the messages of a saved chat history as dicts.
+
+    .jsonl files (optionally .gz or .zst compressed) are parsed a line at a time, so messages are
+    available before the whole file is read. .json files are parsed whole.
+
+    Args:
+        raw (file): The file, opened in binary mode.
+        filename (str): The file name, its extension decides the format.
+    """
+    with history_stream(raw, filename, 'rb') as f:
+        if '.jsonl' not in filename:
+            yield from json.load(f).get("chat_history", [])
+            return
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if record.get("type") != "session": # The first line describes the session
+                    yield record
+
+class BlobStore:
+    """Content-addressed store for large message bodies, kept on disk as <directory>/<key[:2]>/<key>[.z].
+
+    Bodies are stored once however many messages reference them. They are zlib compressed unless compression is turned off.
+    A body's modification time is the last time a session stored or read it. Bodies this process uses are never pruned by
+    it, and touch_in_use() keeps them from being pruned by other instances while this one stays open.
+    """
+    MAX_AGE_DAYS = 7 # Bodies no session has read for this long are pruned at startup
+
+    def __init__(self, directory, compress=True):
+        self.directory = directory
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.in_use = set() # Keys stored or read by this process
+
+    def path(self, key, compressed):
+        return os.path.join(self.directory, key[:2], key + ('.z' if compressed else ''))
+
+    def put(self, text):
+        """Stores a text and returns its key, the SHA-256 of its contents."""
+        data = text.encode('utf-8', 'surrogatepass')
+        key = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            self.in_use.add(key)
+            for compressed in (True, False):
+                if os.path.exists(self.path(key, compressed)):
+                    os.utime(self.path(key, compressed)) # Mark it as in use so it isn't pruned
+                    return key
+            path = self.path(key, self.compress)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so a crash never leaves a truncated body under the key
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(zlib.compress(data, 1) if self.compress else data)
+            os.replace(temp_path, path)
+        return key
+
+    def get(self, key):
+        """Returns the text stored under key."""
+        compressed_path = self.path(key, True)
+        compressed = os.path.exists(compressed_path)
+        path = compressed_path if compressed else self.path(key, False)
+        with open(path, 'rb') as f:
+            data = f.read()
+        if key not in self.in_use: # Mark it as in use once per session, it was loaded from a saved history
+            with self.lock:
+                self.in_use.add(key)
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return (zlib.decompress(data) if compressed else data).decode('utf-8', 'surrogatepass')
+
+    def touch_in_use(self):
+        """Refreshes the modification time of the bodies this process uses, so other instances don't prune them."""
+        with self.lock:
+            keys = list(self.in_use)
+        for key in keys:
+            for compressed in (True, False):
+                try:
+                    os.utime(self.path(key, compressed))
+                except OSError:
+                    pass # Not stored in this form
+
+    def prune(self, max_age_days=MAX_AGE_DAYS):
+        """Deletes bodies that haven't been stored or read for max_age_days. Returns the number deleted."""
+        if not os.path.isdir(self.directory):
+            return 0
+        cutoff = time.time() - max_age_days * 86400
+        deleted = 0
+        with self.lock:
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    if name.split('.', 1)[0] in self.in_use:
+                        continue
+                    try:
+                        if os.path.getmtime(path) < cutoff:
+                            os.remove(path)
+                            deleted += 1
+                    except OSError:
+                        pass # Removed by another instance
+            for root, dirs, files in os.walk(self.directory, topdown=False):
+                if root != self.directory and not dirs and not files:
+                    try:
+                        os.rmdir(root)
+                    except OSError:
+                        pass
+        return deleted
+
+BLOBS = BlobStore(os.path.join(SCRIPT_DIR, 'cache', 'blobs'))
+
+class CachedResponse:
+    """A reply served by ResponseCache, with the parts of a Gemini response the chat window reads."""
+    cached = True
+
+    def __init__(self, text, prompt_tokens, output_tokens):
+        self.text = text
+        self.usage_metadata = types.SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=output_tokens)
+
+class ResponseCache:
+    """Exact-match cache of model replies, kept on disk as <directory>/<key>.json.
+
+    The key hashes everything that decides the reply: the model, generation config, safety settings,
+    system instructions and the full history sent. Entries expire after ttl_hours, and the least
+    recently used are evicted when the cache grows past max_mb.
+    """
+    def __init__(self, directory, ttl_hours=24, max_mb=100):
+        self.directory = directory
+        self.ttl_hours = ttl_hours
+        self.max_mb = max_mb
+        self.lock = threading.Lock()
+        self.size = None # Bytes on disk, counted on the first put
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model_name, generation_config, safety_settings, system_instructions, contents):
+        """Returns the SHA-256 of a request."""
+        request = {
+            "model": model_name, "generation_config": generation_config, "safety_settings": safety_settings,
+            "system_instructions": system_instructions, "contents": contents,
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        """Returns the cached CachedResponse for a key, or None if there is none or it expired."""
+        path = self.path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if time.time() - entry['created'] > self.ttl_hours * 3600:
+            self.remove(path)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path) # Eviction removes the least recently used entries first
+        except OSError:
+            pass
+        self.hits += 1
+        return CachedResponse(entry['text'], entry['prompt_tokens'], entry['output_tokens'])
+
+    def put(self, key, text, prompt_tokens, output_tokens):
+        """Caches a reply, evicting the least recently used entries if the cache is over max_mb."""
+        data = json.dumps({"created": time.time(), "text": text, "prompt_tokens": prompt_tokens, "output_tokens": output_tokens}).encode('utf-8', 'surrogatepass')
+        path = self.path(key)
+        with self.lock:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                if self.size is None:
+                    self.size = sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file())
+                temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+                self.size += len(data)
+                if self.size > self.max_mb * 1_000_000:
+                    self.evict()
+            except OSError as e:
+                if DEBUG:
+                    print(f"Unable to cache response: {e}", tag='Debug', tag_color='red')
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache is at 90% of max_mb. Called with the lock held."""
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in os.scandir(self.directory) if entry.is_file())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.max_mb * 900_000:
+                break
+            self.remove(path)
+            self.size -= size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        """Deletes every cached reply. Returns the number deleted."""
+        with self.lock:
+            if not os.path.isdir(self.directory):
+                return 0
+            paths = [entry.path for entry in os.scandir(self.directory) if entry.is_file()]
+            for path in paths:
+                self.remove(path)
+            self.size = 0
+        return len(paths)
+
+RESPONSE_CACHE = ResponseCache(os.path.join(SCRIPT_DIR, 'cache', 'responses'))
+
+class UploadCache:
+    """Handles of files uploaded through the Gemini Files API, keyed by the SHA-256 of their contents and saved in a JSON file.
+
+    An attachment is uploaded the first time it is sent, and its handle is reused by later turns and sessions
+    until shortly before the API deletes the file (48 hours after upload). It is then uploaded again from its path.
+    """
+    EXPIRY_MARGIN = 3600 # Seconds before expiry a handle stops being reused, so a request never refers to a deleted file
+    DEFAULT_LIFETIME = 47 * 3600 # Used if the API doesn't report an expiration time
+
+    def __init__(self, path):
+        self.path = path
+        self.api = None # genai, or FakeFilesAPI for the fake backend. Provides upload_file() and get_file()
+        self.lock = threading.Lock()
+        self.entries = None # Loaded on first use
+        self.uploads = 0
+        self.reuses = 0
+
+    @staticmethod
+    def file_hash(path):
+        """Returns the SHA-256 of a file, read in 1 MB chunks."""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def attachment(path, mime_type):
+        """Returns the attachment saved with a message for a local file."""
+        return {"sha256": UploadCache.file_hash(path), "path": os.path.abspath(path), "mime_type": mime_type, "name": os.path.basename(path), "size": os.path.getsize(path)}
+
+    def file_part(self, attachment):
+        """Returns the API part referring to an attachment's uploaded file, uploading it if it has no live handle."""
+        with self.lock:
+            if self.entries is None:
+                try:
+                    with open(self.path, 'r') as f:
+                        self.entries = json.load(f)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    self.entries = {}
+            entry = self.entries.get(attachment['sha256'])
+            if entry and entry['expires'] - self.EXPIRY_MARGIN > time.time():
+                self.reuses += 1
+            else:
+                entry = self.upload(attachment)
+                self.entries[attachment['sha256']] = entry
+                self.entries = {key: e for key, e in self.entries.items() if e['expires'] > time.time()}
+                try:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    with open(self.path, 'w') as f:
+                        json.dump(self.entries, f, indent=4)
+                except OSError as e:
+                    if DEBUG:
+                        print(f"Unable to save upload handles: {e}", tag='Debug', tag_color='red')
+        return {'file_data': {'mime_type': entry['mime_type'], 'file_uri': entry['uri']}}
+
+    def upload(self, attachment):
+        """Uploads an attachment and waits until the API has processed it. Called with the lock held."""
+        if not os.path.exists(attachment['path']):
+            raise FileNotFoundError(f"{attachment['name']} must be uploaded again, but {attachment['path']} no longer exists.")
+        if self.file_hash(attachment['path']) != attachment['sha256']:
+            raise ValueError(f"{attachment['path']} changed since it was attached. Attach it again to send the new version.")
+        with TELEMETRY.track('upload_file', 'files'):
+            file = self.api.upload_file(attachment['path'], mime_type=attachment['mime_type'], display_name=attachment['name'])
+            while getattr(file.state, 'name', 'ACTIVE') == 'PROCESSING': # Video and large PDFs are processed before use
+                time.sleep(1)
+                file = self.api.get_file(file.name)
+        if getattr(file.state, 'name', 'ACTIVE') == 'FAILED':
+            raise ValueError(f"The Files API could not process {attachment['name']}.")
+        self.uploads += 1
+        expires = file.expiration_time.timestamp() if getattr(file, 'expiration_time', None) else time.time() + self.DEFAULT_LIFETIME
+        return {"name": file.name, "uri": file.uri, "mime_type": attachment['mime_type'], "expires": expires}
+
+UPLOADS = UploadCache(os.path.join(SCRIPT_DIR, 'cache', 'uploads.json'))
+
+# Files sent as attachments through the Files API instead of being read into the message as text
+ATTACHMENT_TYPES = ('image/', 'audio/', 'video/', 'application/pdf')
+
+class CodeSymbol:
+    """A function, class or method found by a symbol parser, with the lines it spans and the names it refers to."""
+    __slots__ = ('name', 'kind', 'start', 'body_start', 'end', 'references', 'parent')
+
+    def __init__(self, name, kind, start, body_start, end, references, parent=None):
+        self.name = name # Qualified, "Class.method" for methods
+        self.kind = kind # "function", "class" or "method"
+        self.start = start # First line, including decorators (0-based)
+        self.body_start = body_start # First line after the signature
+        self.end = end # Line after the last line
+        self.references = references # Names and attributes used in the body
+        self.parent = parent # Name of the class of a method
+
+class PythonSymbolParser:
+    """Finds the top level functions and classes and the methods of a Python file with the ast module."""
+    def parse(self, source):
+        """Parses source code.
+
+        Args:
+            source (str): The file contents.
+
+        Returns:
+            list: The CodeSymbols of the file in source order. Raises SyntaxError if the file can't be parsed.
+        """
+        import ast
+        symbols = []
+        def add(node, kind, parent=None):
+            start = min([node.lineno] + [d.lineno for d in node.decorator_list]) - 1
+            body_start = node.body[0].lineno - 1 if node.body[0].lineno > node.lineno else node.lineno
+            references = set()
+            for child in ast.walk(node):
+                if isinstance(child, ast.Name):
+                    references.add(child.id)
+                elif isinstance(child, ast.Attribute):
+                    references.add(child.attr)
+            name = f"{parent}.{node.name}" if parent else node.name
+            symbols.append(CodeSymbol(name, kind, start, body_start, node.end_lineno, references, parent))
+
+        for node in ast.parse(source).body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                add(node, 'function')
+            elif isinstance(node, ast.ClassDef):
+                add(node, 'class')
+                for child in node.body:
+                    if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                        add(child, 'method', node.name)
+        return symbols
+
+class CodeSlicer:
+    """Sends only the parts of source files a question is about.
+
+    A slice of a file keeps its module level code (imports, constants), the requested symbols, the symbols they
+    use directly, and only the signatures of everything else. Parsers are looked up by file extension; register
+    one with a parse(source) method returning CodeSymbols to slice other languages.
+    """
+    PARSERS = {'.py': PythonSymbolParser()}
+
+    def __init__(self, max_entries=32):
+        self.indexes = collections.OrderedDict() # Content hash -> CodeSymbols, so files aren't parsed again for each request
+        self.max_entries = max_entries
+
+    @classmethod
+    def register(cls, extensions, parser):
+        """Registers a parser for file extensions such as ['.js', '.ts']."""
+        for extension in extensions:
+            cls.PARSERS[extension.lower()] = parser
+
+    @classmethod
+    def can_slice(cls, path):
+        """Returns whether a parser is registered for the file's extension."""
+        return os.path.splitext(path)[1].lower() in cls.PARSERS
+
+    def symbols(self, path, source):
+        """Returns the CodeSymbols of a file, parsing it only if its contents changed."""
+        key = hashlib.sha256(f"{os.path.splitext(path)[1].lower()}\0{source}".encode('utf-8', 'surrogatepass')).hexdigest()
+        if key in self.indexes:
+            self.indexes.move_to_end(key)
+            return self.indexes[key]
+        symbols = self.PARSERS[os.path.splitext(path)[1].lower()].parse(source)
+        self.indexes[key] = symbols
+        while len(self.indexes) > self.max_entries:
+            self.indexes.popitem(last=False)
+        return symbols
+
+    def slice(self, path, source, wanted):
+        """Builds the slice of a file for the requested symbols.
+
+        Args:
+            path (str): The file path, used to choose the parser.
+            source (str): The file contents.
+            wanted (list): Names of the requested symbols, "Class" or "Class.method" for methods.
+
+        Returns:
+            tuple: (sliced source, report dict with the symbol counts and estimated tokens of the file and the slice)
+        """
+        symbols = self.symbols(path, source)
+        by_name = {s.name: s for s in symbols}
+        methods = collections.defaultdict(list) # Method name -> methods of that name, to resolve self.method() calls
+        for s in symbols:
+            if s.kind == 'method':
+                methods[s.name.split('.', 1)[1]].append(s)
+        requested = {name for name in wanted if name in by_name}
+        requested |= {s.name for s in symbols if s.parent in requested} # A requested class brings all its methods
+
+        # Direct dependencies: top level symbols the requested code names, and the methods it calls on its own class
+        # or on classes it names. Classes it names are outlined, their methods become signatures unless called.
+        dependencies = set()
+        for name in requested:
+            symbol = by_name[name]
+            own_class = symbol.parent or (symbol.name if symbol.kind == 'class' else None)
+            named_classes = {r for r in symbol.references if r in by_name and by_name[r].kind == 'class'}
+            for reference in symbol.references:
+                if reference in by_name and by_name[reference].kind != 'method':
+                    dependencies.add(reference)
+                for method in methods.get(reference, ()):
+                    if method.parent == own_class or method.parent in named_classes:
+                        dependencies.add(method.name)
+        dependencies -= requested
+        outlined = {name for name in dependencies if by_name[name].kind == 'class'}
+        full = requested | dependencies - outlined
+
+        lines = source.splitlines(keepends=True)
+        sliced = []
+        position = 0
+        signatures = 0
+        for s in symbols:
+            if s.start < position: # A method of a class that was already written whole
+                continue
+            sliced += lines[position:s.start] # Module level code, or class level code between methods
+            if s.name in full:
+                sliced += lines[s.start:s.end]
+                position = s.end
+            elif s.name in outlined or s.kind == 'class' and any(m.parent == s.name and m.name in full for m in symbols): # Methods not kept become signatures
+                sliced += lines[s.start:s.body_start]
+                position = s.body_start
+            else:
+                sliced += lines[s.start:s.body_start] + [self.ellipsis(lines, s)]
+                signatures += 1
+                position = s.end
+        sliced += lines[position:]
+        text = ''.join(sliced)
+        return text, {
+            "symbols": len(symbols),
+            "requested": [name for name in wanted if name in by_name],
+            "missing": sorted(set(wanted) - set(by_name)),
+            "dependencies": sorted(dependencies),
+            "signatures": signatures,
+            "full_tokens": estimate_tokens(source),
+            "sliced_tokens": estimate_tokens(text),
+        }
+
+    @staticmethod
+    def ellipsis(lines, symbol):
+        """Returns the "..." line replacing a symbol's body, indented like it."""
+        if symbol.body_start >= symbol.end: # The body is on the signature line
+            return ''
+        body = lines[symbol.body_start]
+        return f"{body[:len(body) - len(body.lstrip())]}...\n"
+
+SLICER = CodeSlicer()
+
+class ContextMinifier:
+    """Strips noise from files before they are sent as context.
+
+    Removes comments (license headers and banners included), trailing whitespace and runs of blank lines per file
+    type, compacts JSON, and replaces lockfiles and generated files with a one line note. Results are cached by
+    content hash, so files sent again, such as docs, aren't processed again.
+    """
+    LINE_COMMENTS = {
+        '#': ('.py', '.pyw', '.sh', '.bash', '.zsh', '.rb', '.pl', '.r', '.yaml', '.yml', '.toml', '.cfg', '.conf', '.cmake', '.mk'),
+        '//': ('.js', '.jsx', '.mjs', '.ts', '.tsx', '.java', '.c', '.h', '.cpp', '.hpp', '.cc', '.cs', '.go', '.rs', '.swift', '.kt', '.scala', '.php', '.dart', '.scss'),
+        '--': ('.sql', '.lua', '.hs'),
+        ';': ('.ini',),
+    }
+    BLOCK_COMMENTS = {
+        ('/*', '*/'): ('.js', '.jsx', '.mjs', '.ts', '.tsx', '.java', '.c', '.h', '.cpp', '.hpp', '.cc', '.cs', '.go', '.rs', '.swift', '.kt', '.scala', '.php', '.dart', '.css', '.scss', '.sql'),
+        ('<!--', '-->'): ('.html', '.htm', '.xml', '.svg', '.vue'),
+    }
+    GENERATED_MARKERS = ('@generated', 'DO NOT EDIT', 'auto-generated', 'autogenerated', 'Code generated by')
+
+    def __init__(self, max_entries=256):
+        self.strip_comments = True
+        self.max_blank_lines = 1 # Longer runs of blank lines are shortened to this
+        self.omit_generated = True # Replace files marked as generated in their first lines with a note
+        self.skip_files = ['package-lock.json', 'yarn.lock', 'pnpm-lock.yaml', 'poetry.lock', 'Pipfile.lock', 'Cargo.lock', 'composer.lock', 'Gemfile.lock', 'go.sum', 'uv.lock']
+        self.cache = collections.OrderedDict() # Content hash -> minified text
+        self.max_entries = max_entries
+        self.hits = 0
+
+    def minify(self, path, content):
+        """Returns the minified contents of a file.
+
+        Args:
+            path (str): The file path, its name and extension select what is stripped.
+            content (str): The file contents.
+
+        Returns:
+            str: The minified contents.
+        """
+        name = os.path.basename(path)
+        extension = os.path.splitext(name)[1].lower()
+        options = (name if name in self.skip_files else extension, self.strip_comments, self.max_blank_lines, self.omit_generated)
+        key = hashlib.sha256(f"{options}\0{content}".encode('utf-8', 'surrogatepass')).hexdigest()
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return self.cache[key]
+
+        lines = content.splitlines()
+        if name in self.skip_files:
+            minified = f"({name} omitted, a lockfile of {len(lines)} lines)"
+        elif self.omit_generated and any(marker in line for line in lines[:5] for marker in self.GENERATED_MARKERS):
+            minified = f"({name} omitted, a generated file of {len(lines)} lines)"
+        elif extension == '.json':
+            try:
+                minified = json.dumps(json.loads(content), ensure_ascii=False, separators=(',', ':'))
+            except ValueError:
+                minified = self.strip_lines(lines)
+        else:
+            if self.strip_comments:
+                lines = self.remove_comments(lines, extension)
+            minified = self.strip_lines(lines)
+
+        self.cache[key] = minified
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        return minified
+
+    def remove_comments(self, lines, extension):
+        """Removes comments from lines of code. Only whole line comments are removed, except in Python where the
+        tokenizer finds trailing comments too, so comment markers inside strings are never mistaken for comments."""
+        if extension in ('.py', '.pyw'):
+            import tokenize
+            try:
+                comments = [token.start for token in tokenize.generate_tokens(io.StringIO('\n'.join(lines) + '\n').readline) if token.type == tokenize.COMMENT]
+            except (tokenize.TokenError, SyntaxError):
+                comments = None
+            if comments is not None:
+                lines = list(lines)
+                for row, column in comments:
+                    if row == 1 and lines[0].startswith('#!'):
+                        continue
+                    line = lines[row - 1][:column].rstrip()
+                    lines[row - 1] = line if line else None # Lines that were only a comment are dropped
+                return [line for line in lines if line is not None]
+
+        marker = next((marker for marker, extensions in self.LINE_COMMENTS.items() if extension in extensions), None)
+        block = next((block for block, extensions in self.BLOCK_COMMENTS.items() if extension in extensions), None)
+        kept = []
+        in_block = False
+        for i, line in enumerate(lines):
+            stripped = line.strip()
+            if in_block:
+                in_block = not stripped.endswith(block[1])
+                continue
+            if block and stripped.startswith(block[0]) and (block[1] not in stripped or stripped.endswith(block[1])):
+                in_block = not stripped.endswith(block[1]) or stripped == block[0]
+                continue
+            if marker and stripped.startswith(marker) and not (i == 0 and stripped.startswith('#!')):
+                continue
+            kept.append(line)
+        return kept
+
+    def strip_lines(self, lines):
+        """Removes trailing whitespace and shortens runs of blank lines."""
+        kept = []
+        blank = 0
+        for line in lines:
+            line = line.rstrip()
+            blank = blank + 1 if not line else 0
+            if blank <= self.max_blank_lines:
+                kept.append(line)
+        return '\n'.join(kept).strip('\n')
+
+MINIFIER = ContextMinifier()
+
+class GitContext:
+    """Reads the changes of a local git repository against a base ref, for reviews. Runs git locally, never fetches.
+
+    Diffs are computed from the base's blobs and the working tree, so staged, unstaged and untracked changes are
+    all included. Blobs are immutable, so they are read once (in one `git cat-file --batch` call) and cached, and
+    the diff of each file is cached by the base blob and a hash of the working file, making repeated reviews
+    of the same branch instant.
+    """
+    STATUS_NAMES = {'A': 'added', 'D': 'deleted', 'R': 'renamed', 'C': 'copied', 'M': 'modified', 'T': 'type changed'}
+    GITLINK_MODE = '160000' # The mode of submodule entries
+
+    def __init__(self, repo_dir, max_blobs=2048):
+        self.repo_dir = repo_dir
+        self.blobs = collections.OrderedDict() # Blob SHA -> bytes
+        self.max_blobs = max_blobs
+        self.diffs = {} # (base blob, path, working file hash, context lines) -> diff text
+        self.blob_reads = 0
+
+    def git(self, *args):
+        """Runs a git command in the repository and returns its stdout as bytes."""
+        try:
+            result = subprocess.run(['git', '-C', self.repo_dir, *args], capture_output=True, timeout=60)
+        except FileNotFoundError:
+            raise ValueError("git is not installed or not on the PATH.")
+        if result.returncode != 0:
+            raise ValueError(result.stderr.decode('utf-8', 'replace').strip() or f"git {args[0]} failed")
+        return result.stdout
+
+    def is_repository(self):
+        """Returns whether repo_dir is inside a git working tree."""
+        try:
+            return self.git('rev-parse', '--is-inside-work-tree').strip() == b'true'
+        except ValueError:
+            return False
+
+    def base_refs(self):
+        """Returns likely base refs: HEAD, the upstream, and the local and remote main branches."""
+        refs = ['HEAD']
+        try:
+            refs.append(self.git('rev-parse', '--abbrev-ref', '@{upstream}').decode().strip())
+        except ValueError:
+            pass # No upstream
+        branches = self.git('for-each-ref', '--format=%(refname:short)', 'refs/heads', 'refs/remotes').decode().split()
+        refs += [b for b in branches if b.split('/')[-1] in ('main', 'master', 'develop')]
+        return list(dict.fromkeys(refs))
+
+    def read_blobs(self, shas):
+        """Reads blobs not in the cache with a single git cat-file call."""
+        while len(self.blobs) > self.max_blobs: # Evicted before reading, so the blobs asked for stay cached
+            self.blobs.popitem(last=False)
+        missing = [sha for sha in dict.fromkeys(shas) if sha not in self.blobs]
+        if missing:
+            result = subprocess.run(['git', '-C', self.repo_dir, 'cat-file', '--batch'], input=''.join(f"{sha}\n" for sha in missing).encode(), capture_output=True, timeout=60)
+            if result.returncode != 0:
+                raise ValueError(result.stderr.decode('utf-8', 'replace').strip() or "git cat-file failed")
+            output = result.stdout
+            position = 0
+            for sha in missing:
+                header_end = output.index(b'\n', position)
+                header = output[position:header_end].split() # "<sha> <type> <size>", or "<sha> missing"
+                if len(header) != 3:
+                    raise ValueError(f"git cat-file could not read {sha}: {b' '.join(header[1:]).decode('utf-8', 'replace')}")
+                size = int(header[2])
+                self.blobs[sha] = output[header_end + 1:header_end + 1 + size]
+                position = header_end + 2 + size # The contents are followed by a newline
+                self.blob_reads += 1
+        for sha in shas:
+            self.blobs.move_to_end(sha)
+
+    def changes(self, base, context_lines=3, include_untracked=True, ignored=()):
+        """Computes the changes of the working tree against a base ref.
+
+        Args:
+            base (str): A commit, branch or tag to compare with.
+            context_lines (int): Unchanged lines shown around each change.
+            include_untracked (bool): Include new files not added to git.
+            ignored (list): File extensions or names to leave out.
+
+        Returns:
+            tuple: (resolved commit SHA, list of (status, path, added lines, removed lines, diff text))
+        """
+        commit = self.git('rev-parse', '--verify', f'{base}^{{commit}}').decode().strip()
+        # Raw entries: ":old_mode new_mode old_sha new_sha status\0path\0[new path\0]"
+        fields = self.git('diff', '--raw', '-z', '-M', '--no-abbrev', commit).split(b'\0')
+        entries = []
+        i = 0
+        while i < len(fields) - 1:
+            old_mode, new_mode, old_sha, _, status = fields[i].decode().split(' ')
+            old_path = fields[i + 1].decode('utf-8', 'surrogateescape')
+            i += 2
+            new_path = old_path
+            if status[0] in 'RC':
+                new_path = fields[i].decode('utf-8', 'surrogateescape')
+                i += 1
+            if self.GITLINK_MODE in (old_mode.lstrip(':'), new_mode):
+                continue # A submodule pointer, its SHA is a commit of the submodule and its path a directory
+            entries.append((status[0], old_sha if status[0] != 'A' else None, old_path, new_path))
+        if include_untracked:
+            for path in self.git('ls-files', '--others', '--exclude-standard', '-z').split(b'\0'):
+                if path and not path.endswith(b'/'): # Untracked nested repositories are listed as directories
+                    path = path.decode('utf-8', 'surrogateescape')
+                    entries.append(('A', None, path, path))
+        entries = [e for e in entries if not any(e[3].endswith(item) for item in ignored)]
+
+        self.read_blobs([old_sha for _, old_sha, _, _ in entries if old_sha])
+        root = self.git('rev-parse', '--show-toplevel').decode().strip()
+        changes = []
+        for status, old_sha, old_path, new_path in entries:
+            old = self.blobs[old_sha] if old_sha else b''
+            try:
+                with open(os.path.join(root, new_path), 'rb') as f:
+                    new = f.read() if status != 'D' else b''
+            except FileNotFoundError:
+                new = b''
+            key = (old_sha, new_path, hashlib.sha256(new).hexdigest(), context_lines)
+            if key not in self.diffs:
+                self.diffs[key] = self.diff(old, new, old_path, new_path, context_lines)
+            diff, added, removed = self.diffs[key]
+            changes.append((status, new_path, added, removed, diff))
+        return commit, changes
+
+    @staticmethod
+    def diff(old, new, old_path, new_path, context_lines):
+        """Returns (unified diff, added lines, removed lines) between two versions of a file."""
+        import difflib
+        if b'\0' in old[:8192] or b'\0' in new[:8192]:
+            return f"Binary file {new_path} changed\n", 0, 0
+        old_lines = old.decode('utf-8', 'replace').splitlines(keepends=True)
+        new_lines = new.decode('utf-8', 'replace').splitlines(keepends=True)
+        lines = list(difflib.unified_diff(old_lines, new_lines, f"a/{old_path}", f"b/{new_path}", n=context_lines))
+        if not lines:
+            return f"Renamed from {old_path} without changes\n" if old_path != new_path else "No changes\n", 0, 0
+        added = sum(1 for line in lines[2:] if line.startswith('+'))
+        removed = sum(1 for line in lines[2:] if line.startswith('-'))
+        return ''.join(line if line.endswith('\n') else line + '\n\\ No newline at end of file\n' for line in lines), added, removed
+
+SPEND = SpendLedger(os.path.join(SCRIPT_DIR, 'logs', 'spend.json'))
+
+class Message:
+    """A chat turn, or a notice shown in the chat window.
+
+    Conversation turns are stored once, in a MessageStore. The API history, saved files and the chat window are derived from it.
+    Large bodies can be spilled to BLOBS, leaving only a preview in memory, and are read back whenever content is used.
+    """
+    __slots__ = ('role', '_content', 'blob', '_preview', 'tokens', 'cost', 'html', 'attachments')
+
+    def __init__(self, role, content, tokens=0, cost=0.0, attachments=None):
+        self.role = role # "User" or "Model" for conversation turns, the sender's label for notices
+        self._content = content # None once spilled to BLOBS
+        self.blob = None # BLOBS key of a spilled body
+        self._preview = None # Kept in memory for spilled bodies
+        self.tokens = tokens
+        self.cost = cost # Cost of the message's tokens when it was sent or received
+        self.html = None # Body rendered for the chat window on first display, shared with RENDERER's cache
+        self.attachments = attachments # Files sent with the message through UPLOADS, see UploadCache.file_part
+
+    @property
+    def content(self):
+        """The message text, read back from disk if the body was spilled."""
+        if self._content is None:
+            return BLOBS.get(self.blob)
+        return self._content
+
+    def spill(self):
+        """Moves the body to BLOBS, keeping only its preview in memory."""
+        self._preview = self.preview()
+        self.blob = BLOBS.put(self._content)
+        self._content = None
+        self.html = None
+
+    def preview(self):
+        """Returns the start and end of the message on one line."""
+        if self._preview is not None:
+            return self._preview
+        content = self._content
+        content_preview = content[:100] + ' ... ' + content[-100:] if len(content) > 205 else content
+        return content_preview.replace('\n', ' ')
+
+    def render(self):
+        """Returns the chat window HTML for the message, rendering its body on first use."""
+        body = self.html
+        if body is None:
+            if self.role == "Model":
+                body = RENDERER.render(self.content) # Model replies are Markdown
+            elif self.role == "User":
+                body = html.escape(self.content, quote=False) # Show code in the message as text
+            else:
+                body = self.content # Notices are HTML
+            if self.blob is None: # Spilled bodies are rendered from disk each time
+                self.html = body
+        return format_message(self.role, body)
+
+    def to_content(self):
+        """Returns the message as a Gemini API content dict."""
+        parts = [{'text': self.content}]
+        if self.attachments:
+            parts += [UPLOADS.file_part(attachment) for attachment in self.attachments] # Uploads files whose handles expired
+        return {'role': 'model' if self.role == 'Model' else 'user', 'parts': parts}
+
+    def to_dict(self):
+        """Returns the message as saved in chat history files."""
+        data = {"role": self.role, "content": self.content, "tokens": self.tokens, "cost": self.cost}
+        if self.attachments:
+            data["attachments"] = self.attachments
+        return data
+
+class MessageStore:
+    """The conversation of a session, indexed like the Display Chat History tool (from 0 here, from 1 for the user)."""
+    def __init__(self, spill_threshold=0):
+        self.items = []
+        self.total_tokens = 0 # Kept up to date so pricing tiers don't need to sum the history
+        self.spill_threshold = spill_threshold # Bodies of at least this many characters are spilled to BLOBS, 0 keeps everything in memory
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def append(self, role, content, tokens=0, cost=0.0, attachments=None):
+        """Adds a message to the end of the conversation and returns it."""
+        message = Message(role, content, tokens, cost, attachments)
+        if self.spill_threshold and len(content) >= self.spill_threshold:
+            message.spill()
+        self.items.append(message)
+        self.total_tokens += tokens
+        return message
+
+    def insert(self, index, role, content, tokens=0, cost=0.0):
+        """Adds a message at index, such as the late reply to a queued request, and returns it."""
+        message = Message(role, content, tokens, cost)
+        if self.spill_threshold and len(content) >= self.spill_threshold:
+            message.spill()
+        self.items.insert(index, message)
+        self.total_tokens += tokens
+        return message
+
+    def pop(self, index):
+        """Removes and returns the message at index."""
+        message = self.items.pop(index)
+        self.total_tokens -= message.tokens
+        return message
+
+    def clear(self):
+        self.items.clear()
+        self.total_tokens = 0
+
+    def add_tokens(self, message, tokens):
+        """Adds tokens to a message, once the API reports tokens its text count didn't include (attachments)."""
+        message.tokens += tokens
+        self.total_tokens += tokens
+
+    def contents(self):
+        """Returns the conversation as the history of a Gemini API request."""
+        return [m.to_content() for m in self.items]
+
+    def to_dicts(self):
+        """Returns the conversation as saved in chat history files."""
+        return [m.to_dict() for m in self.items]
+
+    def fork(self, length):
+        """Returns a new store starting with the first `length` messages.
+
+        The Message objects are shared with this store, not copied, so a fork costs a list of references.
+        Messages aren't modified once added, and each store appends and deletes only in its own list.
+        """
+        store = MessageStore(self.spill_threshold)
+        store.items = self.items[:length]
+        store.total_tokens = sum(m.tokens for m in store.items)
+        return store
+
+class Branch:
+    """A line of the conversation. Branches forked from it share the messages before the fork."""
+    def __init__(self, name, messages, parent=None, fork_index=0):
+        self.name = name
+        self.messages = messages # MessageStore of the branch
+        self.chat_history = list(messages) # What the chat window shows while the branch is active
+        self.parent = parent # Name of the branch it was forked from
+        self.fork_index = fork_index # Messages shared with the parent when it was forked
+        self.cost = 0.0 # Spent on requests made in this branch
+        self.requests = 0
+
+    def common_prefix(self, other):
+        """Returns how many leading messages this branch shares with another."""
+        shared = 0
+        for mine, theirs in zip(self.messages, other.messages):
+            if mine is not theirs:
+                break
+            shared += 1
+        return shared
+
+def format_message(sender, body):
+    """Formats a message for the chat window.
+
+    Args:
+        sender (str): "User", "Model", or the label of a notice such as "System" or "Error".
+        body (str): The message body as HTML.
+
+    Returns:
+        str: The HTML for the chat window.
+    """
+    match sender:
+        case "User":
+            color = "lightgreen"
+        case "Model":
+            color = "cyan"
+        case "Error":
+            color = "red" 
+        case "Warning":
+            color = "orange" 
+        case _:
+            color = "yellow" 
+
+    if sender == "Model":
+        # Model replies are rendered Markdown blocks, shown below the sender
+        return f"<hr style='width: 100%; border-top: 1px;'><p style='margin: 0px;'><strong style='color:{color}; background-color:black;'>{sender}:</strong></p>{body}"
+    return f"<hr style='width: 100%; border-top: 1px;'><p style='margin: 0px;'><strong style='color:{color}; background-color:black;'>{sender}:</strong> <span style='white-space: pre-wrap;'>{body}</span></p>"
+
 class MainWindow(QMainWindow):
     response_receieved = pyqtSignal(object, int) # Signal to indicate response received
     timeout_occurred = pyqtSignal()
     error_occured = pyqtSignal(str)
-
-    def __init__(self):
+    model_initialized = pyqtSignal(object, int) # Signal with the model and system instruction tokens
+    model_init_failed = pyqtSignal(object)
+    scrape_progress = pyqtSignal(object) # Signal with the crawler's counters
+    scrape_finished = pyqtSignal(object, object) # Signal with the crawl summary and error
+    draft_tokens_counted = pyqtSignal(str, int) # Signal with a draft's hash and its token count
+    history_progress = pyqtSignal(str, int, int) # Signal with the operation, progress and total while saving or loading history
+    history_batch_loaded = pyqtSignal(object) # Signal with the next messages of a history being loaded
+    history_io_finished = pyqtSignal(str, object) # Signal with the result message and error of a save or load
+    map_result = pyqtSignal(object) # Signal with the result of one map request of a map-reduce analysis
+    map_stage_finished = pyqtSignal()
+    request_deferred = pyqtSignal(str) # Signal with the connectivity or quota error of a request that can be queued
+    queued_response = pyqtSignal(object, object, object) # Signal with a queued job and its response or error
+
+    def __init__(self, fake_backend=False, benchmark_startup=False):
         super().__init__()
 
+        self.fake_backend = fake_backend # Use FakeGenerativeModel instead of the Gemini API
+        self.benchmark_startup = benchmark_startup # Skip dialogs, report startup timings and quit
+
         self.loop = asyncio.new_event_loop() # Create the event loop
         asyncio.set_event_loop(self.loop)
 
@@ -149,6 +1665,18 @@ class MainWindow(QMainWindow):
         self.response_receieved.connect(self.update_ui_with_response) # Connect signal to slot
         self.timeout_occurred.connect(self.handle_timeout)
         self.error_occured.connect(self.handle_error)
+        self.model_initialized.connect(self.handle_model_initialized)
+        self.model_init_failed.connect(self.handle_model_init_failed)
+        self.scrape_progress.connect(self.handle_scrape_progress)
+        self.scrape_finished.connect(self.handle_scrape_finished)
+        self.draft_tokens_counted.connect(self.handle_draft_tokens_counted)
+        self.history_progress.connect(self.handle_history_progress)
+        self.history_batch_loaded.connect(self.handle_history_batch_loaded)
+        self.history_io_finished.connect(self.handle_history_io_finished)
+        self.map_result.connect(self.handle_map_result)
+        self.map_stage_finished.connect(self.handle_map_stage_finished)
+        self.request_deferred.connect(self.handle_request_deferred)
+        self.queued_response.connect(self.handle_queued_response)
 
         self.setWindowTitle("Gemini Project Assistant")
         self.setGeometry(100, 100, 1200, 800)
@@ -169,19 +1697,91 @@ class MainWindow(QMainWindow):
         self.timeout = 60
         self.project_dir = None
         self.ignored_extensions = []
-        self.chat_history = []  # Stores message content for display
-        self.messages = [] # Stores detailed message data (including tokens, cost) - used for saving history
+        self.chat_history = []  # Messages and notices shown in the chat window, in order
+        self.messages = MessageStore() # The conversation, the API history and saved files are derived from it
+        self.branch = Branch("main", self.messages) # The active branch, its messages and chat_history are the ones above
+        self.branch.chat_history = self.chat_history
+        self.branches = {"main": self.branch}
         self.model = None
-        self.chat = None
+        self.previous_model_settings = None # The settings of the working model while a reconfigured one initializes, restored if it fails
         self.model_name = 'gemini-1.5-pro-latest'
+        self.router = None # ModelRouter choosing the model of each request, if routing is enabled
+        self.router_enabled = False
+        self.router_fast_model = 'gemini-1.5-flash-latest'
+        self.router_strong_model = 'gemini-1.5-pro-latest'
+        self.router_fast_max_tokens = 2000 # Longer messages go to the strong model
+        self.routed_models = {} # Models other than model_name created for routed requests
+        self.request_model_name = self.model_name # The model of the current or last request
+        self.output_policy = None # OutputPolicy choosing the output cap and stop sequences of each request, if enabled
+        self.output_policy_enabled = False
+        self.output_policy_caps = {} # Kind -> output token cap, overriding the OutputPolicy defaults
+        self.output_policy_stop_sequences = {} # Kind -> stop sequences added for that kind
+        self.request_generation_config = None # The generation config of the current or last request
+        self.request_output_kind = None # The OutputPolicy kind of the current or last request
+        self.budget_session = 0.0 # Spending caps in dollars, 0 means no cap
+        self.budget_daily = 0.0
+        self.budget_monthly = 0.0
+        self.budget_action = 'block' # "block" or "downgrade" requests that would exceed a cap
+        self.budget_downgrade_model = 'gemini-1.5-flash-latest'
+        self.confirm_cost_above = 0.10 # Ask before sending requests estimated to cost more, 0 never asks
+        self.response_cache_enabled = False # Serve identical requests from RESPONSE_CACHE
+        self.response_cache_ttl_hours = 24
+        self.response_cache_max_mb = 100
+        self.draft_token_counts = collections.OrderedDict() # Draft hash -> tokens, so sending a previewed draft doesn't count it again
+        self.counting_draft = None # Hash of the draft being counted in the background
+        self.files_context = "" # Context of files waiting to be sent with the next message
+        self.files_message = ""
+        self.files_attachments = [] # Attachments waiting to be sent with the next message
+        self.code_slicing = True # Offer to send only some functions and classes of large source files
+        self.code_slicing_min_tokens = 2000
+        self.diff_mode = False # Ask for unified diffs instead of whole files, and validate them, see check_diff_reply
+        self.request_diff_mode = False # Whether the current or last request asked for diffs
+        self.diff_max_retries = 1 # Times a diff that doesn't apply is sent back for correction
+        self.diff_retries = 0
+        self.diff_reprompting = False
+        self.diff_results = {} # Path -> (original, patched) of the valid patches of a diff being corrected
+        self.last_diff = None # Path -> (original, patched) of the last validated diff, None for created or deleted files
+        self.offline_queue = True # Queue requests that fail for lack of connectivity or quota in QUEUE and send them later
+        self.pending_request = None # (branch, user message) of the request being sent
+        self.queued_messages = {} # Job id -> (branch, user message) of queued requests
+        self.queue_timer = QTimer(self) # Sends due queued requests in the background
+        self.queue_timer.timeout.connect(self.flush_queue)
+        self.map_stage = None # Progress and cost of the map stage of a map-reduce analysis
+        self.map_reduce_concurrency = 4 # Map requests sent at once
+        self.map_reduce_chunk_tokens = 30000 # Larger files are split into parts of about this many tokens
+        self.map_reduce_map_max_tokens = 1024 # Output limit of each map request
+        self.map_reduce_map_model = "" # Model of the map requests, "" uses model_name
+        self.git_context = None # GitContext of the project directory, keeps blobs and diffs cached between reviews
+        self.git_base_ref = 'HEAD' # Offered first when reviewing git changes
+        self.git_diff_context = 3 # Unchanged lines around each change in git diffs
+        self.git_include_untracked = True
+        self.minify_context = False # Strip comments, blank lines and generated files from file and docs context, see MINIFIER
+        self.minify_strip_comments = MINIFIER.strip_comments
+        self.minify_max_blank_lines = MINIFIER.max_blank_lines
+        self.minify_omit_generated = MINIFIER.omit_generated
+        self.minify_skip_files = MINIFIER.skip_files
+        self.history_thread = None # Saves or loads chat history in the background
+        self.history_loading = False
         self.temperature = 1.0
         self.max_output_tokens = 8192
         self.stop_sequences = []
-        self.system_instructions = "You are an expert AI programming assistant specializing in: 1. Code Generation (high-quality, well-formatted code in any language, following best practices and user's style, producing snippets, functions, classes, or modules as needed, adapting to user's style); 2. Debugging (analyzing code for errors, providing clear explanations and fixes, considering broader context); 3. Project Management (helping with task breakdown, milestones, code organization, suggesting structures and tools); 4. Conceptual Understanding (grasping core ideas, suggesting patterns, structures, libraries, explaining complex concepts); 5. Interactive Collaboration (asking clarifying questions, proposing multiple solutions with explanations, adapting to feedback). Additional Capabilities (on request): Code Refactoring, Unit Test Generation, Code Documentation, External Resource Search. Formatting: You should not output newlines at the start or end of your response. Context: Access relevant code files and project context. Conciseness: Keep responses short, avoid emojis unless specifically requested. Do not add newlines to the end of responses." # default
+        self.metrics_port = 0 # Port for the Prometheus metrics endpoint, 0 disables it
+        self.metrics_server = None
+        self.crawler = None # The running DocCrawler
+        self.scrape_max_pages = 1000
+        self.scrape_concurrency = 4 # Concurrent requests to the documentation site
+        self.spill_threshold_kb = 64 # Message bodies this large are kept on disk until needed, 0 keeps them in memory
+        self.spill_compression = True
+        self.system_instructions = DEFAULT_SYSTEM_INSTRUCTIONS # default
         self.safety_level = 'medium' # default
         self.safety_settings = MEDIUM_SAFETY
         self.system_message_displayed = False
         self.api_key_invalid = False
+        self.model_ready = False
+        self.system_instruction_tokens = 0
+        self.system_instruction_counts = {} # (model, system instructions) -> tokens, reinitializing with unchanged instructions doesn't count them again
+        self.shown_system_instructions = None # The (instructions, tokens) last shown in the chat
+        self.startup_timings = {}
 
         # Create UI elements
         self.central_widget = QWidget()
@@ -198,9 +1798,8 @@ class MainWindow(QMainWindow):
         # Load system instructions
         self.display_message("Welcome", "Welcome to Gemini Project Assistant!")
 
-        # Load Configuration and API Key
+        # Load Configuration
         self.load_config()
-        self.load_api_key()
         self.generation_config = {
             "temperature": self.temperature,
             "max_output_tokens": self.max_output_tokens,
@@ -208,34 +1807,53 @@ class MainWindow(QMainWindow):
         }
 
         # Set pricing based on model
-        global PRICING_DATE, PRICING_MODEL, INPUT_PRICING, OUTPUT_PRICING
-        match self.model_name:
-            case 'gemini-1.5-pro-latest' | 'gemini-1.5-pro-exp-0801':
-                PRICING_DATE = G1_5_PRO_PRICING_DATE
-                PRICING_MODEL = G1_5_PRO_PRICING_MODEL
-                INPUT_PRICING = G1_5_PRO_INPUT_PRICING
-                OUTPUT_PRICING = G1_5_PRO_OUTPUT_PRICING
-            case 'gemini-1.5-flash-latest':
-                PRICING_DATE = G1_5_FLASH_PRICING_DATE
-                PRICING_MODEL = G1_5_FLASH_PRICING_MODEL
-                INPUT_PRICING = G1_5_FLASH_INPUT_PRICING
-                OUTPUT_PRICING = G1_5_FLASH_OUTPUT_PRICING
-        
+        self.load_pricing()
+
         # Update status bar after pricing loaded
         self.update_status_bar()
 
         # Display current pricing information
-        self.display_message("Pricing", f"Pricing as of {PRICING_DATE} for {PRICING_MODEL}:")
-        self.display_message("Input", f"${INPUT_PRICING['upto_128k']} per million tokens (up to 128k tokens), ${INPUT_PRICING['over_128k']} per million tokens (over 128k tokens).")
-        self.display_message("Output", f"${OUTPUT_PRICING['upto_128k']} per million tokens (up to 128k tokens), ${OUTPUT_PRICING['over_128k']} per million tokens (over 128k tokens).")
+        self.display_pricing()
 
         # Display settings after UI setup
         self.display_loaded_settings()
 
-        # Display Warnings and User Agreement
-        self.show_warnings_and_agreement()
-
-        # Initialize the model
+        # Serve telemetry for Prometheus if enabled
+        if self.metrics_port:
+            try:
+                self.metrics_server = MetricsServer(self.metrics_port)
+                self.display_message("Metrics", f"Serving metrics on http://127.0.0.1:{self.metrics_port}/metrics")
+            except OSError as e:
+                self.display_message("Error", f"Unable to serve metrics on port {self.metrics_port}: {e}")
+
+        # Delete message bodies left on disk by old sessions, and keep this session's from being pruned by other instances
+        threading.Thread(target=BLOBS.prune, daemon=True).start()
+        self.blob_timer = QTimer(self)
+        self.blob_timer.timeout.connect(lambda: threading.Thread(target=BLOBS.touch_in_use, daemon=True).start())
+        self.blob_timer.start(6 * 3600 * 1000) # Every 6 hours, well within BlobStore.MAX_AGE_DAYS
+
+        # Start importing the Gemini SDK while the window opens and the user reads the warnings
+        if not self.fake_backend:
+            self.genai_import_thread = QThread(self)
+            self.genai_import_thread.run = load_genai
+            self.genai_import_thread.start()
+
+        # Warnings, API key and model initialization happen once the window is showing
+        QTimer.singleShot(0, self.finish_startup)
+
+    def finish_startup(self):
+        """Runs the interactive part of startup after the window is shown."""
+        self.startup_timings['window_shown'] = time.time()
+
+        if not self.benchmark_startup:
+            # Display Warnings and User Agreement
+            self.show_warnings_and_agreement()
+
+        # Load API Key
+        if not self.fake_backend:
+            self.load_api_key()
+
+        # Initialize the model in the background
         self.initialize_model()
     
     def eventFilter(self, source, event):
@@ -263,6 +1881,13 @@ class MainWindow(QMainWindow):
             event.accept()
         else:
             event.ignore()  # Prevent the window from closing if the user chooses Cancel
+
+        if event.isAccepted() and self.history_thread:
+            self.history_thread.wait() # Finish writing a chat history being saved
+
+        if event.isAccepted() and self.crawler:
+            self.crawler.stop() # Saves the crawl state so it can be resumed
+            self.scrape_thread.wait()
         
         # Close the event loop
         self.loop.close()
@@ -308,46 +1933,105 @@ class MainWindow(QMainWindow):
         if self.request_in_progress:
             QMessageBox.warning(self, "Request in Progress", "A request is already in progress. Please wait for the current request to complete.")
             return
+        if not self.require_model():
+            return
+        if self.history_loading:
+            QMessageBox.warning(self, "Loading Chat History", "Wait for the chat history to finish loading before sending a message.")
+            return
         
+        difficulty = None
+        overrides = {}
         if not files:
-            user_input = self.input_box.toPlainText().strip()
+            typed_input = self.input_box.toPlainText()
+            user_input = typed_input.strip()
+            if self.output_policy:
+                overrides, user_input = self.output_policy.parse_overrides(user_input) # #question, #code, #review, #max:N or #stop:SEQ
+            if self.router:
+                difficulty, user_input = self.router.parse_tag(user_input) # #hard or #easy picks the model
             if not user_input: # Check if the input is empty
                 return # Do nothing if the input is empty
             
             self.input_box.clear()
+            prompt = user_input
         else:
             user_message = '<None>' if self.files_message == '' else self.files_message
+            if self.output_policy:
+                overrides, user_message = self.output_policy.parse_overrides(user_message)
             user_input = self.files_context + user_message
+            prompt = user_message
+
+        if not self.diff_reprompting:
+            self.diff_retries = 0
+            self.diff_results = {}
+        self.request_diff_mode = self.diff_mode # The instructions are added to the request only, see send_message_async
 
         self.request_in_progress = True
 
         # Add messages to history for display and saving BEFORE sending the request
-        total_message_tokens = self.model.count_tokens([{'role': 'user', 'parts':[user_input]}]).total_tokens
-        input_tokens = total_message_tokens - self.system_instruction_tokens
-        self.messages.append({"role": "User", "content": user_input, "tokens": input_tokens})  # Store message in messages
+        input_tokens = self.cached_draft_tokens(user_input) # Counted by the cost preview
+        if input_tokens is None:
+            with TELEMETRY.track('count_tokens', self.model_name):
+                total_message_tokens = self.model.count_tokens([{'role': 'user', 'parts':[user_input]}]).total_tokens
+            input_tokens = total_message_tokens - self.system_instruction_tokens
+
+        # Choose the model for this request
+        self.request_model_name = self.model_name
+        if self.router:
+            self.request_model_name, reason = self.router.route(input_tokens, files or '```' in user_input, difficulty)
+            if DEBUG:
+                print(f"Routing to {self.request_model_name}: {reason}", tag='Debug', tag_color='cyan', color='white')
+        if not self.check_budget(input_tokens):
+            self.request_in_progress = False
+            if not files:
+                self.input_box.setPlainText(typed_input) # Keep the message so it can be edited or sent later
+            return
+
+        # Choose the output cap and stop sequences for this request
+        self.request_generation_config = self.generation_config
+        self.request_output_kind = None
+        if self.output_policy:
+            kind, reason, cap, stops = self.output_policy.apply(prompt, files or '```' in user_input, self.max_output_tokens, self.stop_sequences, overrides)
+            self.request_output_kind = kind
+            self.request_generation_config = dict(self.generation_config, max_output_tokens=cap, stop_sequences=stops)
+            if DEBUG:
+                print(f"Output policy {kind} ({reason}): max_output_tokens {cap}, stop_sequences {stops}", tag='Debug', tag_color='cyan', color='white')
+        input_pricing, _ = self.pricing_for(self.request_model_name)
+        attachments = self.files_attachments if files else None
+        user_message = self.messages.append("User", user_input, input_tokens, calculate_cost(input_tokens, input_pricing, self.messages), attachments)  # Store message in messages
 
         if not files:
-            self.display_message("User", user_input)  # Display the user message in the chat history
+            self.show_message(user_message)  # Display the user message in the chat history
         else:
             if self.files_message != "":
                 self.display_message("User", self.files_message)
             self.files_message = ""  # Reset files_message for next file uploads
             self.files_context = ""   # Reset files_context for next file uploads
+            self.files_attachments = []
+
+        self.pending_request = (self.branch, user_message)
+        if self.offline_queue and QUEUE.pending(self.branch.name):
+            # Earlier requests of this branch are still queued, this one must be answered after them
+            self.request_in_progress = False
+            self.handle_request_deferred("earlier requests of this branch are still queued")
+            return
 
         # Start the progress bar
         self.progress_bar.setValue(0)
         self.progress_bar.setMaximum(self.timeout * 4)  # Set the maximum value of the progress bar
-        self.progress_bar.setFormat("Awaiting Response...")  # Set the progress bar text
+        self.progress_bar.setFormat(f"Awaiting {self.request_model_name}..." if self.router else "Awaiting Response...")  # Set the progress bar text
         self.timer = QTimer(self) # Create a QTimer instance
         self.timer.timeout.connect(self.update_progress_bar) # Connect the timeout signal to the update_progress_bar method
         self.timer.start(250) # Start the timer with a .25 second interval
 
         thread = QThread(self)
-        thread.run = lambda: self.send_message_thread(user_input, self.timeout)
+        queued_at = time.perf_counter()
+        thread.run = lambda: self.send_message_thread(user_input, self.timeout, queued_at, input_tokens)
         thread.start()
 
     def delete_messages(self):
         """Deletes messages from history and updates the model's context."""
+        if not self.require_model():
+            return
         message_indices_str, ok = QInputDialog.getText(
             self,
             "Delete Messages",
@@ -371,22 +2055,18 @@ class MainWindow(QMainWindow):
                     if 0 <= python_index < len(self.messages):  
                         if DEBUG:
                             print(f"DEBUG: Deleting message at index: {i} (python_index: {python_index})", tag="DEBUG", tag_color="cyan", color="white")
-                            print(f"DEBUG: all_messages before deletion: {self.messages}", tag="DEBUG", tag_color="cyan", color="white")
+                            print(f"DEBUG: all_messages before deletion: {self.messages.to_dicts()}", tag="DEBUG", tag_color="cyan", color="white")
                         deleted_message = self.messages.pop(python_index)
                         if DEBUG:
-                            print(f"DEBUG: Deleted message: {deleted_message}", tag="DEBUG", tag_color="cyan", color="white")
-                            print(f"DEBUG: all_messages after deletion: {self.messages}", tag="DEBUG", tag_color="cyan", color="white")
-                        if DEBUG:
-                            print(f"DEBUG: chat.history before deletion: {self.chat.history}", tag="DEBUG", tag_color="cyan", color="white")
-                        del self.chat.history[python_index]
-                        if DEBUG:
-                            print(f"DEBUG: chat.history after deletion: {self.chat.history}", tag="DEBUG", tag_color="cyan", color="white")
+                            print(f"DEBUG: Deleted message: {deleted_message.to_dict()}", tag="DEBUG", tag_color="cyan", color="white")
+                            print(f"DEBUG: all_messages after deletion: {self.messages.to_dicts()}", tag="DEBUG", tag_color="cyan", color="white")
 
                         self.display_message("System", f"Deleted message at index {i}.") # Tell the user the message was deleted
                     else:
                         self.display_message("Error", f"Invalid message index: {i}")
                 # Refresh the chat history after deleting
                 self.update_chat_window()
+                self.update_status_bar()
             except ValueError:
                 self.display_message("Error", "Invalid input. Enter message indices as comma-separated numbers.")
     
@@ -429,22 +2109,15 @@ class MainWindow(QMainWindow):
                         files_context += (file_path + '\n')
             messages_to_display.append("Project directory tree was sent to the model.")
 
+        attachments = []
         add_files = True
         while(add_files): # While the user wants to add files, loop
             if file_dialog.exec():
                 selected_files = file_dialog.selectedFiles()
-                files_context += "Files from the user: "
-                for file in selected_files:
-                    try:
-                        with open(file, 'r', errors='ignore') as f:
-                            content = f.read()
-                            # Get absolute file path
-                            file_path = os.path.abspath(file)
-                            files_context += ("File: " + file_path + '\n')
-                            files_context += ('```' + content + '```\n')
-                            messages_to_display.append(f"{file} was sent to model.")  # Display only the file path
-                    except Exception as e:
-                        self.display_message("Error", f"Error reading file {file}: {e}")
+                context, sent_messages, file_attachments = self.read_files_context(selected_files, self.choose_symbols(selected_files))
+                files_context += context
+                messages_to_display += sent_messages
+                attachments += file_attachments
             # Ask if user wants to add more files.
             msg_box.setWindowTitle('Add more files?')
             msg_box.setIcon(QMessageBox.Icon.Question)
@@ -466,31 +2139,335 @@ class MainWindow(QMainWindow):
                 self.display_message('File', message)
             self.files_context = files_context
             self.files_message = user_message
+            self.files_attachments = attachments
             self.send_message(True)  # Send the user message to the model
     
+    def choose_symbols(self, selected_files):
+        """Offers to send only some functions and classes of large source files that SLICER can parse.
+
+        Args:
+            selected_files (list): Paths of the files being added.
+
+        Returns:
+            dict: File path -> names of the symbols to send. Files not in it are sent whole.
+        """
+        if not self.code_slicing:
+            return {}
+        files_symbols = {}
+        for file in selected_files:
+            if not CodeSlicer.can_slice(file):
+                continue
+            try:
+                with open(file, 'r', errors='ignore') as f:
+                    source = f.read()
+                if estimate_tokens(source) >= self.code_slicing_min_tokens:
+                    files_symbols[file] = SLICER.symbols(file, source)
+            except (OSError, SyntaxError, ValueError) as e: # Files that don't parse are sent whole
+                if DEBUG:
+                    print(f"Unable to index {file}: {e}", tag='Debug', tag_color='red')
+        if not files_symbols:
+            return {}
+        dialog = SymbolPickerDialog(files_symbols, self)
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return {}
+        return dialog.selected()
+
+    def read_files_context(self, selected_files, symbols=None):
+        """Reads files into a context block for the model. Images, audio, video and PDFs become attachments instead.
+
+        Args:
+            selected_files (list): Paths of the files to read.
+            symbols (dict): File path -> names of the symbols to send, see choose_symbols. Other files are sent whole.
+
+        Returns:
+            tuple: (context text, list of messages to display for the files that were read, list of attachments)
+        """
+        import mimetypes
+        files_context = "Files from the user: "
+        messages_to_display = []
+        attachments = []
+        minified = [0, 0, 0] # Files, estimated tokens before and after minifying
+        for file in selected_files:
+            try:
+                mime_type = mimetypes.guess_type(file)[0] or ''
+                if mime_type.startswith(ATTACHMENT_TYPES):
+                    attachments.append(UploadCache.attachment(file, mime_type))
+                    messages_to_display.append(f"{file} was attached ({mime_type}). It is uploaded once and reused while the upload lasts.")
+                    continue
+                with open(file, 'rb') as f:
+                    if b'\0' in f.read(8192):
+                        raise ValueError("binary files other than images, audio, video and PDFs can't be sent")
+                with open(file, 'r', errors='ignore') as f:
+                    content = f.read()
+                    # Get absolute file path
+                    file_path = os.path.abspath(file)
+                    if symbols and symbols.get(file):
+                        content, report = SLICER.slice(file, content, symbols[file])
+                        files_context += f"File: {file_path} (only {', '.join(report['requested'])} and the code they use directly, other definitions are reduced to signatures)\n"
+                        messages_to_display.append(self.describe_slice(file, report))
+                    else:
+                        files_context += ("File: " + file_path + '\n')
+                        messages_to_display.append(f"{file} was sent to model.")  # Display only the file path
+                    if self.minify_context:
+                        content = self.minify_file(file, content, minified)
+                    files_context += ('```' + content + '```\n')
+            except Exception as e:
+                self.display_message("Error", f"Error reading file {file}: {e}")
+        if minified[0]:
+            messages_to_display.append(self.describe_minified(*minified))
+        return files_context, messages_to_display, attachments
+
+    def minify_file(self, file, content, minified):
+        """Minifies a file's contents with MINIFIER, adding the file and its estimated tokens before and after to `minified`."""
+        result = MINIFIER.minify(file, content)
+        minified[0] += 1
+        minified[1] += estimate_tokens(content)
+        minified[2] += estimate_tokens(result)
+        return result
+
+    def describe_minified(self, files, tokens_before, tokens_after):
+        """Returns the token savings report of minified files."""
+        saved = tokens_before - tokens_after
+        input_pricing, _ = self.pricing_for(self.model_name)
+        return (
+            f"Minified {files} files from ~{tokens_before:,} to ~{tokens_after:,} tokens "
+            f"({saved / max(1, tokens_before):.0%} and ${saved * input_pricing['upto_128k'] / 1_000_000:.4f} saved per request)."
+        )
+
+    def describe_slice(self, file, report):
+        """Returns the token savings report of a sliced file."""
+        saved = report['full_tokens'] - report['sliced_tokens']
+        input_pricing, _ = self.pricing_for(self.model_name)
+        description = (
+            f"{file} was sliced to {', '.join(report['requested'])} with {len(report['dependencies'])} direct dependencies "
+            f"and {report['signatures']} of {report['symbols']} definitions as signatures: ~{report['sliced_tokens']:,} of "
+            f"~{report['full_tokens']:,} tokens ({saved / max(1, report['full_tokens']):.0%} and ${saved * input_pricing['upto_128k'] / 1_000_000:.4f} saved per request)."
+        )
+        if report['missing']:
+            description += f" Not found: {', '.join(report['missing'])}."
+        return description
+
+    def review_git_changes(self):
+        """Sends the changes of the project directory's git repository against a base ref, as diffs, with a message from the user."""
+        if not self.require_model():
+            return
+        if not self.project_dir:
+            QMessageBox.warning(self, "No Project Directory", "Set the project directory to a git repository in Settings > Configuration first.")
+            return
+        if self.git_context is None or self.git_context.repo_dir != self.project_dir:
+            self.git_context = GitContext(self.project_dir) # Keeps its caches while the project directory stays the same
+        git = self.git_context
+        if not git.is_repository():
+            QMessageBox.warning(self, "Not a Git Repository", f"{self.project_dir} is not in a git repository.")
+            return
+
+        try:
+            refs = git.base_refs()
+            if self.git_base_ref in refs:
+                refs.remove(self.git_base_ref)
+            base, ok = QInputDialog.getItem(self, "Review Git Changes", "Compare the working tree with (branch, tag or commit):", [self.git_base_ref] + refs, 0, True)
+            if not ok or not base.strip():
+                return
+            started = time.perf_counter()
+            commit, changes = git.changes(base.strip(), self.git_diff_context, self.git_include_untracked, self.ignored_extensions)
+        except (ValueError, OSError, subprocess.SubprocessError) as e:
+            self.display_message("Error", f"Unable to read the git changes: {e}")
+            return
+        if not changes:
+            self.display_message("Info", f"No changes against {base} ({commit[:10]}).")
+            return
+
+        files_context = f"Changes to the git repository at {self.project_dir} compared to {base} ({commit[:10]}), as unified diffs:\n"
+        for status, path, added, removed, diff in changes:
+            files_context += f"File: {path} ({GitContext.STATUS_NAMES.get(status, 'modified')}, +{added} -{removed})\n```diff\n{diff}```\n"
+        summary = (
+            f"{len(changes)} files changed against {base} ({commit[:10]}), +{sum(c[2] for c in changes)} -{sum(c[3] for c in changes)} lines, "
+            f"~{estimate_tokens(files_context):,} tokens. Read in {time.perf_counter() - started:.2f}s."
+        )
+        QMessageBox.information(self, "Git Changes", summary + "\n\n" + "\n".join(f"{status} {path} (+{added} -{removed})" for status, path, added, removed, _ in changes[:30]))
+
+        dialog = MessageInputDialog(self)
+        if dialog.exec() == QDialog.DialogCode.Accepted:
+            user_message = dialog.message_edit.toPlainText().strip()
+            if user_message:
+                self.files_context = files_context + "User message: "
+                self.files_message = user_message
+                self.display_message("File", summary)
+                self.send_message(True)
+
+    def analyze_files_map_reduce(self):
+        """Analyzes many files with one concurrent request per file or chunk (map), then combines the results in a final request (reduce).
+        Each map request only holds its file and the question, so large subsystems don't need one long request.
+        """
+        if self.request_in_progress:
+            QMessageBox.warning(self, "Request in Progress", "A request is already in progress. Please wait for the current request to complete.")
+            return
+        if not self.require_model():
+            return
+        files, _ = QFileDialog.getOpenFileNames(self, "Select Files to Analyze", self.project_dir or os.path.expanduser("~"))
+        if not files:
+            return
+        dialog = MessageInputDialog(self)
+        dialog.setWindowTitle("Question About the Files")
+        if dialog.exec() != QDialog.DialogCode.Accepted or not dialog.message_edit.toPlainText().strip():
+            return
+        question = dialog.message_edit.toPlainText().strip()
+
+        # Split files into chunks of at most map_reduce_chunk_tokens, on line boundaries
+        chunks = [] # (label, text)
+        chunk_chars = self.map_reduce_chunk_tokens * 4
+        for file in files:
+            try:
+                with open(file, 'r', errors='ignore') as f:
+                    content = f.read()
+            except OSError as e:
+                self.display_message("Error", f"Error reading file {file}: {e}")
+                continue
+            if self.minify_context:
+                content = MINIFIER.minify(file, content)
+            parts = []
+            part = []
+            size = 0
+            for line in content.splitlines(keepends=True):
+                if part and size + len(line) > chunk_chars:
+                    parts.append(''.join(part))
+                    part, size = [], 0
+                part.append(line)
+                size += len(line)
+            parts.append(''.join(part))
+            for i, text in enumerate(parts):
+                chunks.append((os.path.abspath(file) + (f" (part {i + 1} of {len(parts)})" if len(parts) > 1 else ""), text))
+        if not chunks:
+            return
+
+        # The map stage is checked against the budget here, the reduce request by send_message
+        map_model = self.map_reduce_map_model or self.model_name
+        input_pricing, output_pricing = self.pricing_for(map_model)
+        map_input = sum(SI_TOKENS + estimate_tokens(question) + estimate_tokens(text) + 100 for _, text in chunks)
+        map_output = len(chunks) * self.map_reduce_map_max_tokens // 2
+        estimate = (map_input * input_pricing['upto_128k'] + map_output * output_pricing['upto_128k']) / 1_000_000
+        exceeded = self.budget_exceeded(estimate)
+        if exceeded:
+            QMessageBox.warning(self, "Over Budget", f"The map stage is estimated to cost ${estimate:.4f}, which would exceed {exceeded}.")
+            return
+        if QMessageBox.question(
+            self, "Map-Reduce Analysis",
+            f"Analyze {len(files)} files as {len(chunks)} requests to {map_model}, {self.map_reduce_concurrency} at a time, then combine the results with {self.model_name}?\n"
+            f"The map stage is estimated at ~{map_input:,} input tokens and ${estimate:.4f}.",
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+        ) != QMessageBox.StandardButton.Yes:
+            return
+
+        self.request_in_progress = True
+        self.map_stage = {"question": question, "model": map_model, "total": len(chunks), "results": [], "cost": 0.0, "started": time.perf_counter()}
+        self.display_message("Map-Reduce", f"Analyzing {len(chunks)} parts of {len(files)} files with {map_model}, {self.map_reduce_concurrency} at a time, for: {question}\nResults are shown as they complete.")
+        self.progress_bar.setMaximum(len(chunks))
+        self.progress_bar.setValue(0)
+        self.progress_bar.setFormat(f"Map: 0/{len(chunks)} parts")
+
+        thread = QThread(self)
+        thread.run = lambda: self.map_stage_thread(map_model, question, chunks)
+        thread.start()
+
+    def map_stage_thread(self, model_name, question, chunks):
+        """Sends the map requests concurrently, at most map_reduce_concurrency at a time, emitting each result as it completes."""
+        model = self.model_for(model_name)
+        generation_config = dict(self.generation_config, max_output_tokens=self.map_reduce_map_max_tokens)
+        semaphore = asyncio.Semaphore(self.map_reduce_concurrency)
+        input_pricing, output_pricing = self.pricing_for(model_name)
+
+        async def map_chunk(index, label, text):
+            prompt = (
+                f"{question}\n\nThis is part {index + 1} of {len(chunks)} of an analysis of several files. Analyze only the file below, "
+                f"reporting concisely what is relevant to the question. The results of all parts will be combined afterwards.\nFile: {label}\n```{text}```"
+            )
+            async with semaphore:
+                started = time.perf_counter()
+                result = {"label": label, "text": None, "error": None, "input_tokens": 0, "output_tokens": 0, "cost": 0.0}
+                try:
+                    response = await model.generate_content_async(
+                        [{'role': 'user', 'parts': [prompt]}], request_options={'timeout': self.timeout},
+                        generation_config=generation_config, safety_settings=self.safety_settings
+                    )
+                    usage = response.usage_metadata
+                    result.update(text=response.text, input_tokens=usage.prompt_token_count, output_tokens=usage.candidates_token_count,
+                                  cost=(usage.prompt_token_count * input_pricing['upto_128k'] + usage.candidates_token_count * output_pricing['upto_128k']) / 1_000_000)
+                    TELEMETRY.record('map', model_name, time.perf_counter() - started, input_tokens=result['input_tokens'], output_tokens=result['output_tokens'], cost=result['cost'])
+                except Exception as e: # A failed part is reported and left out of the synthesis
+                    result['error'] = "Timed out" if isinstance(e, DeadlineExceeded) else str(e)
+                    TELEMETRY.record('map', model_name, time.perf_counter() - started, error=result['error'])
+            self.map_result.emit(result)
+
+        async def run_maps():
+            await asyncio.gather(*(map_chunk(i, label, text) for i, (label, text) in enumerate(chunks)))
+
+        self.loop.run_until_complete(run_maps())
+        self.map_stage_finished.emit() # After the loop has stopped, since the reduce request runs on it too
+
+    def handle_map_result(self, result):
+        """Shows a map result as soon as it completes and accounts for its cost."""
+        stage = self.map_stage
+        stage['results'].append(result)
+        stage['cost'] += result['cost']
+        self.total_input_tokens += result['input_tokens']
+        self.total_output_tokens += result['output_tokens']
+        self.session_cost += result['cost']
+        self.branch.cost += result['cost']
+        self.branch.requests += 1
+        SPEND.record(result['cost'])
+        done = len(stage['results'])
+        if result['error']:
+            self.display_message("Error", f"[{done}/{stage['total']}] {result['label']}: {result['error']}")
+        else:
+            self.show_message(Message(f"Map {done}/{stage['total']}", f"{result['label']}\n\n{result['text']}"))
+        self.progress_bar.setValue(done)
+        self.progress_bar.setFormat(f"Map: {done}/{stage['total']} parts")
+        self.update_status_bar()
+
+    def handle_map_stage_finished(self):
+        """Sends the reduce request, combining the map results, through send_message."""
+        stage = self.map_stage
+        succeeded = [r for r in stage['results'] if not r['error']]
+        stage['elapsed'] = time.perf_counter() - stage['started']
+        self.request_in_progress = False
+        self.display_message("Map-Reduce", (
+            f"Map stage: {len(succeeded)} of {stage['total']} parts analyzed in {stage['elapsed']:.1f}s, "
+            f"{sum(r['input_tokens'] for r in succeeded):,} input and {sum(r['output_tokens'] for r in succeeded):,} output tokens, ${stage['cost']:.5f}."
+        ))
+        if not succeeded:
+            self.map_stage = None
+            self.progress_bar.setFormat("Map-Reduce Failed")
+            return
+        order = {label: i for i, label in enumerate(r['label'] for r in stage['results'])}
+        self.files_context = f"These are the results of analyzing {len(succeeded)} files, or parts of files, separately for the question below. Combine them into one answer.\n\n"
+        self.files_context += "".join(f"Result for {r['label']}:\n{r['text']}\n\n" for r in sorted(succeeded, key=lambda r: order[r['label']]))
+        self.files_context += "User message: "
+        self.files_message = stage['question']
+        self.files_attachments = []
+        self.send_message(True)
+        if not self.request_in_progress: # Blocked by the budget
+            self.map_stage = None
+
     def send_docs_directory(self):
         """Sends all .txt files in a selected directory to the model."""
+        if not self.require_model():
+            return
 
         directory = QFileDialog.getExistingDirectory(self, "Select Documentation Directory")
         if not directory:
             return  # User cancelled the dialog
+        self.send_docs(directory)
 
-        files_context = "This is documentation scraped from a URL, use it to improve quality of your responses:\n"
-        total_tokens = 0
-        file_count = 0
+    def send_docs(self, directory, files=None):
+        """Counts the tokens of documentation files and sends them to the model with a message from the user.
 
-        for root, _, files in os.walk(directory):
-            for file in files:
-                if file.endswith(".txt"):
-                    file_path = os.path.join(root, file)
-                    try:
-                        with open(file_path, 'r', errors='ignore') as f:
-                            content = f.read()
-                            files_context += f"File: {file_path}\n```\n{content}\n```\n"
-                            file_count += 1
-                            total_tokens += self.model.count_tokens(content).total_tokens
-                    except Exception as e:
-                        self.display_message("Error", f"Error reading file {file_path}: {e}")
+        Args:
+            directory (str): The documentation directory.
+            files (list, optional): Only send these .txt files from the directory.
+        """
+        if not self.require_model():
+            return
+        files_context, total_tokens, file_count, minified = self.read_docs_context(directory, files)
 
         if file_count == 0:
             self.display_message("Info", f"No .txt files found in {directory}")
@@ -507,106 +2484,238 @@ class MainWindow(QMainWindow):
                 self.files_context = files_context + "User message: "
                 self.files_message = user_message
                 self.display_message("File", f"File Documentation directory sent to model: {directory}")
+                if minified[0]:
+                    self.display_message("File", self.describe_minified(*minified))
                 self.send_message(True)  # Send using the files_context 
 
+    def read_docs_context(self, directory, files=None):
+        """Reads every .txt file under a directory into a context block for the model.
+
+        Args:
+            directory (str): The documentation directory.
+            files (list, optional): Only read these .txt files, such as the pages a refresh changed.
+
+        Returns:
+            tuple: (context text, total tokens of the files, number of files read, [files, estimated tokens before and after minifying])
+        """
+        files_context = "This is documentation scraped from a URL, use it to improve quality of your responses:\n"
+        total_tokens = 0
+        file_count = 0
+        minified = [0, 0, 0]
+
+        if files is None:
+            files = [os.path.join(root, file) for root, _, names in os.walk(directory) for file in names]
+        for file_path in files:
+            if file_path.endswith(".txt"):
+                try:
+                    with open(file_path, 'r', errors='ignore') as f:
+                        content = f.read()
+                        if self.minify_context:
+                            content = self.minify_file(file_path, content, minified)
+                        files_context += f"File: {file_path}\n```\n{content}\n```\n"
+                        file_count += 1
+                        with TELEMETRY.track('count_tokens', self.model_name):
+                            total_tokens += self.model.count_tokens(content).total_tokens
+                except Exception as e:
+                    self.display_message("Error", f"Error reading file {file_path}: {e}")
+        return files_context, total_tokens, file_count, minified
+
     def scrape_docs_from_url(self):
-        """Scrapes documentation from a given URL using the docscraper script."""
+        """Scrapes the documentation pages under a URL into .txt files on a background thread."""
+        if self.crawler:
+            QMessageBox.warning(self, "Scraping in Progress", "Documentation is already being scraped. Stop it from the Tools menu first.")
+            return
         QMessageBox.information(
             self,
             "Scrape Documentation",
             "This tool will scrape all subpages of a URL into .txt files.\n"
             "Use it to grab the documentation for APIs, etc. and reference them when talking to the assistant.\n"
-            "WARNING: This may take a long time! You will receive a popup when finished or if theres an error."
+            "Progress is shown in the progress bar. You can stop scraping from the Tools menu and resume it later."
         )
         url, ok = QInputDialog.getText(self, "Enter URL", "Enter the URL to scrape:")
-        if ok:
-            self.progress_bar.setValue(0)
-            self.progress_bar.setMaximum(100)  # Indeterminate progress
-            self.progress_bar.setFormat("Scraping URL")
+        url = url.strip()
+        if not ok or not url:
+            return
+        if '://' not in url:
+            url = 'https://' + url
 
-            self.process = QProcess()
-            self.process.setProgram(sys.executable)
-            script_path = os.path.join(SCRIPT_DIR, "tools", "DocScraper", "docscraper.py")
-            self.process.setArguments([script_path, url, "scrape_and_save"]) # Pass url and function name as arguments
+        host = urllib.parse.urlsplit(url).netloc
+        if not host:
+            QMessageBox.warning(self, "Invalid URL", f"Invalid URL: {url}")
+            return
+        output_dir = os.path.join(SCRIPT_DIR, 'docs', re.sub(r'[^\w.-]', '_', host))
+        crawler = DocCrawler(url, output_dir, concurrency=self.scrape_concurrency * 2, per_host_concurrency=self.scrape_concurrency,
+                             max_pages=self.scrape_max_pages, timeout=self.timeout, progress=self.scrape_progress.emit)
+        resume = refresh = False
+        state = crawler.saved_state()
+        if state and not state.get('finished'):
+            resume = QMessageBox.question(
+                self, "Resume Scraping", f"A previous scrape of {crawler.start_url} did not finish. Resume it?",
+                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+            ) == QMessageBox.StandardButton.Yes
+        elif state:
+            refresh = QMessageBox.question(
+                self, "Refresh Documentation", f"{crawler.start_url} was scraped before. Refresh it, only downloading and rewriting the pages that changed?\n"
+                "Choose No to scrape everything again.",
+                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+            ) == QMessageBox.StandardButton.Yes
+
+        self.crawler = crawler
+        self.stop_scraping_action.setEnabled(True)
+        self.progress_bar.setValue(0)
+        self.progress_bar.setMaximum(1)
+        self.progress_bar.setFormat("Scraping: starting...")
+
+        self.scrape_thread = QThread(self)
+        self.scrape_thread.run = lambda: self.scrape_docs_thread(crawler, resume, refresh)
+        self.scrape_thread.start()
+
+    def scrape_docs_thread(self, crawler, resume, refresh):
+        """Runs the crawl on its own event loop, reporting the result with scrape_finished."""
+        try:
+            self.scrape_finished.emit(asyncio.run(crawler.run(resume, refresh)), None)
+        except Exception as e:
+            if DEBUG:
+                traceback.print_exc()
+            self.scrape_finished.emit(None, e)
 
-            self.process.finished.connect(self.handle_scraper_finished)
+    def stop_scraping(self):
+        """Stops the running scrape, it can be resumed by scraping the same URL again."""
+        if self.crawler:
+            self.crawler.stop()
+            self.progress_bar.setFormat("Stopping scraping...")
 
-            self.process.start()
+    def handle_scrape_progress(self, progress):
+        """Shows the crawler's progress in the progress bar."""
+        if not self.crawler:
+            return
+        self.progress_bar.setMaximum(max(progress['fetched'] + progress['queued'], 1))
+        self.progress_bar.setValue(progress['fetched'])
+        unchanged = f", {progress['unchanged']} unchanged" if progress['unchanged'] else ""
+        self.progress_bar.setFormat(f"Scraping: {progress['fetched']} pages fetched{unchanged}, {progress['queued']} queued, {progress['bytes'] / 1_000_000:.1f} MB")
+
+    def handle_scrape_finished(self, summary, error):
+        """Reports the end of a scrape."""
+        self.crawler = None
+        self.stop_scraping_action.setEnabled(False)
+        self.progress_bar.setValue(self.progress_bar.maximum())  # Indicate completion
+        if error:
+            self.progress_bar.setFormat("Scraping Incomplete")
+            QMessageBox.warning(self, "Scraping Error", f"An error occurred during scraping:\n{error}")
+            return
 
-            # Start animation timer
-            self.scraping_animation_state = (0)
-            self.animation_timer = QTimer(self)
-            self.animation_timer.timeout.connect(self.update_scraping_animation)
-            self.animation_timer.start(1000)
-    
-    def update_scraping_animation(self):
-        """Updates the progress bar animation."""
-        animation_states = ["Scraping URL", "Scraping URL.", "Scraping URL..", "Scraping URL..."]
-        self.progress_bar.setFormat(animation_states[self.scraping_animation_state])
-        self.scraping_animation_state = (self.scraping_animation_state + 1) % len(animation_states)
-
-    def handle_scraper_finished(self, exit_code, exit_status):
-        """Handles the docscraper process finishing."""
-        if exit_code == 0:
-            self.animation_timer.stop()
-            self.progress_bar.setValue(self.progress_bar.maximum())  # Indicate completion
+        details = f"{summary['pages']} pages saved to {summary['output_dir']}, {summary['failed']} failed."
+        if not summary['pages'] and summary['errors']:
+            self.progress_bar.setFormat("Scraping Incomplete")
+            errors = "\n".join(f"{url}: {e}" for url, e in summary['errors'].items())
+            QMessageBox.warning(self, "Scraping Error", f"No pages could be scraped:\n{errors}")
+            return
+        if summary['finished'] and summary['refresh']:
+            changes = summary['changes']
+            changed_files = [os.path.join(summary['output_dir'], f) for f in changes['updated'] + changes['added']]
+            details = f"{len(changes['updated'])} pages updated, {len(changes['added'])} added, {len(changes['removed'])} removed and {changes['unchanged']} unchanged in {summary['output_dir']}."
+            self.progress_bar.setFormat("Refresh Complete")
+            if changed_files and QMessageBox.question(
+                self, "Refresh Complete", f"{details}\nThe changes are listed in changelog.jsonl.\nSend the changed pages to the model?",
+                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+            ) == QMessageBox.StandardButton.Yes:
+                self.send_docs(summary['output_dir'], changed_files)
+            elif not changed_files:
+                QMessageBox.information(self, "Refresh Complete", f"The documentation hasn't changed.\n{details}")
+        elif summary['finished']:
             self.progress_bar.setFormat("Scraping Complete")
-            QMessageBox.information(self, "Scraping Complete", "Documentation scraped successfully!")
+            QMessageBox.information(self, "Scraping Complete", f"Documentation scraped successfully!\n{details}\nUse Send Docs Directory to send it to the model.")
         else:
-            self.animation_timer.stop()
-            self.progress_bar.setValue(self.progress_bar.maximum())  # Indicate completion
+            reason = "Scraping was stopped" if summary['stopped'] else f"The {self.scrape_max_pages} page limit was reached"
             self.progress_bar.setFormat("Scraping Incomplete")
-            error_output = bytes(self.process.readAllStandardError()).decode()  # Get error output
-            QMessageBox.warning(self, "Scraping Error", f"An error occurred during scraping:\n{error_output}")
+            QMessageBox.information(self, "Scraping Incomplete", f"{reason} with {summary['queued']} pages left.\n{details}\nScrape the same URL again to resume.")
+        self.display_message("Docs", f"Scraped {summary['url']}: {details}")
 
-    async def send_message_async(self, message, timeout):
+    async def send_message_async(self, message, timeout, queued_at=None, input_tokens=None):
         """Sends the message asynchronously to the Gemini model and handles the response."""
+        queue_time = time.perf_counter() - queued_at if queued_at else 0.0
+        request_started = time.perf_counter()
         try:
-            # Calculate token counts for the user's message and subtract system instructions tokens
-            total_message_tokens = self.model.count_tokens([{'role': 'user', 'parts':[message]}]).total_tokens
-            input_tokens = total_message_tokens - self.system_instruction_tokens
+            if input_tokens is None:
+                # Calculate token counts for the user's message and subtract system instructions tokens
+                with TELEMETRY.track('count_tokens', self.model_name):
+                    total_message_tokens = self.model.count_tokens([{'role': 'user', 'parts':[message]}]).total_tokens
+                input_tokens = total_message_tokens - self.system_instruction_tokens
 
             if DEBUG:
                 print("Sending message to model:", message, tag='Debug', tag_color='cyan', color='white')
 
             # Send the message asynchronously to the model. Overrides settings in case they are changed during the session
-            response = await self.chat.send_message_async(
-                message,
+            queue_time += time.perf_counter() - request_started # Counting tokens delays the request too
+            request_started = time.perf_counter()
+            contents = self.messages.contents() # Already ends with the user's message
+            if self.request_diff_mode:
+                contents = UnifiedDiff.instruct(contents)
+            cache_key = None
+            if self.response_cache_enabled:
+                cache_key = ResponseCache.key(self.request_model_name, self.request_generation_config, self.safety_settings, self.system_instructions, contents)
+                response = RESPONSE_CACHE.get(cache_key)
+                if response:
+                    TELEMETRY.record('chat_cached', self.request_model_name, time.perf_counter() - request_started, queue_time=queue_time, input_tokens=response.usage_metadata.prompt_token_count, output_tokens=response.usage_metadata.candidates_token_count)
+                    return response, input_tokens, None
+
+            model = self.model_for(self.request_model_name)
+            response = await model.generate_content_async(
+                contents,
                 request_options={'timeout': timeout},
-                generation_config=self.generation_config,
+                generation_config=self.request_generation_config,
                 safety_settings=self.safety_settings
                 )
 
+            usage = response.usage_metadata
+            if cache_key:
+                try:
+                    RESPONSE_CACHE.put(cache_key, response.text, usage.prompt_token_count, usage.candidates_token_count)
+                except ValueError:
+                    pass # Blocked replies have no text and aren't cached
+            input_pricing, output_pricing = self.pricing_for(self.request_model_name)
+            TELEMETRY.record(
+                'chat', self.request_model_name, time.perf_counter() - request_started, queue_time=queue_time,
+                input_tokens=usage.prompt_token_count, output_tokens=usage.candidates_token_count,
+                cost=calculate_cost(usage.prompt_token_count, input_pricing, self.messages) + calculate_cost(usage.candidates_token_count, output_pricing, self.messages)
+            )
+
             if DEBUG:
                 print("Full response from model:", response, tag='Debug', tag_color='cyan', color='white') 
 
             return response, input_tokens, None
 
         # Handle exceptions
-        except DeadlineExceeded as e:
-            self.chat.history.append({'parts': [{'text': message}], 'role': 'user'})
+        except DeadlineExceeded:
+            TELEMETRY.record('chat', self.request_model_name, time.perf_counter() - request_started, queue_time=queue_time, error="DeadlineExceeded")
             if DEBUG:
                 print(f"DeadlineExceeded: Request timed out after {timeout} seconds.", tag='Debug', tag_color='red') # Log the timeout
             self.request_in_progress = False # Allow new requests
             return None, input_tokens, DeadlineExceeded
         except Exception as e:
-            self.chat.history.append({'parts': [{'text': message}], 'role': 'user'})
+            TELEMETRY.record('chat', self.request_model_name, time.perf_counter() - request_started, queue_time=queue_time, error=str(e))
             if DEBUG:
                 print(f"Error sending message: {e}", tag='Debug', tag_color='red')
                 traceback.print_exc()
             self.request_in_progress = False # Allow new requests
             return None, input_tokens, e
     
-    def send_message_thread(self, message, timeout):
+    def send_message_thread(self, message, timeout, queued_at=None, input_tokens=None):
         """Runs the asynchronous send_message_async in a separate thread."""
         async def run_task():
-            response, input_tokens, error = await self.send_message_async(message, timeout)
+            response, counted_tokens, error = await self.send_message_async(message, timeout, queued_at, input_tokens)
             if not error:
-                self.handle_response(response, input_tokens)
+                try:
+                    RENDERER.render(response.text) # Render here so displaying the reply on the GUI thread is a cache hit
+                except ValueError:
+                    pass # Replies without text are reported by update_ui_with_response
+                self.handle_response(response, counted_tokens)
             else:
                 self.progress_bar.setValue(self.progress_bar.maximum()) # Indicate completion (timeout or error)
                 if error == DeadlineExceeded:
                     self.timeout_occurred.emit()
+                elif self.offline_queue and is_retryable(error):
+                    self.request_deferred.emit(f"{type(error).__name__}: {error}")
                 else:
                     self.error_occured.emit(str(error))
         
@@ -621,56 +2730,336 @@ class MainWindow(QMainWindow):
         self.progress_bar.setFormat("Response Received")
         self.response_receieved.emit(response, input_tokens) # Emit signal with response and input tokens
     
+    def handle_request_deferred(self, error):
+        """Queues the pending request in QUEUE, to be sent by flush_queue once the API is reachable."""
+        branch, user_message = self.pending_request
+        history = branch.messages.to_dicts()[:branch.messages.items.index(user_message) + 1]
+        job = QUEUE.add(branch.name, self.request_model_name, history, error, self.request_generation_config, self.request_diff_mode, self.request_output_kind)
+        self.queued_messages[job['id']] = (branch, user_message)
+        self.map_stage = None
+        self.progress_bar.setFormat(f"Queued: {len(QUEUE.pending())} requests")
+        self.display_message("Queued", (
+            f"The request could not be sent ({error}). It was queued and will be sent automatically, in order, "
+            f"when the API can be reached. The reply will appear after your message. You can keep working meanwhile."
+        ))
+        if not self.queue_timer.isActive():
+            self.queue_timer.start(2000)
+
+    def flush_queue(self):
+        """Sends the oldest queued request when it is due and no other request is running."""
+        if self.request_in_progress or self.history_loading or not self.model_ready:
+            return
+        if not QUEUE.pending():
+            self.queue_timer.stop()
+            return
+        job = QUEUE.next_due()
+        if not job:
+            return
+        if job['id'] not in self.queued_messages: # Its conversation wasn't restored
+            return
+        branch, user_message = self.queued_messages[job['id']]
+        if user_message not in branch.messages.items: # Deleted by the user
+            QUEUE.remove(job)
+            del self.queued_messages[job['id']]
+            self.display_message("Queued", "A queued request was dropped because its message was deleted.")
+            return
+
+        index = branch.messages.items.index(user_message)
+        messages = branch.messages.items[:index + 1] # Includes the replies to earlier queued requests
+        generation_config = job.get('generation_config') or self.generation_config # Sent with the settings of the original request
+        self.request_in_progress = True
+        self.progress_bar.setFormat(f"Sending queued request (attempt {job['attempts'] + 1})...")
+
+        async def send():
+            try:
+                # Built here, attachments whose handles expired are uploaded again, and fail if their file moved or changed
+                contents = [m.to_content() for m in messages]
+            except Exception as e:
+                return None, e
+            if job.get('diff_mode'):
+                contents = UnifiedDiff.instruct(contents)
+            started = time.perf_counter()
+            try:
+                response = await self.model_for(job['model']).generate_content_async(
+                    contents, request_options={'timeout': self.timeout}, generation_config=generation_config, safety_settings=self.safety_settings
+                )
+                response.text # Raises for blocked replies
+                TELEMETRY.record('chat_queued', job['model'], time.perf_counter() - started, input_tokens=response.usage_metadata.prompt_token_count, output_tokens=response.usage_metadata.candidates_token_count, retries=job['attempts'])
+                return response, None
+            except Exception as e:
+                TELEMETRY.record('chat_queued', job['model'], time.perf_counter() - started, retries=job['attempts'], error=str(e))
+                return None, e
+
+        thread = QThread(self)
+        thread.run = lambda: self.queued_response.emit(job, *self.loop.run_until_complete(send()))
+        thread.start()
+
+    def handle_queued_response(self, job, response, error):
+        """Inserts the reply to a queued request after its message, or schedules a retry."""
+        self.request_in_progress = False
+        if error is not None:
+            if is_retryable(error) or isinstance(error, DeadlineExceeded):
+                QUEUE.retry_later(job, f"{type(error).__name__}: {error}")
+                self.progress_bar.setFormat(f"Queued: {len(QUEUE.pending())} requests, retrying in {job['next_attempt'] - time.time():.0f}s")
+            else:
+                QUEUE.remove(job)
+                del self.queued_messages[job['id']]
+                self.display_message("Error", f"A queued request failed and was dropped: {str(error).rstrip('.')}. Its message is still in the history, delete it if necessary.")
+            return
+
+        branch, user_message = self.queued_messages.pop(job['id'])
+        QUEUE.remove(job)
+        usage = response.usage_metadata
+        input_pricing, output_pricing = self.pricing_for(job['model'])
+        request_cost = calculate_cost(usage.prompt_token_count, input_pricing, branch.messages) + calculate_cost(usage.candidates_token_count, output_pricing, branch.messages)
+        self.total_input_tokens += usage.prompt_token_count
+        self.total_output_tokens += usage.candidates_token_count
+        self.session_cost += request_cost # Billed even if the reply is discarded
+        branch.cost += request_cost
+        branch.requests += 1
+        SPEND.record(request_cost)
+        if user_message not in branch.messages.items: # Deleted while the request was being sent
+            self.display_message("Queued", "The reply to a queued request was discarded because its message was deleted.")
+            self.update_status_bar()
+            if QUEUE.pending():
+                QTimer.singleShot(0, self.flush_queue)
+            return
+        index = branch.messages.items.index(user_message)
+        model_message = branch.messages.insert(index + 1, "Model", response.text, usage.candidates_token_count, calculate_cost(usage.candidates_token_count, output_pricing, branch.messages))
+
+        # Show the reply after its message in the branch's chat window
+        if user_message in branch.chat_history:
+            branch.chat_history.insert(branch.chat_history.index(user_message) + 1, model_message)
+        else:
+            branch.chat_history.append(model_message)
+        notice = f"A queued request was sent after {time.time() - job['created']:.0f}s, its reply is shown after your message" + ("" if branch is self.branch else f" in branch {branch.name}") + "."
+        branch.chat_history.append(Message("Queued", notice))
+        if self.output_policy and job.get('output_kind') in OutputPolicy.KINDS:
+            cap = (job.get('generation_config') or self.generation_config)['max_output_tokens']
+            hit_cap = OutputPolicy.hit_cap(response, cap)
+            self.output_policy.record(job['output_kind'], usage.candidates_token_count, hit_cap)
+            if hit_cap:
+                branch.chat_history.append(Message("Output Policy", f"The reply to the queued request was cut off at the {cap:,} token cap for {job['output_kind']} prompts."))
+        if branch is self.branch:
+            self.update_chat_window()
+        remaining = len(QUEUE.pending())
+        self.progress_bar.setFormat(f"Queued: {remaining} requests" if remaining else "Queued Requests Sent")
+        self.update_status_bar()
+        if job.get('diff_mode') and branch is self.branch: # Diff paths are resolved against the files of the active branch
+            self.diff_retries = 0
+            self.diff_results = {}
+            self.check_diff_reply(response.text, usage.candidates_token_count)
+        if remaining:
+            QTimer.singleShot(0, self.flush_queue) # The rest are due now that the API answers
+
+    def restore_queue(self):
+        """Offers to restore requests queued in a previous session, with their conversations, and send them."""
+        jobs = [job for job in QUEUE.pending() if job['id'] not in self.queued_messages]
+        if not jobs:
+            return
+        reply = QMessageBox.question(
+            self, "Queued Requests",
+            f"{len(jobs)} requests could not be sent before the application closed. Restore their conversations and send them now?\n"
+            "Choose No to discard them.",
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+        )
+        if reply != QMessageBox.StandardButton.Yes:
+            for job in jobs:
+                QUEUE.remove(job)
+            return
+        groups = {}
+        for job in jobs:
+            groups.setdefault(job['branch'], []).append(job)
+        for name, group in groups.items():
+            # The last job's conversation holds the messages of the earlier ones, none of them has a reply yet
+            history = group[-1]['history']
+            if not self.messages.items and not self.queued_messages:
+                branch = self.branch
+            else:
+                branch_name = f"{name} (queued)"
+                while branch_name in self.branches:
+                    branch_name += "'"
+                branch = Branch(branch_name, MessageStore(self.spill_threshold_kb * 1024))
+                self.branches[branch_name] = branch
+            for message_data in history:
+                branch.messages.append(message_data['role'], message_data['content'], message_data.get('tokens', 0), message_data.get('cost', 0.0), message_data.get('attachments'))
+            branch.chat_history.extend(branch.messages)
+            for job in group:
+                job['next_attempt'] = 0 # Try now
+                self.queued_messages[job['id']] = (branch, branch.messages[len(job['history']) - 1])
+            self.display_message("Queued", f"Restored {len(group)} queued requests of branch {name}" + ("" if branch is self.branch else f" as branch {branch.name}, switch to it from the Branches menu") + ".")
+        self.update_chat_window()
+        self.update_status_bar()
+        self.queue_timer.start(2000)
+        self.flush_queue()
+
     def handle_timeout(self):
+        self.map_stage = None
         self.progress_bar.setFormat("Response Timed Out")
         QMessageBox.warning(self, "Timeout Error", "Your message was still added to history. Delete if necessary. DeadlineExceeded Error, try increasing timeout or reducing complexity of your prompt.")
     
     def handle_error(self, error_message):
+        self.map_stage = None
         self.progress_bar.setFormat("Response Error")
         QMessageBox.warning(self, "Response Error", f"Your message was still added to history. Delete if necessary. Response error: {error_message}")
     
     def update_ui_with_response(self, response, input_tokens):
         """Updates the UI with the response from the model."""
-        self.last_input_tokens = response.usage_metadata.prompt_token_count
-        self.last_output_tokens = response.usage_metadata.candidates_token_count
-        self.total_input_tokens += self.last_input_tokens  # Only add the input tokens without system instructions
-        self.total_output_tokens += self.last_output_tokens
+        usage = response.usage_metadata
+        input_pricing, output_pricing = self.pricing_for(self.request_model_name)
+        cached = getattr(response, 'cached', False) # Served by RESPONSE_CACHE, nothing was billed
+        if cached:
+            saved = calculate_cost(usage.prompt_token_count, input_pricing, self.messages) + calculate_cost(usage.candidates_token_count, output_pricing, self.messages)
+            self.display_message("Cached", f"Identical request answered from the response cache, saving ${saved:.5f}.")
+            self.last_input_tokens = self.last_output_tokens = 0
+        else:
+            user_message = self.messages[-1]
+            if user_message.attachments:
+                # The message was counted as text, the API reports what the attachments cost
+                self.messages.add_tokens(user_message, max(0, usage.prompt_token_count - SI_TOKENS - self.messages.total_tokens))
+            self.last_input_tokens = usage.prompt_token_count
+            self.last_output_tokens = usage.candidates_token_count
+            self.total_input_tokens += self.last_input_tokens  # Only add the input tokens without system instructions
+            self.total_output_tokens += self.last_output_tokens
+        if self.output_policy and self.request_output_kind:
+            cap = self.request_generation_config['max_output_tokens']
+            hit_cap = OutputPolicy.hit_cap(response, cap)
+            self.output_policy.record(self.request_output_kind, usage.candidates_token_count, hit_cap)
 
         # Add Model response to chat history
-        self.messages.append({"role": "Model", "content": response.text, "tokens": self.last_output_tokens})  # Store message in all_messages
-        self.display_message("Model", response.text)
-
-        # Update session cost
-        self.session_cost = calculate_cost(self.total_input_tokens, INPUT_PRICING, self.messages) + calculate_cost(self.total_output_tokens, OUTPUT_PRICING, self.messages)
+        model_message = self.messages.append("Model", response.text, usage.candidates_token_count, calculate_cost(self.last_output_tokens, output_pricing, self.messages))  # Store message in messages
+        self.show_message(model_message)
+
+        # Update session cost, adding each request at the pricing of the model it was sent to
+        if not cached:
+            request_cost = calculate_cost(self.last_input_tokens, input_pricing, self.messages) + calculate_cost(self.last_output_tokens, output_pricing, self.messages)
+            self.session_cost += request_cost
+            self.branch.cost += request_cost
+            self.branch.requests += 1
+            SPEND.record(request_cost) # Daily and monthly budgets span sessions
+        if self.map_stage:
+            reduce_cost = 0.0 if cached else request_cost
+            self.display_message("Map-Reduce", (
+                f"Map stage: ${self.map_stage['cost']:.5f} over {len(self.map_stage['results'])} requests. "
+                f"Synthesis: ${reduce_cost:.5f}. Total: ${self.map_stage['cost'] + reduce_cost:.5f} in {time.perf_counter() - self.map_stage['started']:.1f}s."
+            ))
+            self.map_stage = None
 
         self.update_status_bar()
 
         self.progress_bar.setValue(self.progress_bar.maximum())  # Indicate successful completion
 
+        if self.output_policy and self.request_output_kind and hit_cap:
+            self.display_message("Output Policy", f"The reply was cut off at the {cap:,} token cap for {self.request_output_kind} prompts. Start a message with #max:N to allow a longer reply.")
+
+        if self.request_diff_mode:
+            self.check_diff_reply(response.text, usage.candidates_token_count)
+
+    def check_diff_reply(self, text, output_tokens):
+        """Validates the diffs of a reply in diff-only mode against the files they change.
+
+        A diff that doesn't parse or apply is sent back to the model with the errors, up to diff_max_retries times.
+        A valid one is kept for Preview/Apply Diff.
+        """
+        errors = []
+        try:
+            patches = UnifiedDiff.parse(text)
+        except ValueError as e:
+            patches = []
+            errors.append(str(e))
+        if not patches and not errors:
+            return # Not a code change
+
+        results = dict(self.diff_results) # Valid patches of the earlier attempts, replaced by corrections
+        for patch in patches:
+            name = patch['new_path'] or patch['old_path']
+            path = self.resolve_diff_path(name)
+            if path is None:
+                errors.append(f"{name}: not found in the project directory or the files in context")
+                continue
+            try:
+                original = None
+                if os.path.exists(path):
+                    with open(path, 'r', encoding='utf-8', newline='') as f:
+                        original = f.read()
+                elif patch['old_path'] is not None:
+                    raise ValueError("the file doesn't exist, use --- /dev/null to create it")
+                results[path] = (original, None if patch['new_path'] is None else UnifiedDiff.apply(original or '', patch['hunks']))
+            except (ValueError, OSError) as e:
+                errors.append(f"{name}: {e}")
+
+        if errors:
+            self.diff_results = results
+            if self.diff_retries < self.diff_max_retries:
+                self.diff_retries += 1
+                self.display_message("Diff", f"The diff doesn't apply, asking for a correction ({self.diff_retries}/{self.diff_max_retries}): {'; '.join(errors)}")
+                QTimer.singleShot(0, lambda: self.reprompt_diff(errors))
+            else:
+                self.display_message("Warning", f"The diff doesn't apply: {'; '.join(errors)}")
+            return
+
+        self.diff_results = {}
+        self.last_diff = results
+        rewrite_tokens = sum(estimate_tokens(new or '') for _, new in results.values())
+        savings = f" instead of ~{rewrite_tokens:,} to rewrite the files ({1 - output_tokens / rewrite_tokens:.0%} fewer)" if output_tokens < rewrite_tokens else ""
+        self.display_message("Diff", f"Diff for {len(results)} files validated. The reply took {output_tokens:,} output tokens{savings}. Use Tools > Preview/Apply Diff to review and apply it.")
+
+    def reprompt_diff(self, errors):
+        """Asks the model for a corrected diff, naming only what failed."""
+        if self.request_in_progress:
+            return
+        self.files_context = ""
+        self.files_message = "Your diff could not be applied:\n" + "\n".join(f"- {e}" for e in errors) + (
+            "\nReply with a corrected unified diff for only these files. Copy the context and removed lines exactly from the files."
+        )
+        self.diff_reprompting = True
+        try:
+            self.send_message(True)
+        finally:
+            self.diff_reprompting = False
+
+    def resolve_diff_path(self, name):
+        """Finds the file a diff path refers to: a file sent as context, or a path inside the project directory.
+
+        Any other path, such as an absolute path elsewhere or one climbing out of the project with .., gives None.
+        """
+        parts = name.replace('\\', '/').split('/')
+        relative = '/'.join(part for part in parts if part not in ('', '.'))
+        for message in self.messages:
+            if message.role == "User" and "File: " in message.content:
+                for path in re.findall(r'^File: (.+?)(?: \(.*\))?$', message.content, flags=re.MULTILINE):
+                    if path == name or ('..' not in parts and path.replace('\\', '/').endswith('/' + relative)):
+                        return path
+        if self.project_dir:
+            root = os.path.realpath(self.project_dir)
+            path = os.path.realpath(os.path.join(root, name))
+            if path.startswith(os.path.join(root, '')) and os.path.isdir(os.path.dirname(path)):
+                return path
+        return None
+
+    def preview_diff(self):
+        """Shows the last validated diff and lets the user apply it to the files."""
+        if not self.last_diff:
+            QMessageBox.information(self, "No Diff", "No validated diff yet. Turn on Tools > Diff-Only Replies and ask for a change to files in the context.")
+            return
+        DiffPreviewDialog(self.last_diff, self).exec()
+
     def display_message(self, sender, message):
-        """Appends the formatted message to the chat_history."""
-        color = ""
-        match sender:
-            case "User":
-                color = "lightgreen" 
-            case "Model":
-                color = "cyan"
-                # Replace code blocks with <pre> tags
-                message = re.sub(r'```(.*?)```', r"<span style='white-space: pre-wrap;'>\1</span>", message, flags=re.DOTALL)
-                # Replace bold text with <strong> tags
-                message = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', message)
-                # Replace italic text with <em> tags
-                message = re.sub(r'_(.*?)_', r'<em>\1</em>', message)
-            case "Error":
-                color = "red" 
-            case "Warning":
-                color = "orange" 
-            case _:
-                color = "yellow" 
-
-        formatted_message = f"<hr style='width: 100%; border-top: 1px;'><p style='margin: 0px;'><strong style='color:{color}; background-color:black;'>{sender}:</strong> <span style='white-space: pre-wrap;'>{message}</span></p>"
-        self.chat_history.append(formatted_message) # Append to chat_history list
-        self.update_chat_window() # Update the chat window
+        """Shows a notice, such as a system message or an error, in the chat window."""
+        self.show_message(Message(sender, str(message)))
+
+    def show_message(self, message):
+        """Appends a Message to the chat window."""
+        self.show_messages([message])
+
+    def show_messages(self, messages):
+        """Appends Messages to the chat window."""
+        self.chat_history.extend(messages) # Append to chat_history list
+        # Lay out only the new messages, update_chat_window redraws the whole history when it changes
+        cursor = QTextCursor(self.chat_window.document())
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.insertHtml("".join(message.render() for message in messages))
+        self.chat_window.verticalScrollBar().setValue(self.chat_window.verticalScrollBar().maximum()) # Scroll to the bottom of the chat window
 
     def view_full_message(self):
         """Allows the user to view the full content of a message."""
@@ -681,19 +3070,21 @@ class MainWindow(QMainWindow):
             try:
                 message = self.messages[message_index - 1] # Adjust for zero-based indexing
                 prefix = ''
-                print(f'Viewing message: {message}', tag='Debug', tag_color='cyan', color='white')
-                if message['role'] == 'User':
-                    prefix = f'<strong style="color:lightgreen; background-color:black;">User</strong> | Tokens: {message["tokens"]} | Cost to keep: ${calculate_cost(message["tokens"], INPUT_PRICING, self.messages):.5f}<hr>'
+                print(f'Viewing message: {message.to_dict()}', tag='Debug', tag_color='cyan', color='white')
+                if message.role == 'User':
+                    prefix = f'<strong style="color:lightgreen; background-color:black;">User</strong> | Tokens: {message.tokens} | Cost to keep: ${calculate_cost(message.tokens, INPUT_PRICING, self.messages):.5f}<hr>'
                 else:
-                    prefix = f'<strong style="color:cyan; background-color:black">Model</strong> | Tokens: {message["tokens"]} | Cost to keep: ${calculate_cost(message["tokens"], INPUT_PRICING, self.messages):.5f}<hr>'
+                    prefix = f'<strong style="color:cyan; background-color:black">Model</strong> | Tokens: {message.tokens} | Cost to keep: ${calculate_cost(message.tokens, INPUT_PRICING, self.messages):.5f}<hr>'
 
-                message_dialog = ViewMessageDialog("Message Content", (prefix + f"<pre><span style='white-space: pre-wrap;'>{message['content']}</span></pre>"), message)
+                message_dialog = ViewMessageDialog("Message Content", (prefix + f"<pre><span style='white-space: pre-wrap;'>{message.content}</span></pre>"), message.to_dict())
                 message_dialog.exec()
             except IndexError:
                 self.display_message("Error", "Invalid message index.")
 
     def import_message(self):
         """Imports a single message from a JSON file."""
+        if not self.require_model():
+            return
         file_dialog = QFileDialog(self)
         file_dialog.setNameFilter("JSON Message (*.json)")
         if file_dialog.exec():
@@ -714,9 +3105,7 @@ class MainWindow(QMainWindow):
 
                 # Append to chat history and model history
                 self.display_message("System", f"Message imported from {filename}")
-                self.messages.append({"role": role, "content": content, "tokens": tokens})
-                self.chat.history.append({'parts': [{'text': content}], 'role': role})
-                self.display_message(role, content)
+                self.show_message(self.messages.append(role, content, int(tokens), calculate_cost(int(tokens), INPUT_PRICING, self.messages)))
 
                 # Add tokens to total token count
                 self.total_input_tokens += int(tokens)
@@ -730,65 +3119,128 @@ class MainWindow(QMainWindow):
             except Exception as e:
                 QMessageBox.critical(self, "Import Error", f"Error importing message: {str(e)}")
 
+    def display_connection_stats(self):
+        """Displays how much the shared API connections have been reused."""
+        stats = CLIENT_POOL.snapshot_stats()
+        self.display_message("Connections", (
+            f"{stats['requests']} requests over {stats['channels_created']} connections ({stats['requests_per_channel']:.1f} requests per connection). "
+            f"Models created: {stats['models_created']}, reused: {stats['models_reused']}. "
+            f"Client configurations: {stats['configures']}, skipped: {stats['configures_skipped']}. "
+            f"Files uploaded: {UPLOADS.uploads}, upload handles reused: {UPLOADS.reuses}."
+        ))
+
     def display_chat_history(self):
         """Displays a concise chat history in a larger message box."""
         history_text = []
         total_cost = 0.0
         for i, m in enumerate(self.messages):
-            # Calculate message content preview, removing newlines
-            content_preview = m['content'][:100] + ' ... ' + m['content'][-100:] if len(m['content']) > 205 else m['content']
-            content_preview = content_preview.replace('\n', ' ')
-            input_cost = calculate_cost(m['tokens'], INPUT_PRICING, self.messages) # Calculate cost to keep message
+            content_preview = m.preview() # Message content preview, without newlines
+            input_cost = calculate_cost(m.tokens, INPUT_PRICING, self.messages) # Calculate cost to keep message
             total_cost += input_cost
             
             # Apply color based on message role 
-            color = "lightgreen" if m['role'] == "User" else "cyan"
-            history_text.append(f"<hr style='width: 100%; border-top: 1px;'>{i+1}. <strong><span style='color:{color}; background-color: black'>{m['role']}</span>, Tokens: {m['tokens']}, Cost to keep: ${input_cost:.5f}</strong><br><span style='white-space: pre-wrap;'>{content_preview}</span>")
+            color = "lightgreen" if m.role == "User" else "cyan"
+            history_text.append(f"<hr style='width: 100%; border-top: 1px;'>{i+1}. <strong><span style='color:{color}; background-color: black'>{m.role}</span>, Tokens: {m.tokens}, Cost to keep: ${input_cost:.5f}</strong><br><span style='white-space: pre-wrap;'>{content_preview}</span>")
         history_text.append(f"<hr><strong>Total cost to keep: ${total_cost:.5f}</strong>")
 
         if DEBUG:
-            print('Model Chat History:', self.chat.history, tag='Debug', tag_color='cyan', color='white')
+            print('Model Chat History:', self.messages.contents(), tag='Debug', tag_color='cyan', color='white')
 
         history_dialog = ViewHistoryDialog("Chat History", "".join(history_text))
         history_dialog.exec()
 
     def load_chat_history(self):
         """Opens a dialog to load chat history from a file."""
+        if not self.require_model():
+            return
          # Display a warning message box
         warning_msg = QMessageBox(self)
         warning_msg.setIcon(QMessageBox.Icon.Warning)
         warning_msg.setWindowTitle("File Type Warning")
-        warning_msg.setText("Warning: Only select '.json' files generated by this application!")
+        warning_msg.setText("Warning: Only select .json or .jsonl files generated by this application!")
         warning_msg.setStandardButtons(QMessageBox.StandardButton.Ok)  # Only an "OK" button
         warning_msg.exec()
 
         file_dialog = QFileDialog()
-        file_dialog.setNameFilter("Chat History (*.json)")
+        file_dialog.setNameFilter("Chat History (*.json *.jsonl *.jsonl.gz *.jsonl.zst)")
         if file_dialog.exec():
             filename = file_dialog.selectedFiles()[0]
-            try:
-                with open(filename, 'r') as f:
-                    data = json.load(f)
-
-                    # Load messages and add to chat.history and all_messages
-                    for message_data in data.get("chat_history", []):
-                        role = message_data['role']
-                        content = message_data['content']
-                        tokens = message_data.get('tokens', 0) # Get tokens, default to 0 if not present in older files
-                        self.messages.append({"role": role, "content": content, "tokens": tokens})
-                        self.chat.history.append({'parts': [{'text': content}], 'role': role.lower()})
-                    self.update_chat_window()
-                    self.update_status_bar()
-                    self.display_message("System", "Chat history loaded successfully.")
-            except Exception as e:
-                self.display_message("Error", f"Error loading chat history: {e}")
+            if self.history_thread and self.history_thread.isRunning():
+                QMessageBox.warning(self, "Chat History Busy", "Chat history is already being saved or loaded. Try again when it finishes.")
+                return
+            # Messages are read on a background thread and shown in batches as they arrive
+            self.history_loading = True
+            self.history_batches = threading.Semaphore(2)
+            self.history_thread = QThread(self)
+            self.history_thread.run = lambda: self.load_history_thread(filename)
+            self.history_thread.start()
+
+    def load_history_thread(self, filename):
+        """Reads a chat history file in batches, emitting history_batch_loaded as they are parsed."""
+        try:
+            total = os.path.getsize(filename)
+            batch, batch_size = [], 0
+            with open(filename, 'rb') as raw:
+                for message_data in iter_chat_history(raw, filename):
+                    batch.append(message_data)
+                    batch_size += len(message_data.get('content', ''))
+                    if len(batch) >= 200 or batch_size >= 4_000_000:
+                        self.history_batches.acquire() # Stay at most two batches ahead of the chat window
+                        self.history_batch_loaded.emit(batch)
+                        self.history_progress.emit("Loading", raw.tell() if not raw.closed else total, total)
+                        batch, batch_size = [], 0
+            self.history_batches.acquire()
+            self.history_batch_loaded.emit(batch)
+            self.history_io_finished.emit("Chat history loaded successfully.", None)
+        except Exception as e:
+            self.history_io_finished.emit("", f"Error loading chat history: {e}")
+
+    def handle_history_batch_loaded(self, batch):
+        """Adds loaded messages to the conversation and the chat window."""
+        self.show_messages([
+            self.messages.append(message_data['role'], message_data['content'], message_data.get('tokens', 0), message_data.get('cost', 0.0), message_data.get('attachments'))
+            for message_data in batch
+        ])
+        self.history_batches.release()
+
+    def handle_history_progress(self, operation, done, total):
+        """Shows the progress of saving or loading chat history in the progress bar."""
+        self.progress_bar.setMaximum(max(total, 1))
+        self.progress_bar.setValue(min(done, total))
+        self.progress_bar.setFormat(f"{operation} History: %p%")
+
+    def handle_history_io_finished(self, result, error):
+        """Reports the end of saving or loading chat history."""
+        if self.history_loading:
+            self.history_loading = False
+            self.update_status_bar()
+        self.progress_bar.setValue(self.progress_bar.maximum())
+        if error:
+            self.progress_bar.setFormat("History Error")
+            self.display_message("Error", error)
+        else:
+            self.progress_bar.setFormat("History Saved" if result.startswith("Chat history saved") else "History Loaded")
+            self.display_message("System", result)
+
+    def read_chat_history(self, filename):
+        """Appends the messages of a chat history file saved by this application to the session.
+
+        Args:
+            filename (str): A chat history in JSON or JSON Lines format, .jsonl files may be .gz or .zst compressed.
+        """
+        with open(filename, 'rb') as raw:
+            for message_data in iter_chat_history(raw, filename):
+                role = message_data['role']
+                content = message_data['content']
+                tokens = message_data.get('tokens', 0) # Get tokens, default to 0 if not present in older files
+                cost = message_data.get('cost', 0.0) # Not saved by older versions
+                self.messages.append(role, content, tokens, cost, message_data.get('attachments'))
 
     def save_chat_history(self):
-        """Opens a dialog to save chat history to a file."""
+        """Opens a dialog to save chat history to a file, which is written on a background thread."""
 
         # Dialog for file type selection
-        file_formats = ["JSON (*.json)", "Text (*.txt)", "Markdown (*.md)", "CSV (*.csv)"]
-        selected_filter, ok = QInputDialog.getItem(self, "Choose File Format", "Select a file format:", file_formats, 0, False)
+        selected_filter, ok = QInputDialog.getItem(self, "Choose File Format", "Select a file format:", HISTORY_FORMATS, 0, False)
         if not ok:
             return  # User canceled the dialog
 
@@ -796,51 +3248,156 @@ class MainWindow(QMainWindow):
         file_dialog.setNameFilter(selected_filter)  # Set the selected filter
         file_dialog.setAcceptMode(QFileDialog.AcceptMode.AcceptSave)
 
-        if file_dialog.exec():
-            filename = file_dialog.selectedFiles()[0]
+        if file_dialog.exec():
+            filename = file_dialog.selectedFiles()[0]
+            extension = selected_filter[selected_filter.index('*') + 1:-1]
+            if not filename.endswith(extension):
+                filename += extension # The extension decides how the file is compressed and read back
+            if self.history_thread and self.history_thread.isRunning():
+                self.history_thread.wait() # One save or load at a time
+
+            messages = list(self.messages) # The conversation as of now, sending can continue while it is written
+            self.history_thread = QThread(self)
+            self.history_thread.run = lambda: self.save_history_thread(filename, selected_filter, messages)
+            self.history_thread.start()
+
+    def save_history_thread(self, filename, selected_filter, messages):
+        """Writes a chat history file, reporting progress with history_progress."""
+        try:
+            self.write_chat_history(filename, selected_filter, messages, progress=lambda done, total: self.history_progress.emit("Saving", done, total))
+            self.history_io_finished.emit(f"Chat history saved to {filename}", None)
+        except Exception as e:
+            self.history_io_finished.emit("", f"Failed to save chat history: {e}")
+
+    def write_chat_history(self, filename, selected_filter, messages=None, progress=None):
+        """Writes the chat history to a file, a message at a time so large bodies spilled to disk are only read one by one.
+
+        Args:
+            filename (str): The file to write.
+            selected_filter (str): The file format, one of HISTORY_FORMATS (e.g. "JSON (*.json)").
+            messages (list, optional): The messages to write, defaults to the conversation.
+            progress (callable, optional): Called with (messages written, total) as the file is written.
+        """
+        messages = list(self.messages) if messages is None else messages
+        system_instruction = {
+            "content": self.system_instructions,
+            "tokens": self.system_instruction_tokens,
+            "cost": calculate_cost(self.system_instruction_tokens, INPUT_PRICING, self.messages) # Calculate the cost of the system instructions
+        }
+
+        def written(i):
+            if progress and (i % 100 == 0 or i == len(messages)):
+                progress(i, len(messages))
+
+        with open(filename, "wb") as raw, history_stream(raw, filename, 'wb') as f:
+            match selected_filter:
+                case "JSON (*.json)":
+                    # The same document json.dump(indent=4) writes, streamed a message at a time
+                    f.write('{\n    "total_session_cost": ' + json.dumps(self.session_cost) + ',\n')
+                    f.write('    "system_instruction": ' + json.dumps(system_instruction, indent=4).replace('\n', '\n    ') + ',\n')
+                    f.write('    "chat_history": [')
+                    for i, m in enumerate(messages):
+                        f.write((',' if i else '') + '\n        ' + json.dumps(m.to_dict(), indent=4).replace('\n', '\n        '))
+                        written(i + 1)
+                    f.write('\n    ]\n}' if messages else ']\n}')
+                case "JSON Lines (*.jsonl)" | "Compressed JSON Lines (*.jsonl.gz)" | "Zstandard JSON Lines (*.jsonl.zst)":
+                    # One record per line: the session, then each message
+                    f.write(json.dumps({"type": "session", "version": VERSION, "total_session_cost": self.session_cost, "system_instruction": system_instruction}) + '\n')
+                    for i, m in enumerate(messages):
+                        f.write(json.dumps(m.to_dict()) + '\n')
+                        written(i + 1)
+                case "Text (*.txt)":
+                    f.write(f"Total session cost: ${self.session_cost:.5f}\n\n")
+                    f.write(f"0. System Instructions, {self.system_instruction_tokens} tokens - {self.system_instructions}\n") # System instructions at index 0
+                    for i, m in enumerate(messages):
+                        f.write(f"{i+1}. {m.role}, {m.tokens} tokens - {m.content}\n")
+                        written(i + 1)
+                case "Markdown (*.md)":
+                    f.write(f"# Total session cost: ${self.session_cost:.5f}\n\n")
+                    f.write("---\n")
+                    f.write(f"### 0. System Instructions, {self.system_instruction_tokens} tokens\n")
+                    f.write(f"{self.system_instructions}\n\n")
+                    f.write("---\n")
+                    f.write("# Chat History\n")
+                    for i, m in enumerate(messages):
+                        f.write(f"### {i+1}. {m.role}, {m.tokens} tokens\n")
+                        f.write(f"{m.content}\n\n")
+                        f.write("---\n")
+                        written(i + 1)
+                case "CSV (*.csv)":
+                    f.write(f'Session Cost:,{self.session_cost:.5f}\n')
+                    f.write("Role,Tokens,Content\n")
+                    f.write(f"System Instructions,{self.system_instruction_tokens},\"{self.system_instructions}\"\n") # System instructions on the first line
+                    for i, m in enumerate(messages):
+                        f.write(f"{m.role},{m.tokens},\"{m.content}\"\n")
+                        written(i + 1)
+                case _:
+                    raise ValueError("Invalid file format")
+
+    def branches_busy(self):
+        """Returns True, after telling the user, if a request or history load is changing the active branch."""
+        if self.request_in_progress or self.history_loading:
+            QMessageBox.warning(self, "Branch Busy", "Wait for the current request or history load to finish.")
+            return True
+        return False
+
+    def fork_branch(self):
+        """Starts a new branch sharing the conversation up to a chosen message, and switches to it."""
+        if self.branches_busy():
+            return
+        index, ok = QInputDialog.getInt(
+            self, "Fork Conversation", "You can view message indices with the Display Chat History tool.<br>Keep messages up to index (0 for none):",
+            len(self.messages), 0, len(self.messages), 1
+        )
+        if not ok:
+            return
+        queued = [message for branch, message in self.queued_messages.values() if branch is self.branch and message in self.messages.items[:index]]
+        if queued:
+            # The fork would share the unanswered messages, but their replies are only inserted into this branch
+            QMessageBox.warning(
+                self, "Queued Requests",
+                f"{len(queued)} of the messages up to index {index} are queued requests without replies yet. "
+                "Fork before them, or wait until they are sent."
+            )
+            return
+        name, ok = QInputDialog.getText(self, "Fork Conversation", "Branch name:", text=f"branch {len(self.branches)}")
+        name = name.strip()
+        if not ok or not name:
+            return
+        if name in self.branches:
+            QMessageBox.warning(self, "Branch Exists", f"There is already a branch named {name}.")
+            return
+        self.branches[name] = Branch(name, self.messages.fork(index), parent=self.branch.name, fork_index=index)
+        self.switch_to_branch(name)
+        self.display_message("Branch", f"Forked {name} from {self.branch.parent} after message {index}. Messages sent here don't change {self.branch.parent}.")
 
-            try:
-                with open(filename, "w") as f:
-                    match selected_filter:
-                        case "JSON (*.json)":
-                            data = {
-                                "total_session_cost": self.session_cost,
-                                "system_instruction": {
-                                    "content": self.system_instructions,
-                                    "tokens": self.system_instruction_tokens,
-                                    "cost": calculate_cost(self.system_instruction_tokens, INPUT_PRICING, self.messages) # Calculate the cost of the system instructions
-                                },
-                                "chat_history": self.messages
-                            }
-                            json.dump(data, f, indent=4)
-                        case "Text (*.txt)":
-                            f.write(f"Total session cost: ${self.session_cost:.5f}\n\n")
-                            f.write(f"0. System Instructions, {self.system_instruction_tokens} tokens - {self.system_instructions}\n") # System instructions at index 0
-                            for i, m in enumerate(self.messages):
-                                f.write(f"{i+1}. {m['role']}, {m['tokens']} tokens - {m['content']}\n")
-                        case "Markdown (*.md)":
-                            f.write(f"# Total session cost: ${self.session_cost:.5f}\n\n")
-                            f.write("---\n")
-                            f.write(f"### 0. System Instructions, {self.system_instruction_tokens} tokens\n")
-                            f.write(f"{self.system_instructions}\n\n")
-                            f.write("---\n")
-                            f.write("# Chat History\n")
-                            for i, m in enumerate(self.messages):
-                                f.write(f"### {i+1}. {m['role']}, {m['tokens']} tokens\n")
-                                f.write(f"{m['content']}\n\n")
-                                f.write("---\n")
-                        case "CSV (*.csv)":
-                            f.write(f'Session Cost:,{self.session_cost:.5f}\n')
-                            f.write("Role,Tokens,Content\n")
-                            f.write(f"System Instructions,{self.system_instruction_tokens},\"{self.system_instructions}\"\n") # System instructions on the first line
-                            for m in self.messages:
-                                f.write(f"{m['role']},{m['tokens']},\"{m['content']}\"\n") 
-                        case _:
-                            raise ValueError("Invalid file format")
+    def switch_branch(self):
+        """Asks which branch to continue."""
+        if self.branches_busy():
+            return
+        names = list(self.branches)
+        labels = [self.describe_branch(self.branches[name]) for name in names]
+        label, ok = QInputDialog.getItem(self, "Switch Branch", "Branch:", labels, names.index(self.branch.name), False)
+        if ok:
+            previous = self.branch
+            self.switch_to_branch(names[labels.index(label)])
+            queued = len(QUEUE.pending(previous.name)) if self.branch is not previous else 0
+            if queued:
+                self.display_message("Queued", f"{previous.name} has {queued} queued requests. Their replies will be added to {previous.name} when they are sent, not to this branch.")
+
+    def switch_to_branch(self, name):
+        """Makes a branch the active conversation and shows it."""
+        self.branch = self.branches[name]
+        self.messages = self.branch.messages
+        self.chat_history = self.branch.chat_history
+        self.setWindowTitle("Gemini Project Assistant" if name == "main" and len(self.branches) == 1 else f"Gemini Project Assistant - {name}")
+        self.update_chat_window()
+        self.update_status_bar()
 
-                QMessageBox.information(self, "Success", f"Chat history saved to {filename}")
-            except Exception as e:
-                QMessageBox.critical(self, "Error", f"Failed to save chat history: {str(e)}")
+    def describe_branch(self, branch):
+        """Returns a one line summary of a branch's size and cost."""
+        forked = f", forked from {branch.parent} after message {branch.fork_index}" if branch.parent else ""
+        return f"{branch.name}: {len(branch.messages)} messages, {branch.messages.total_tokens} tokens, ${branch.cost:.5f} over {branch.requests} requests{forked}"
 
     def create_menu_bar(self):
         """Creates the menu bar for the application."""
@@ -875,6 +3432,14 @@ class MainWindow(QMainWindow):
         files_action.triggered.connect(self.add_files_to_context)
         tools_menu.addAction(files_action)
 
+        map_reduce_action = QAction("Analyze Files (Map-Reduce)", self)
+        map_reduce_action.triggered.connect(self.analyze_files_map_reduce)
+        tools_menu.addAction(map_reduce_action)
+
+        git_action = QAction("Review Git Changes", self)
+        git_action.triggered.connect(self.review_git_changes)
+        tools_menu.addAction(git_action)
+
         send_docs_action = QAction("Send Docs Directory", self)
         send_docs_action.setShortcut("Ctrl+Shift+D")
         send_docs_action.triggered.connect(self.send_docs_directory)
@@ -884,6 +3449,11 @@ class MainWindow(QMainWindow):
         scrape_docs_action.setShortcut("Ctrl+Shift+S")
         scrape_docs_action.triggered.connect(self.scrape_docs_from_url)
         tools_menu.addAction(scrape_docs_action)
+
+        self.stop_scraping_action = QAction("Stop Scraping", self)
+        self.stop_scraping_action.triggered.connect(self.stop_scraping)
+        self.stop_scraping_action.setEnabled(False)
+        tools_menu.addAction(self.stop_scraping_action)
         
         history_action = QAction("Display Chat History", self)
         history_action.setShortcut("Ctrl+H")
@@ -905,11 +3475,59 @@ class MainWindow(QMainWindow):
         timeout_action.triggered.connect(self.set_timeout)
         tools_menu.addAction(timeout_action)
 
+        telemetry_action = QAction("Telemetry Dashboard", self)
+        telemetry_action.setShortcut("Ctrl+Shift+T")
+        telemetry_action.triggered.connect(lambda: TelemetryDialog(self).exec())
+        tools_menu.addAction(telemetry_action)
+
+        connection_stats_action = QAction("Connection Statistics", self)
+        connection_stats_action.triggered.connect(self.display_connection_stats)
+        tools_menu.addAction(connection_stats_action)
+
+        self.diff_mode_action = QAction("Diff-Only Replies", self)
+        self.diff_mode_action.setCheckable(True)
+        self.diff_mode_action.setChecked(self.diff_mode)
+        self.diff_mode_action.toggled.connect(lambda checked: setattr(self, 'diff_mode', checked))
+        tools_menu.addAction(self.diff_mode_action)
+
+        preview_diff_action = QAction("Preview/Apply Diff", self)
+        preview_diff_action.triggered.connect(self.preview_diff)
+        tools_menu.addAction(preview_diff_action)
+
+        clear_cache_action = QAction("Clear Response Cache", self)
+        clear_cache_action.triggered.connect(lambda: self.display_message("Cache", f"Deleted {RESPONSE_CACHE.clear()} cached responses."))
+        tools_menu.addAction(clear_cache_action)
+
+        routing_stats_action = QAction("Routing Statistics", self)
+        routing_stats_action.triggered.connect(self.display_routing_stats)
+        tools_menu.addAction(routing_stats_action)
+
+        output_policy_stats_action = QAction("Output Policy Statistics", self)
+        output_policy_stats_action.triggered.connect(self.display_output_policy_stats)
+        tools_menu.addAction(output_policy_stats_action)
+
         clear_action = QAction("Clear Chat History", self)
         clear_action.setShortcut("Ctrl+R")
         clear_action.triggered.connect(self.clear_chat_history)
         tools_menu.addAction(clear_action)
 
+        # Branches Menu
+        branches_menu = menu_bar.addMenu("Branches")
+
+        fork_action = QAction("Fork Conversation", self)
+        fork_action.setShortcut("Ctrl+B")
+        fork_action.triggered.connect(self.fork_branch)
+        branches_menu.addAction(fork_action)
+
+        switch_action = QAction("Switch Branch", self)
+        switch_action.setShortcut("Ctrl+Shift+B")
+        switch_action.triggered.connect(self.switch_branch)
+        branches_menu.addAction(switch_action)
+
+        compare_action = QAction("Compare Branches", self)
+        compare_action.triggered.connect(lambda: CompareBranchesDialog(self).exec())
+        branches_menu.addAction(compare_action)
+
         # Settings Menu
         settings_menu = menu_bar.addMenu("Settings")
 
@@ -938,7 +3556,7 @@ class MainWindow(QMainWindow):
         """Updates the chat window with the current chat history."""
         full_html = ""  # Initialize an empty string for the full HTML content
         for message in self.chat_history: 
-            full_html += message # Append each formatted message to the full_html
+            full_html += message.render() # Append each formatted message to the full_html
         self.chat_window.setHtml(full_html)  # Set the HTML content of the QTextEdit
 
         self.chat_window.verticalScrollBar().setValue(self.chat_window.verticalScrollBar().maximum()) # Scroll to the bottom of the chat window
@@ -965,7 +3583,87 @@ class MainWindow(QMainWindow):
         input_layout.addWidget(self.send_button)
 
         self.layout.addLayout(input_layout)
+
+        # Estimated size and cost of the next request, counted a moment after typing stops
+        self.cost_preview_label = QLabel(self)
+        self.cost_preview_label.setStyleSheet("color: gray;")
+        self.cost_preview_label.setAlignment(Qt.AlignmentFlag.AlignRight)
+        self.layout.addWidget(self.cost_preview_label)
+        self.cost_preview_timer = QTimer(self)
+        self.cost_preview_timer.setSingleShot(True)
+        self.cost_preview_timer.setInterval(400)
+        self.cost_preview_timer.timeout.connect(self.update_cost_preview)
+        self.input_box.textChanged.connect(self.cost_preview_timer.start)
     
+    def draft_key(self, text):
+        return hashlib.sha256(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def cached_draft_tokens(self, text):
+        """Returns the counted tokens of a draft, or None if it hasn't been counted."""
+        tokens = self.draft_token_counts.get(self.draft_key(text))
+        if tokens is not None:
+            self.draft_token_counts.move_to_end(self.draft_key(text))
+        return tokens
+
+    def update_cost_preview(self):
+        """Shows the estimated input tokens and cost of sending the draft, counting its tokens in the background if needed."""
+        if not self.model_ready:
+            return
+        typed = self.input_box.toPlainText().strip()
+        if self.output_policy:
+            _, typed = self.output_policy.parse_overrides(typed)
+        if self.router:
+            _, typed = self.router.parse_tag(typed)
+        draft = self.files_context + typed
+        tokens = self.cached_draft_tokens(draft) if draft else 0
+        if tokens is None:
+            # Show a local estimate until the count arrives, one count runs at a time
+            self.show_cost_preview(draft, estimate_tokens(draft), exact=False)
+            if self.counting_draft is None:
+                self.counting_draft = self.draft_key(draft)
+                self.count_thread = QThread(self)
+                self.count_thread.run = lambda: self.count_draft_tokens(draft)
+                self.count_thread.start()
+        else:
+            self.show_cost_preview(draft, tokens)
+
+    def count_draft_tokens(self, draft):
+        """Counts a draft's tokens like send_message does. Runs on a background thread."""
+        try:
+            with TELEMETRY.track('count_tokens', self.model_name):
+                tokens = self.model.count_tokens([{'role': 'user', 'parts': [draft]}]).total_tokens - self.system_instruction_tokens
+        except Exception as e:
+            if DEBUG:
+                print(f"Unable to count draft tokens: {e}", tag='Debug', tag_color='red')
+            tokens = -1
+        self.draft_tokens_counted.emit(self.draft_key(draft), tokens)
+
+    def handle_draft_tokens_counted(self, key, tokens):
+        """Caches a draft's token count and refreshes the preview, counting the current draft if it changed meanwhile."""
+        self.counting_draft = None
+        if tokens >= 0:
+            self.draft_token_counts[key] = tokens
+            while len(self.draft_token_counts) > 64:
+                self.draft_token_counts.popitem(last=False)
+        self.update_cost_preview()
+
+    def show_cost_preview(self, draft, tokens, exact=True):
+        """Sets the cost preview label for a draft of `tokens` tokens."""
+        model_name = self.model_name
+        if self.router:
+            model_name, _ = self.router.choose(tokens, bool(self.files_context) or '```' in draft)
+        output_cap, policy = self.max_output_tokens, ""
+        if self.output_policy:
+            overrides, typed = self.output_policy.parse_overrides(self.input_box.toPlainText().strip())
+            kind, _, output_cap, _ = self.output_policy.choose(typed, bool(self.files_context) or '```' in draft, self.max_output_tokens, self.stop_sequences, overrides)
+            policy = f" (capped at {output_cap:,} for a {kind} prompt)"
+        prompt_tokens, output_tokens, cost = self.estimate_request_cost(tokens, model_name, output_cap)
+        approximate = "" if exact else "~"
+        self.cost_preview_label.setText(
+            f"Next request: {approximate}{prompt_tokens:,} input tokens (conversation {prompt_tokens - tokens:,} + message {approximate}{tokens:,}), "
+            f"about {output_tokens:,} output tokens{policy}, {approximate}${cost:.5f} on {model_name}"
+        )
+
     def adjust_input_box_height(self):
         """Adjusts the height of the input box to fit text."""
         max_lines = 8  # Maximum number of lines to show in input box
@@ -989,6 +3687,8 @@ class MainWindow(QMainWindow):
         self.session_cost_label = QLabel("Session Cost: $0.00000", self)
         self.last_input_label = QLabel("| Last Input: 0 tokens, $0.00000", self)
         self.last_output_label = QLabel("| Last Output: 0 tokens, $0.00000", self)
+        self.last_model_label = QLabel(f"| Model: {self.model_name}", self)
+        self.spend_label = QLabel("| Today: $0.0000 | Month: $0.0000", self)
 
         # Create a progress bar
         self.progress_bar = QProgressBar(self)
@@ -999,6 +3699,8 @@ class MainWindow(QMainWindow):
         self.status_bar.addPermanentWidget(self.session_cost_label)
         self.status_bar.addPermanentWidget(self.last_input_label)
         self.status_bar.addPermanentWidget(self.last_output_label)
+        self.status_bar.addPermanentWidget(self.last_model_label)
+        self.status_bar.addPermanentWidget(self.spend_label)
         self.status_bar.addPermanentWidget(self.progress_bar) # Add the progress bar to the status bar
 
     def update_progress_bar(self):
@@ -1065,29 +3767,78 @@ class MainWindow(QMainWindow):
             )
 
     def configure_settings(self):
-        """Allows the user to configure application settings."""
+        """Allows the user to configure application settings, applying them without restarting.
+
+        The conversation is kept in self.messages and sent in full with each request, so it carries over to the
+        new model as is. The model is only recreated if the model, safety or generation settings or the system
+        instructions changed, and the system instruction tokens are only counted again if the instructions did.
+        If the new model fails to initialize, the previous one is kept with its settings.
+        """
+        if self.request_in_progress or self.model_thread.isRunning():
+            QMessageBox.information(self, "Request In Progress", "Settings can't be changed while a request is being sent or the model is initializing. Try again in a moment.")
+            return
         dialog = SettingsDialog(self) # Create an instance of the SettingsDialog
-        if dialog.exec() == QDialog.accepted: # Use exec() instead of show() to run the dialog modally
+        if dialog.exec() == QDialog.DialogCode.Accepted: # Use exec() instead of show() to run the dialog modally
+            previous = {
+                "model": self.model_name, "system instructions": self.system_instructions, "safety": self.safety_level,
+                "temperature": self.temperature, "max output tokens": self.max_output_tokens, "stop sequences": self.stop_sequences
+            }
+            model_settings = {name: getattr(self, name) for name in (
+                'model_name', 'system_instructions', 'safety_level', 'safety_settings', 'temperature', 'max_output_tokens',
+                'stop_sequences', 'generation_config', 'request_model_name'
+            )}
             self.load_config() # Reload config if settings are changed
             self.generation_config = { # Update generation_config
                 "temperature": self.temperature,
                 "max_output_tokens": self.max_output_tokens,
                 "stop_sequences": self.stop_sequences
             }
-            # Update the model with the new settings and restart the chat
-            self.initialize_model()
-            self.chat = self.model.start_chat()
-            self.display_message('System', 'Settings updated.') # Inform the user that the settings have been updated
+            current = {
+                "model": self.model_name, "system instructions": self.system_instructions, "safety": self.safety_level,
+                "temperature": self.temperature, "max output tokens": self.max_output_tokens, "stop sequences": self.stop_sequences
+            }
+            changed = [name for name in current if current[name] != previous[name]]
+            if "model" in changed:
+                if get_pricing(self.model_name)[2] is None:
+                    self.display_message("Pricing", f"No pricing is known for {self.model_name}, costs are estimated with the pricing of {PRICING_MODEL}.")
+                else:
+                    self.load_pricing()
+                    self.display_pricing()
+            if changed:
+                # Update the model with the new settings, the conversation carries over
+                if self.model is not None:
+                    self.previous_model_settings = model_settings
+                self.initialize_model()
+                self.display_message('System', f"Settings updated ({', '.join(changed)} changed). The conversation continues with the new settings.")
+            else:
+                self.update_status_bar()
+                self.display_message('System', 'Settings updated.') # Inform the user that the settings have been updated
+
+    def load_pricing(self):
+        """Sets the pricing globals to the pricing of model_name."""
+        global PRICING_DATE, PRICING_MODEL, INPUT_PRICING, OUTPUT_PRICING
+        PRICING_DATE, PRICING_MODEL, INPUT_PRICING, OUTPUT_PRICING = get_pricing(self.model_name)
+
+    def display_pricing(self):
+        """Displays the pricing of model_name in the chat window."""
+        self.display_message("Pricing", f"Pricing as of {PRICING_DATE} for {PRICING_MODEL}:")
+        self.display_message("Input", f"${INPUT_PRICING['upto_128k']} per million tokens (up to 128k tokens), ${INPUT_PRICING['over_128k']} per million tokens (over 128k tokens).")
+        self.display_message("Output", f"${OUTPUT_PRICING['upto_128k']} per million tokens (up to 128k tokens), ${OUTPUT_PRICING['over_128k']} per million tokens (over 128k tokens).")
 
     def update_status_bar(self):
         """Updates the status bar with session information."""
-        last_message_input_cost = calculate_cost(self.last_input_tokens, INPUT_PRICING, self.messages)
-        last_message_output_cost = calculate_cost(self.last_output_tokens, OUTPUT_PRICING, self.messages)
+        input_pricing, output_pricing = self.pricing_for(self.request_model_name)
+        last_message_input_cost = calculate_cost(self.last_input_tokens, input_pricing, self.messages)
+        last_message_output_cost = calculate_cost(self.last_output_tokens, output_pricing, self.messages)
         
         # Update QLabel text
         self.session_cost_label.setText(f"Session Cost: ${self.session_cost:.5f}")
         self.last_input_label.setText(f"| Last Input: {self.last_input_tokens} tokens, ${last_message_input_cost:.5f}")
         self.last_output_label.setText(f"| Last Output: {self.last_output_tokens} tokens, ${last_message_output_cost:.5f}")
+        self.last_model_label.setText(f"| Model: {self.request_model_name}")
+        spent_today, spent_month = SPEND.spent()
+        self.spend_label.setText(f"| Today: ${spent_today:.4f} | Month: ${spent_month:.4f}")
+        self.update_cost_preview() # The conversation changed
 
     def load_config(self):
         """Loads configuration settings from a JSON file."""
@@ -1109,18 +3860,46 @@ class MainWindow(QMainWindow):
                 self.temperature = config.get('temperature', self.temperature)
                 self.max_output_tokens = config.get('max_output_tokens', self.max_output_tokens)
                 self.stop_sequences = config.get('stop_sequences', self.stop_sequences)
+                self.metrics_port = config.get('metrics_port', self.metrics_port)
+                self.scrape_max_pages = config.get('scrape_max_pages', self.scrape_max_pages)
+                self.scrape_concurrency = config.get('scrape_concurrency', self.scrape_concurrency)
+                self.spill_threshold_kb = config.get('spill_threshold_kb', self.spill_threshold_kb)
+                self.spill_compression = config.get('spill_compression', self.spill_compression)
+                self.router_enabled = config.get('router_enabled', self.router_enabled)
+                self.router_fast_model = config.get('router_fast_model', self.router_fast_model)
+                self.router_strong_model = config.get('router_strong_model', self.router_strong_model)
+                self.router_fast_max_tokens = config.get('router_fast_max_tokens', self.router_fast_max_tokens)
+                self.budget_session = config.get('budget_session', self.budget_session)
+                self.budget_daily = config.get('budget_daily', self.budget_daily)
+                self.budget_monthly = config.get('budget_monthly', self.budget_monthly)
+                self.budget_action = config.get('budget_action', self.budget_action)
+                self.budget_downgrade_model = config.get('budget_downgrade_model', self.budget_downgrade_model)
+                self.confirm_cost_above = config.get('confirm_cost_above', self.confirm_cost_above)
+                self.response_cache_enabled = config.get('response_cache', self.response_cache_enabled)
+                self.response_cache_ttl_hours = config.get('response_cache_ttl_hours', self.response_cache_ttl_hours)
+                self.response_cache_max_mb = config.get('response_cache_max_mb', self.response_cache_max_mb)
+                self.code_slicing = config.get('code_slicing', self.code_slicing)
+                self.code_slicing_min_tokens = config.get('code_slicing_min_tokens', self.code_slicing_min_tokens)
+                self.offline_queue = config.get('offline_queue', self.offline_queue)
+                self.diff_mode = config.get('diff_mode', self.diff_mode)
+                self.diff_max_retries = config.get('diff_max_retries', self.diff_max_retries)
+                self.map_reduce_concurrency = config.get('map_reduce_concurrency', self.map_reduce_concurrency)
+                self.map_reduce_chunk_tokens = config.get('map_reduce_chunk_tokens', self.map_reduce_chunk_tokens)
+                self.map_reduce_map_max_tokens = config.get('map_reduce_map_max_tokens', self.map_reduce_map_max_tokens)
+                self.map_reduce_map_model = config.get('map_reduce_map_model', self.map_reduce_map_model)
+                self.git_base_ref = config.get('git_base_ref', self.git_base_ref)
+                self.git_diff_context = config.get('git_diff_context', self.git_diff_context)
+                self.git_include_untracked = config.get('git_include_untracked', self.git_include_untracked)
+                self.minify_context = config.get('minify_context', self.minify_context)
+                self.minify_strip_comments = config.get('minify_strip_comments', self.minify_strip_comments)
+                self.minify_max_blank_lines = config.get('minify_max_blank_lines', self.minify_max_blank_lines)
+                self.minify_omit_generated = config.get('minify_omit_generated', self.minify_omit_generated)
+                self.minify_skip_files = config.get('minify_skip_files', self.minify_skip_files)
+                self.output_policy_enabled = config.get('output_policy', self.output_policy_enabled)
+                self.output_policy_caps = config.get('output_policy_caps', self.output_policy_caps)
+                self.output_policy_stop_sequences = config.get('output_policy_stop_sequences', self.output_policy_stop_sequences)
                 # Set safety settings based on loaded level
-                match self.safety_level: 
-                    case "none":
-                        self.safety_settings = NO_SAFETY
-                    case "low":
-                        self.safety_settings = LOW_SAFETY
-                    case "medium":
-                        self.safety_settings = MEDIUM_SAFETY
-                    case "high":
-                        self.safety_settings = HIGH_SAFETY
-                    case _: 
-                        self.safety_settings = MEDIUM_SAFETY
+                self.safety_settings = get_safety_settings(self.safety_level)
 
         except FileNotFoundError:
             if DEBUG:
@@ -1131,51 +3910,274 @@ class MainWindow(QMainWindow):
         except Exception as e:
             self.display_message("Error", f"An error occurred loading configuration: {e}")
 
+        # Keep large message bodies on disk
+        for branch in self.branches.values():
+            branch.messages.spill_threshold = self.spill_threshold_kb * 1024
+        BLOBS.compress = self.spill_compression
+
+        RESPONSE_CACHE.ttl_hours = self.response_cache_ttl_hours
+        RESPONSE_CACHE.max_mb = self.response_cache_max_mb
+        self.diff_mode_action.setChecked(self.diff_mode)
+
+        MINIFIER.strip_comments = self.minify_strip_comments
+        MINIFIER.max_blank_lines = self.minify_max_blank_lines
+        MINIFIER.omit_generated = self.minify_omit_generated
+        MINIFIER.skip_files = self.minify_skip_files
+
+        # Route requests between the fast and strong models
+        previous_router, previous_policy = self.router, self.output_policy # Their statistics are kept when settings change
+        self.router = ModelRouter(self.router_fast_model, self.router_strong_model, self.router_fast_max_tokens) if self.router_enabled else None
+        if self.router and previous_router:
+            self.router.decisions = previous_router.decisions
+        self.request_model_name = self.model_name
+
+        # Cap the output of each request by the kind of prompt
+        self.output_policy = OutputPolicy(self.output_policy_caps, self.output_policy_stop_sequences) if self.output_policy_enabled else None
+        if self.output_policy and previous_policy:
+            for name in ('requests', 'replies', 'capped', 'output_tokens', 'reasons'):
+                setattr(self.output_policy, name, getattr(previous_policy, name))
+
     def initialize_model(self):
-        """Initializes the Gemini model with the loaded settings, 
-        handling InvalidArgument exceptions for invalid API keys.
+        """Initializes the Gemini model with the loaded settings on a background thread.
+        handle_model_initialized or handle_model_init_failed is called when it finishes.
         """
-        global API_KEY
-        try:
-            genai.configure(api_key=API_KEY) 
-
-            self.model = genai.GenerativeModel(
-                model_name=self.model_name,
-                generation_config=self.generation_config,
-                safety_settings=self.safety_settings,
-                system_instruction=self.system_instructions,
-            )
+        self.model_ready = False
+        self.send_button.setEnabled(False)
+        self.progress_bar.setFormat("Initializing Model...")
 
-            self.chat = self.model.start_chat()
+        self.model_thread = QThread(self)
+        self.model_thread.run = self.initialize_model_thread
+        self.model_thread.start()
 
-            global SI_TOKENS
-            SI_TOKENS = self.model.count_tokens(" ").total_tokens
-            self.system_instruction_tokens = SI_TOKENS
+    def initialize_model_thread(self):
+        """Imports the Gemini SDK, creates the model and counts the system instruction tokens."""
+        try:
+            if self.fake_backend:
+                model = FakeGenerativeModel(self.model_name, self.system_instructions, self.generation_config, self.safety_settings, **FAKE_BACKEND_OPTIONS)
+                UPLOADS.api = FakeFilesAPI()
+            else:
+                CLIENT_POOL.configure(API_KEY) # Keeps the existing connections unless the API key changed
+                model = CLIENT_POOL.get_model(self.model_name, self.generation_config, self.safety_settings, self.system_instructions)
+                UPLOADS.api = genai
+
+            key = (self.model_name, self.system_instructions)
+            si_tokens = self.system_instruction_counts.get(key)
+            if si_tokens is None:
+                si_tokens = model.count_tokens(" ").total_tokens # Counting a single space gives the system instruction tokens
+                self.system_instruction_counts[key] = si_tokens
+            self.model_initialized.emit(model, si_tokens)
+        except Exception as e:
+            if DEBUG:
+                traceback.print_exc()
+            self.model_init_failed.emit(e)
+
+    def handle_model_initialized(self, model, si_tokens):
+        """Puts the initialized model to use and enables sending. The conversation carries over from the previous model."""
+        global SI_TOKENS
+        self.model = model
+        self.previous_model_settings = None
+        self.routed_models.clear() # Recreated with the current settings when next routed to
+        SI_TOKENS = si_tokens
+        self.system_instruction_tokens = SI_TOKENS
+        if self.shown_system_instructions != (self.system_instructions, SI_TOKENS): # Not shown again when other settings change
             self.display_message("System Instructions", self.system_instructions)
             self.display_message("System Instructions Tokens", SI_TOKENS)
             self.display_message("System Instructions Cost", f"${calculate_cost(SI_TOKENS, INPUT_PRICING, self.messages):.5f}")
-            self.system_message_displayed = True # Resetting this here
-
-        except InvalidArgument as e:
-            if "API key not valid" in str(e):
-                reply = QMessageBox.critical(
-                    self,
-                    "Invalid API Key",
-                    "The API key you provided is invalid.\n"
-                    "Would you like to try entering a new one or quit the application?",
-                    QMessageBox.StandardButton.Retry | QMessageBox.StandardButton.Close,
-                    QMessageBox.StandardButton.Retry  # Set Retry as the default button
-                )
+            self.shown_system_instructions = (self.system_instructions, SI_TOKENS)
+        self.system_message_displayed = True # Resetting this here
+
+        self.model_ready = True
+        self.send_button.setEnabled(True)
+        self.progress_bar.setFormat("Model Ready")
+        self.draft_token_counts.clear() # Counts exclude the system instructions, which may have changed
+        self.update_status_bar() # The pricing may have changed with the model, updates the cost preview too
+
+        if 'model_ready' not in self.startup_timings:
+            self.startup_timings['model_ready'] = time.time()
+            if self.offline_queue and not self.benchmark_startup:
+                QTimer.singleShot(0, self.restore_queue) # After the window has finished starting
+            if self.benchmark_startup:
+                # Read by benchmarks/startup_benchmark.py
+                sys.stdout.write("STARTUP_TIMINGS " + json.dumps({"start": STARTUP_TIME, **self.startup_timings}) + "\n")
+                sys.stdout.flush()
+                QApplication.instance().exit(0)
+
+    def handle_model_init_failed(self, e):
+        """Handles errors from initialize_model_thread, prompting for a new key if the API key is invalid."""
+        self.progress_bar.setFormat("Model Error")
+        if isinstance(e, InvalidArgument) and "API key not valid" in str(e):
+            reply = QMessageBox.critical(
+                self,
+                "Invalid API Key",
+                "The API key you provided is invalid.\n"
+                "Would you like to try entering a new one or quit the application?",
+                QMessageBox.StandardButton.Retry | QMessageBox.StandardButton.Close,
+                QMessageBox.StandardButton.Retry  # Set Retry as the default button
+            )
 
-                if reply == QMessageBox.StandardButton.Retry:
-                    self.api_key_invalid = True
-                    self.set_api_key()  # Prompt the user to enter a new API key
-                    self.initialize_model() # Retry initializing the model after setting a new key
-                else:
-                    sys.exit()  # Close the application if the user chooses to quit
+            if reply == QMessageBox.StandardButton.Retry:
+                self.api_key_invalid = True
+                self.set_api_key()  # Prompt the user to enter a new API key
+                self.initialize_model() # Retry initializing the model after setting a new key
+            else:
+                sys.exit()  # Close the application if the user chooses to quit
+        elif self.previous_model_settings:
+            # Reconfiguring failed, the previous model still works
+            for name, value in self.previous_model_settings.items():
+                setattr(self, name, value)
+            self.previous_model_settings = None
+            self.load_pricing()
+            self.model_ready = True
+            self.send_button.setEnabled(True)
+            self.progress_bar.setFormat("Model Ready")
+            self.update_status_bar()
+            self.display_message("Error", f"An error occurred initializing the model with the new settings: {e}. Continuing with {self.model_name} and the previous settings.")
+        else:
+            self.display_message("Error", f"An error occurred initializing the model: {e}")
+            if self.benchmark_startup:
+                QApplication.instance().exit(1)
+
+    def require_model(self):
+        """Returns True if the model is ready, otherwise tells the user it is still initializing."""
+        if self.model_ready:
+            return True
+        QMessageBox.information(self, "Model Initializing", "The model is still initializing. Try again in a moment.")
+        return False
+
+    def model_for(self, model_name):
+        """Returns the model to send a request to, creating routed models with the current settings on first use.
+
+        Args:
+            model_name (str): The model chosen for the request.
+        """
+        if model_name == self.model_name:
+            return self.model
+        model = self.routed_models.get(model_name)
+        if model is None:
+            if self.fake_backend:
+                model = FakeGenerativeModel(model_name, self.system_instructions, self.generation_config, self.safety_settings, **FAKE_BACKEND_OPTIONS)
+            else:
+                model = CLIENT_POOL.get_model(model_name, self.generation_config, self.safety_settings, self.system_instructions)
+            self.routed_models[model_name] = model
+        return model
+
+    def pricing_for(self, model_name):
+        """Returns the (input, output) pricing of a model."""
+        _, _, input_pricing, output_pricing = get_pricing(model_name)
+        if input_pricing is None: # Unknown model, use the configured model's pricing
+            return INPUT_PRICING, OUTPUT_PRICING
+        return input_pricing, output_pricing
+
+    def estimate_request_cost(self, input_tokens, model_name, max_output_tokens=None):
+        """Estimates the cost of sending a new message with the conversation to a model.
+
+        The whole conversation is billed as input on every request. Output is estimated from the
+        average of recent replies, or a quarter of max_output_tokens before the first reply.
+
+        Args:
+            input_tokens (int): Tokens of the new message.
+            model_name (str): The model the request would be sent to.
+            max_output_tokens (int, optional): The output cap of the request, max_output_tokens by default.
+
+        Returns:
+            tuple: (prompt tokens, expected output tokens, cost in dollars)
+        """
+        prompt_tokens = SI_TOKENS + self.messages.total_tokens + input_tokens
+        replies = [m.tokens for m in self.messages.items[-20:] if m.role == "Model"]
+        max_output_tokens = max_output_tokens or self.max_output_tokens
+        output_tokens = min(max_output_tokens, sum(replies) // len(replies) if replies else max_output_tokens // 4)
+        input_pricing, output_pricing = self.pricing_for(model_name)
+        tier = 'upto_128k' if prompt_tokens <= 128_000 else 'over_128k'
+        return prompt_tokens, output_tokens, (prompt_tokens * input_pricing[tier] + output_tokens * output_pricing[tier]) / 1_000_000
+
+    def budget_exceeded(self, cost):
+        """Returns a description of the first spending cap a request costing `cost` would exceed, or None."""
+        spent_today, spent_month = SPEND.spent()
+        for name, spent, cap in (("session", self.session_cost, self.budget_session), ("daily", spent_today, self.budget_daily), ("monthly", spent_month, self.budget_monthly)):
+            if cap and spent + cost > cap:
+                return f"the {name} budget of ${cap:.2f} (${spent:.4f} spent)"
+        return None
+
+    def check_budget(self, input_tokens):
+        """Estimates the cost of the next request and enforces the spending caps.
+
+        A request that would exceed a cap is downgraded to budget_downgrade_model if budget_action is
+        "downgrade" and the cheaper model fits, otherwise it is blocked. Expensive requests are confirmed first.
+
+        Args:
+            input_tokens (int): Tokens of the new message.
+
+        Returns:
+            bool: True if the request should be sent to self.request_model_name.
+        """
+        prompt_tokens, output_tokens, cost = self.estimate_request_cost(input_tokens, self.request_model_name)
+        exceeded = self.budget_exceeded(cost)
+        if exceeded and self.budget_action == 'downgrade' and self.budget_downgrade_model != self.request_model_name:
+            _, _, downgraded_cost = self.estimate_request_cost(input_tokens, self.budget_downgrade_model)
+            if not self.budget_exceeded(downgraded_cost):
+                self.display_message("Budget", f"Sending to {self.budget_downgrade_model} instead of {self.request_model_name}, "
+                                     f"which would exceed {exceeded} at an estimated ${cost:.4f}.")
+                self.request_model_name, cost = self.budget_downgrade_model, downgraded_cost
+                exceeded = None
+        if exceeded:
+            QMessageBox.warning(
+                self, "Budget Exceeded",
+                f"This request would exceed {exceeded}.\n"
+                f"Estimated cost: ${cost:.4f} ({prompt_tokens} input tokens, about {output_tokens} output tokens).\n"
+                "Delete messages to make the request cheaper, or raise the budget in config.json."
+            )
+            return False
+        if self.confirm_cost_above and cost >= self.confirm_cost_above:
+            return QMessageBox.question(
+                self, "Confirm Cost",
+                f"This request to {self.request_model_name} is estimated to cost ${cost:.4f} "
+                f"({prompt_tokens} input tokens including the conversation, about {output_tokens} output tokens).\nSend it?",
+                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+            ) == QMessageBox.StandardButton.Yes
+        return True
+
+    def display_routing_stats(self):
+        """Displays how many requests were routed to each model, with their latency and cost."""
+        if not self.router:
+            self.display_message("Routing", "Model routing is off. Set router_enabled in config.json to route requests between models.")
+            return
+        summary = TELEMETRY.summary()
+        lines = []
+        for model_name in dict.fromkeys((self.router.fast_model, self.router.strong_model)):
+            reasons = ", ".join(f"{reason}: {count}" for (name, reason), count in self.router.decisions.items() if name == model_name) or "no requests"
+            stats = summary.get(('chat', model_name))
+            if stats and stats['totals']['count']:
+                totals = stats['totals']
+                median = stats['latency'].get(0.5)
+                lines.append(
+                    f"<b>{model_name}</b> ({reasons}) | {totals['count']} calls, median latency {median * 1000 if median else 0:.0f} ms, "
+                    f"cost ${totals['cost']:.5f} (${totals['cost'] / totals['count']:.5f} per call)"
+                )
             else:
-                self.display_message("Error", f"An error occurred: {e}")
-                raise e # Re-raise the exception for other InvalidArgument errors
+                lines.append(f"<b>{model_name}</b> ({reasons})")
+        self.display_message("Routing", "<br>".join(lines))
+
+    def display_output_policy_stats(self):
+        """Displays, for each kind of prompt, its output cap and how often replies were cut off at it."""
+        if not self.output_policy:
+            self.display_message("Output Policy", "The output policy is off. Set output_policy in config.json to cap the output of each request by the kind of prompt.")
+            return
+        lines = []
+        for kind in OutputPolicy.KINDS:
+            requests = self.output_policy.requests[kind]
+            cap = min(self.output_policy.caps[kind], self.max_output_tokens)
+            if not requests:
+                lines.append(f"<b>{kind}</b> (cap {cap:,}) | no requests")
+                continue
+            replies = self.output_policy.replies[kind] or 1
+            reasons = ", ".join(f"{reason}: {count}" for (k, reason), count in self.output_policy.reasons.items() if k == kind)
+            capped = self.output_policy.capped[kind]
+            lines.append(
+                f"<b>{kind}</b> (cap {cap:,}) | {requests} requests ({reasons}), {capped} cut off at the cap ({capped / replies:.0%}), "
+                f"{self.output_policy.output_tokens[kind] // replies:,} output tokens on average"
+            )
+        lines.append("A kind often cut off needs a higher cap in output_policy_caps, one never near its cap can have a lower one for faster replies.")
+        self.display_message("Output Policy", "<br>".join(lines))
 
     def display_loaded_settings(self):
         """Displays the loaded settings in the chat window."""
@@ -1192,6 +4194,8 @@ class MainWindow(QMainWindow):
 
     def clear_chat_history(self):
         """Clears the chat history for the current session."""
+        if not self.require_model():
+            return
         if (
             QMessageBox.question(
                 self,
@@ -1202,8 +4206,7 @@ class MainWindow(QMainWindow):
             == QMessageBox.StandardButton.Yes
         ):
             self.chat_history.clear()  # Clear the chat history 
-            self.messages.clear()  # Clear the messages list
-            self.chat.history.clear() # Start a fresh chat
+            self.messages.clear()  # Clear the messages list, starting a fresh chat
             self.update_chat_window()  # Update the chat window
             self.update_status_bar()  # Update the status bar
 
@@ -1235,6 +4238,112 @@ class MessageInputDialog(QDialog):
     def reject_input(self):
         self.reject()
 
+class SymbolPickerDialog(QDialog):
+    """Lists the functions, classes and methods of source files to choose which ones to send."""
+    def __init__(self, files_symbols, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Send Only Some Definitions?")
+        self.setMinimumSize(600, 500)
+
+        layout = QVBoxLayout(self)
+        label = QLabel("These files are large. Check the functions and classes your question is about to send only those, "
+                       "the code they use directly, and signatures of the rest. Send whole files to skip.", self)
+        label.setWordWrap(True)
+        layout.addWidget(label)
+
+        self.filter_edit = QLineEdit(self)
+        self.filter_edit.setPlaceholderText("Filter")
+        self.filter_edit.textChanged.connect(self.filter)
+        layout.addWidget(self.filter_edit)
+
+        self.symbol_list = QListWidget(self)
+        for file, symbols in files_symbols.items():
+            for symbol in symbols:
+                item = QListWidgetItem(f"{os.path.basename(file)}: {symbol.name} ({symbol.kind}, {symbol.end - symbol.start} lines)")
+                item.setFlags(item.flags() | Qt.ItemFlag.ItemIsUserCheckable)
+                item.setCheckState(Qt.CheckState.Unchecked)
+                item.setData(Qt.ItemDataRole.UserRole, (file, symbol.name))
+                self.symbol_list.addItem(item)
+        layout.addWidget(self.symbol_list)
+
+        button_box = QHBoxLayout()
+        send_button = QPushButton("Send Checked", self)
+        send_button.clicked.connect(self.accept)
+        button_box.addWidget(send_button)
+        whole_button = QPushButton("Send Whole Files", self)
+        whole_button.clicked.connect(self.reject)
+        button_box.addWidget(whole_button)
+        layout.addLayout(button_box)
+
+    def filter(self, text):
+        """Hides the symbols not containing the filter text."""
+        for i in range(self.symbol_list.count()):
+            item = self.symbol_list.item(i)
+            item.setHidden(text.lower() not in item.text().lower())
+
+    def selected(self):
+        """Returns the checked symbols as file path -> names."""
+        symbols = {}
+        for i in range(self.symbol_list.count()):
+            item = self.symbol_list.item(i)
+            if item.checkState() == Qt.CheckState.Checked:
+                file, name = item.data(Qt.ItemDataRole.UserRole)
+                symbols.setdefault(file, []).append(name)
+        return symbols
+
+class DiffPreviewDialog(QDialog):
+    """Shows the changes a validated diff makes to each file, and applies them."""
+    def __init__(self, results, parent):
+        super().__init__(parent)
+        import difflib
+        self.setWindowTitle("Preview Diff")
+        self.results = results
+
+        layout = QVBoxLayout(self)
+        text = QTextEdit(self)
+        text.setReadOnly(True)
+        parts = []
+        for path, (original, new) in results.items():
+            status = "new file" if original is None else "deleted" if new is None else "modified"
+            parts.append(f"<p><strong>{html.escape(path)}</strong> ({status})</p><pre>")
+            for line in difflib.unified_diff((original or '').splitlines(), (new or '').splitlines(), lineterm='', n=3):
+                color = 'lightgreen' if line.startswith('+') else 'salmon' if line.startswith('-') else 'cyan' if line.startswith('@@') else None
+                line = html.escape(line)
+                parts.append(f"<span style='color:{color};'>{line}</span>\n" if color else line + "\n")
+            parts.append("</pre>")
+        text.setHtml("".join(parts))
+        layout.addWidget(text)
+
+        button_box = QHBoxLayout()
+        apply_button = QPushButton("Apply to Files", self)
+        apply_button.clicked.connect(self.apply)
+        button_box.addWidget(apply_button)
+        close_button = QPushButton("Close", self)
+        close_button.clicked.connect(self.close)
+        close_button.setDefault(True)
+        button_box.addWidget(close_button)
+        layout.addLayout(button_box)
+        self.setMinimumSize(900, 600)
+
+    def apply(self):
+        """Writes the patched files, refusing files that changed since the diff was validated."""
+        for path, (original, _) in self.results.items():
+            current = None
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8', newline='') as f:
+                    current = f.read()
+            if current != original:
+                QMessageBox.warning(self, "File Changed", f"{path} changed since the diff was validated. Nothing was applied.")
+                return
+        try:
+            UnifiedDiff.write(self.results)
+        except OSError as e:
+            QMessageBox.warning(self, "Apply Failed", f"Couldn't write the files: {e}. Nothing was applied.")
+            return
+        self.parent().display_message("Diff", f"Applied the diff to {len(self.results)} files: {', '.join(self.results)}")
+        self.parent().last_diff = None
+        self.accept()
+
 class ViewMessageDialog(QDialog):
     def __init__(self, title, text, message, parent=None):
         super().__init__(parent)
@@ -1338,7 +4447,116 @@ class ViewHistoryDialog(QDialog):
         close_button.setDefault(True) 
         layout.addWidget(close_button) # Add the button directly to the main layout
 
-        self.setMinimumSize(800, 400) 
+        self.setMinimumSize(800, 400)
+
+class CompareBranchesDialog(QDialog):
+    """Shows two branches side by side from where they diverge, with their size and cost."""
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.setWindowTitle("Compare Branches")
+        self.branches = parent.branches
+
+        layout = QVBoxLayout(self)
+        self.shared_label = QLabel(self)
+        layout.addWidget(self.shared_label)
+
+        columns = QHBoxLayout()
+        self.sides = []
+        names = list(self.branches)
+        for default in (parent.branch.name, next((n for n in reversed(names) if n != parent.branch.name), parent.branch.name)):
+            column = QVBoxLayout()
+            combo = QComboBox(self)
+            combo.addItems(names)
+            combo.setCurrentText(default)
+            combo.currentTextChanged.connect(self.refresh)
+            summary = QLabel(self)
+            summary.setWordWrap(True)
+            text = QTextEdit(self)
+            text.setReadOnly(True)
+            column.addWidget(combo)
+            column.addWidget(summary)
+            column.addWidget(text)
+            columns.addLayout(column)
+            self.sides.append((combo, summary, text))
+        layout.addLayout(columns)
+
+        close_button = QPushButton("Close", self)
+        close_button.clicked.connect(self.close)
+        close_button.setDefault(True)
+        layout.addWidget(close_button)
+
+        self.setMinimumSize(1100, 600)
+        self.refresh()
+
+    def refresh(self):
+        """Shows the messages of each branch after their common prefix."""
+        left, right = (self.branches[combo.currentText()] for combo, _, _ in self.sides)
+        shared = left.common_prefix(right)
+        shared_tokens = sum(m.tokens for m in left.messages.items[:shared])
+        self.shared_label.setText(f"Shared: the first {shared} messages ({shared_tokens} tokens).")
+        for (_, summary, text), branch in zip(self.sides, (left, right)):
+            own = branch.messages.items[shared:]
+            summary.setText(
+                f"{len(own)} messages after the shared part ({sum(m.tokens for m in own)} tokens). "
+                f"Context: {branch.messages.total_tokens} tokens. Spent: ${branch.cost:.5f} over {branch.requests} requests."
+            )
+            text.setHtml("".join(m.render() for m in own) or "No messages after the shared part.")
+
+class TelemetryDialog(QDialog):
+    """Shows latency percentiles, throughput and cost of recent model calls."""
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Telemetry Dashboard")
+
+        layout = QVBoxLayout(self)
+
+        # Create a QTextEdit to display the metrics
+        self.metrics_text = QTextEdit(self)
+        self.metrics_text.setReadOnly(True)
+        layout.addWidget(self.metrics_text)
+
+        button_bar = QHBoxLayout()
+
+        refresh_button = QPushButton("Refresh", self)
+        refresh_button.clicked.connect(self.refresh)
+        button_bar.addWidget(refresh_button)
+
+        close_button = QPushButton("Close", self)
+        close_button.clicked.connect(self.close)
+        close_button.setDefault(True)
+        button_bar.addWidget(close_button)
+
+        layout.addLayout(button_bar)
+
+        self.setMinimumSize(900, 400)
+        self.refresh()
+
+    def refresh(self):
+        """Rebuilds the tables from TELEMETRY."""
+        summary = TELEMETRY.summary()
+        if not summary:
+            self.metrics_text.setHtml("No model calls recorded yet.")
+            return
+
+        def fmt(value, unit):
+            if value is None:
+                return "-"
+            return f"{value:.2f} tok/s" if unit == "tok/s" else f"{value * 1000:.0f} ms"
+
+        html = [f"<p>Percentiles over the last {Telemetry.WINDOW} calls of each kind. Log: {TELEMETRY.log_file}</p>"]
+        for (kind, model), s in sorted(summary.items()):
+            totals = s['totals']
+            html.append(f"<h3>{kind} - {model}</h3>")
+            html.append(
+                f"<p>Calls: {totals['count']}, errors: {totals['errors']}, retries: {totals['retries']}, "
+                f"input tokens: {totals['input_tokens']}, output tokens: {totals['output_tokens']}, cost: ${totals['cost']:.5f}</p>"
+            )
+            html.append("<table border='1' cellpadding='4' cellspacing='0'><tr><th></th><th>p50</th><th>p95</th><th>p99</th></tr>")
+            for field, label, unit in (("latency", "Latency", "s"), ("ttft", "Time to first token", "s"), ("queue_time", "Queue time", "s"), ("tokens_per_second", "Output tokens/second", "tok/s")):
+                quantiles = s[field]
+                html.append(f"<tr><td>{label}</td>" + "".join(f"<td>{fmt(quantiles.get(q), unit)}</td>" for q in Telemetry.QUANTILES) + "</tr>")
+            html.append("</table>")
+        self.metrics_text.setHtml("".join(html))
 
 class SettingsDialog(QDialog):
     def __init__(self, parent=None):
@@ -1494,33 +4712,1559 @@ class SettingsDialog(QDialog):
             else:
                 set_key(ENV_FILE, 'DEBUG', 'false')
 
-            # Get the current settings from the UI elements
-            config = {
+            # Get the current settings from the UI elements, keeping settings that are only set in config.json
+            config = read_config_file()
+            config.update({
                 'model': self.model_combo.currentText(),
                 'system_instructions': self.system_instructions_edit.toPlainText(), # Get text from QTextEdit
                 'safety': self.safety_combo.currentText().lower(),
                 'timeout': self.timeout_spin.value(),
                 'project_directory': self.project_dir_edit.text(),
-                'ignored_extensions': [x.strip() for x in self.ignored_extensions_edit.text().split(",")],
+                'ignored_extensions': [x.strip() for x in self.ignored_extensions_edit.text().split(",") if x.strip()],
                 'temperature': self.temperature_spin.value(),
                 'max_output_tokens': self.max_output_tokens_spin.value(),
-                'stop_sequences': [x.strip() for x in self.stop_sequences_edit.text().split(",")] 
-            }
+                'stop_sequences': [x.strip() for x in self.stop_sequences_edit.text().split(",") if x.strip()] # An empty stop sequence is rejected by the API
+            })
             with open(config_file, 'w') as f:
                 json.dump(config, f, indent=4)
 
-            QMessageBox.information(self, "Success", "Settings saved successfully.<br>The application may need restarted for some changes to be applied. (Model, system instructions, etc.)<br>It's recommended that you save and reload.")
+            message = "Settings saved successfully.<br>They are applied to the current conversation, no restart is needed."
+            if self.debug_checkbox.isChecked() != DEBUG:
+                message += "<br>Debug mode changes when the application is restarted."
+            QMessageBox.information(self, "Success", message)
+            return True
 
         except Exception as e:
             QMessageBox.critical(self, "Error", f"An error occurred while saving the settings: {e}")
+            return False
 
     def accept(self):
-        """Save settings when the dialog is accepted."""
-        self.save_settings()
-        super().accept()
+        """Save settings when the dialog is accepted, staying open if they couldn't be saved."""
+        if self.save_settings():
+            super().accept()
+
+class MarkdownRenderer:
+    """Renders Markdown model replies to the HTML subset QTextEdit supports, caching the HTML per content hash.
+
+    Code blocks are syntax highlighted with Pygments when it is installed, and shown as plain preformatted text otherwise.
+    render() is thread safe, replies are rendered on the request thread so the GUI thread only reads the cache.
+    """
+    CODE_STYLE = 'monokai' # Pygments style for code blocks, drawn on CODE_BACKGROUND
+    CODE_BACKGROUND = '#272822'
+    CODE_FOREGROUND = '#f8f8f2'
+
+    FENCE = re.compile(r'^ {0,3}(`{3,}|~{3,})\s*([\w+#.-]*)')
+    HEADING = re.compile(r'^ {0,3}(#{1,6})\s+(.*?)(?:\s+#+)?\s*$')
+    RULE = re.compile(r'^ {0,3}([-*_])(?:\s*\1){2,}\s*$')
+    QUOTE = re.compile(r'^ {0,3}>\s?(.*)$')
+    LIST_ITEM = re.compile(r'^( *)([-*+]|\d{1,9}[.)])\s+(.*)$')
+    INLINE_CODE = re.compile(r'(`+)(.+?)\1')
+    LINK = re.compile(r'\[([^\]]+)\]\(((?:https?://|mailto:)[^)\s"]+)\)')
+    BOLD = re.compile(r'(\*\*|__)(?=\S)(.+?)(?<=\S)\1')
+    ITALIC = re.compile(r'(?<![\w*])\*(?=\S)(.+?)(?<=\S)\*(?![\w*])|(?<![\w])_(?=[^\s_])(.+?)(?<=[^\s_])_(?!\w)')
+    STRIKE = re.compile(r'~~(?=\S)(.+?)(?<=\S)~~')
+    PLACEHOLDER = re.compile(r'\x00(\d+)\x00')
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.cache = collections.OrderedDict() # content hash -> HTML, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.pygments_style = None # Loaded on the first code block, False if Pygments isn't installed
+        self.lexers = {} # language -> Pygments lexer, None for unknown languages
+        self.token_styles = {} # Pygments token type -> inline CSS
+
+    def render(self, text):
+        """Returns the HTML for a Markdown text, from the cache when it was rendered before.
+
+        Args:
+            text (str): The Markdown text.
+
+        Returns:
+            str: The HTML.
+        """
+        key = hashlib.sha256(text.encode('utf-8', 'surrogatepass')).hexdigest()
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+            self.misses += 1
+        rendered = self.render_blocks(text.splitlines())
+        with self.lock:
+            self.cache[key] = rendered
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return rendered
+
+    def clear(self):
+        """Empties the cache."""
+        with self.lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def render_blocks(self, lines):
+        """Renders a list of Markdown lines to HTML blocks."""
+        blocks = []
+        paragraph = []
+        i = 0
+
+        def end_paragraph():
+            if paragraph:
+                blocks.append(f"<p style='margin: 0px 0px 6px 0px;'>{'<br>'.join(self.render_inline(l.strip()) for l in paragraph)}</p>")
+                paragraph.clear()
+
+        while i < len(lines):
+            line = lines[i]
+            if fence := self.FENCE.match(line):
+                end_paragraph()
+                marker, language = fence.group(1), fence.group(2)
+                code = []
+                i += 1
+                while i < len(lines) and not (lines[i].strip().startswith(marker) and lines[i].strip().strip(marker[0]) == ''):
+                    code.append(lines[i])
+                    i += 1
+                blocks.append(self.render_code('\n'.join(code), language))
+                i += 1 # Skip the closing fence, unclosed blocks run to the end of the message
+                continue
+
+            if not line.strip():
+                end_paragraph()
+            elif heading := self.HEADING.match(line):
+                end_paragraph()
+                level = len(heading.group(1))
+                blocks.append(f"<h{level}>{self.render_inline(heading.group(2))}</h{level}>")
+            elif self.RULE.match(line):
+                end_paragraph()
+                blocks.append("<hr>")
+            elif self.QUOTE.match(line):
+                end_paragraph()
+                quoted = []
+                while i < len(lines) and (quote := self.QUOTE.match(lines[i])):
+                    quoted.append(quote.group(1))
+                    i += 1
+                blocks.append(f"<blockquote style='color: gray;'>{self.render_blocks(quoted)}</blockquote>")
+                continue
+            elif self.LIST_ITEM.match(line):
+                end_paragraph()
+                items = []
+                while i < len(lines) and lines[i].strip() and not any(pattern.match(lines[i]) for pattern in (self.FENCE, self.HEADING, self.QUOTE, self.RULE)):
+                    if item := self.LIST_ITEM.match(lines[i]):
+                        items.append([len(item.group(1)), item.group(2)[-1] in '.)', [item.group(3)]])
+                    else:
+                        items[-1][2].append(lines[i].strip()) # Continuation of the previous item
+                    i += 1
+                blocks.append(self.render_list(items))
+                continue
+            else:
+                paragraph.append(line)
+            i += 1
+
+        end_paragraph()
+        return ''.join(blocks)
+
+    def render_list(self, items):
+        """Renders [indent, ordered, lines] list items, nesting items by indentation."""
+        html_parts = []
+        open_lists = [] # (indent, tag) of the lists being built, innermost last
+        for indent, ordered, item_lines in items:
+            while open_lists and indent < open_lists[-1][0]:
+                html_parts.append(f"</li></{open_lists.pop()[1]}>")
+            tag = 'ol' if ordered else 'ul'
+            if open_lists and indent == open_lists[-1][0] and tag != open_lists[-1][1]:
+                html_parts.append(f"</li></{open_lists.pop()[1]}>") # Switching between bullets and numbers starts a new list
+            if not open_lists or indent > open_lists[-1][0]:
+                html_parts.append(f"<{tag} style='margin: 0px;'>")
+                open_lists.append((indent, tag))
+            else:
+                html_parts.append("</li>")
+            html_parts.append("<li>" + '<br>'.join(self.render_inline(l) for l in item_lines))
+        while open_lists:
+            html_parts.append(f"</li></{open_lists.pop()[1]}>")
+        return ''.join(html_parts)
+
+    def render_inline(self, text):
+        """Renders inline Markdown (code spans, links, bold, italic and strikethrough) in escaped text."""
+        code_spans = []
+        def stash_code(match):
+            code_spans.append(f"<code style='background-color: {self.CODE_BACKGROUND}; color: {self.CODE_FOREGROUND};'>{html.escape(match.group(2).strip(), quote=False)}</code>")
+            return f"\x00{len(code_spans) - 1}\x00"
+
+        text = self.INLINE_CODE.sub(stash_code, text.replace('\x00', '')) # Code spans are taken out so emphasis inside them isn't rendered
+        text = html.escape(text, quote=False)
+        text = self.LINK.sub(r'<a href="\2">\1</a>', text)
+        text = self.BOLD.sub(r'<strong>\2</strong>', text)
+        text = self.ITALIC.sub(lambda m: f"<em>{m.group(1) or m.group(2)}</em>", text)
+        text = self.STRIKE.sub(r'<s>\1</s>', text)
+        return self.PLACEHOLDER.sub(lambda m: code_spans[int(m.group(1))], text)
+
+    def render_code(self, code, language):
+        """Renders a fenced code block, highlighted when Pygments is installed and knows the language."""
+        lexer = self.get_lexer(language)
+        highlighted = self.highlight(code, lexer) if lexer else html.escape(code, quote=False)
+        return f"<pre style='background-color: {self.CODE_BACKGROUND}; color: {self.CODE_FOREGROUND}; white-space: pre-wrap;'>{highlighted}</pre>"
+
+    def highlight(self, code, lexer):
+        """Returns the code as HTML colored spans, one span per run of tokens sharing a style."""
+        html_parts = []
+        run = []
+        run_css = ''
+        for token_type, value in lexer.get_tokens(code):
+            css = run_css if value.isspace() else self.token_css(token_type) # Whitespace joins the current run
+            if css != run_css:
+                text = html.escape(''.join(run), quote=False)
+                html_parts.append(f"<span style='{run_css}'>{text}</span>" if run_css else text)
+                run.clear()
+                run_css = css
+            run.append(value)
+        text = html.escape(''.join(run), quote=False)
+        html_parts.append(f"<span style='{run_css}'>{text}</span>" if run_css else text)
+        return ''.join(html_parts)
+
+    def token_css(self, token_type):
+        """Returns the inline CSS for a Pygments token type, empty for the default code color."""
+        if token_type not in self.token_styles:
+            style = self.pygments_style.style_for_token(token_type)
+            css = []
+            if style['color'] and f"#{style['color']}".lower() != self.CODE_FOREGROUND:
+                css.append(f"color: #{style['color']}")
+            if style['bold']:
+                css.append("font-weight: bold")
+            if style['italic']:
+                css.append("font-style: italic")
+            self.token_styles[token_type] = '; '.join(css)
+        return self.token_styles[token_type]
+
+    def get_lexer(self, language):
+        """Returns a cached Pygments lexer for a fenced code block language, None if it can't be highlighted."""
+        if not language or not self.load_pygments():
+            return None
+        language = language.lower()
+        if language not in self.lexers:
+            from pygments.lexers import get_lexer_by_name
+            from pygments.util import ClassNotFound
+            try:
+                self.lexers[language] = get_lexer_by_name(language, stripnl=False, ensurenl=False)
+            except ClassNotFound:
+                self.lexers[language] = None
+        return self.lexers[language]
+
+    def load_pygments(self):
+        """Imports Pygments on first use, returns False if it isn't installed."""
+        if self.pygments_style is None:
+            try:
+                from pygments.styles import get_style_by_name
+                self.pygments_style = get_style_by_name(self.CODE_STYLE)
+            except ImportError:
+                self.pygments_style = False
+                if DEBUG:
+                    print("Pygments is not installed, code blocks won't be highlighted.", tag='Debug', tag_color='cyan', color='white')
+        return self.pygments_style is not False
+
+RENDERER = MarkdownRenderer()
+
+class PageTextParser(HTMLParser):
+    """Extracts the readable text, title and links of an HTML page."""
+    SKIP_TAGS = {'script', 'style', 'noscript', 'svg', 'head', 'template', 'iframe', 'button', 'form'}
+    BLOCK_TAGS = {
+        'p', 'div', 'section', 'article', 'main', 'header', 'footer', 'nav', 'aside', 'li', 'ul', 'ol', 'dl', 'dt', 'dd',
+        'table', 'tr', 'pre', 'blockquote', 'figure', 'figcaption', 'br', 'hr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'
+    }
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.links = []
+        self.title = ''
+        self.base = None # <base href>, links are relative to it
+        self.skip_depth = 0
+        self.pre_depth = 0
+        self.in_title = False
+        self.at_line_start = True
+
+    def newline(self):
+        if not self.at_line_start:
+            self.parts.append('\n')
+            self.at_line_start = True
+
+    def write(self, text):
+        if not self.pre_depth:
+            text = re.sub(r'\s+', ' ', text) # Collapse whitespace outside <pre> like a browser
+            if self.at_line_start:
+                text = text.lstrip()
+        if text:
+            self.parts.append(text)
+            self.at_line_start = text.endswith('\n')
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'title':
+            self.in_title = True
+        elif tag == 'base' and attrs.get('href') and self.base is None:
+            self.base = attrs['href']
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+            return
+        if self.skip_depth:
+            return
+        if tag == 'a' and attrs.get('href'):
+            self.links.append(attrs['href'])
+        if tag in self.BLOCK_TAGS:
+            self.newline()
+        if tag == 'li':
+            self.write('- ')
+        elif tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
+            self.write('#' * int(tag[1]) + ' ')
+        if tag == 'pre':
+            self.pre_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self.in_title = False
+        if tag in self.SKIP_TAGS:
+            self.skip_depth = max(self.skip_depth - 1, 0)
+            return
+        if self.skip_depth:
+            return
+        if tag == 'pre':
+            self.pre_depth = max(self.pre_depth - 1, 0)
+        if tag in self.BLOCK_TAGS:
+            self.newline()
+        elif tag in ('td', 'th'):
+            self.write(' | ')
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title += data
+        elif not self.skip_depth:
+            self.write(data)
+
+    def text(self):
+        """Returns the page text with trailing spaces and runs of blank lines removed."""
+        lines = [line.rstrip() for line in ''.join(self.parts).split('\n')]
+        return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+class DocCrawler:
+    """Crawls the pages under a documentation URL into .txt files for Send Docs Directory.
+
+    Only pages on the start URL's host and under its path are followed, and robots.txt is respected.
+    Pages are fetched concurrently over pooled connections, at most per_host_concurrency at a time per host.
+    The crawl frontier is saved to a state file in the output directory, so an interrupted crawl can be resumed.
+
+    A finished crawl can be refreshed: pages are requested conditionally with their saved ETag and Last-Modified validators,
+    and only pages whose text hash changed are rewritten. Every finished crawl appends the added, updated and removed
+    files to changelog.jsonl in the output directory.
+
+    The crawler doesn't depend on Qt, run it with asyncio.run(crawler.run()).
+    """
+    USER_AGENT = f"GeminiProjectAssistant/{VERSION} (documentation scraper)"
+    PAGE_TYPES = ('text/html', 'application/xhtml+xml', 'text/plain')
+    SKIP_EXTENSIONS = (
+        '.png', '.jpg', '.jpeg', '.gif', '.svg', '.ico', '.webp', '.bmp', '.pdf', '.zip', '.gz', '.tgz', '.tar', '.whl', '.exe',
+        '.dmg', '.mp3', '.mp4', '.webm', '.woff', '.woff2', '.ttf', '.eot', '.css', '.js', '.map', '.json', '.xml'
+    )
+    MAX_PAGE_BYTES = 5_000_000 # Larger pages are truncated
+    SAVE_INTERVAL = 2.0 # Seconds between saves of the crawl state
+
+    def __init__(self, start_url, output_dir, concurrency=8, per_host_concurrency=4, max_pages=1000, timeout=30, progress=None):
+        self.start_url = self.normalize(start_url, start_url)
+        self.output_dir = output_dir
+        self.concurrency = concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.max_pages = max_pages # Per run, a resumed crawl can fetch max_pages more
+        self.timeout = timeout
+        self.progress = progress # Called with a dict of counters after every page
+        self.state_file = os.path.join(output_dir, f".crawl_{hashlib.sha256(self.start_url.encode()).hexdigest()[:12]}.json")
+
+        start = urllib.parse.urlsplit(self.start_url)
+        self.origin = (start.scheme, start.netloc)
+        self.scope_path = start.path if start.path.endswith('/') else start.path.rsplit('/', 1)[0] + '/' # Pages under the start page's directory
+
+        self.queue = collections.deque() # URLs waiting to be fetched
+        self.active = set() # URLs being fetched
+        self.seen = set() # URLs queued, fetched or skipped
+        self.pages = {} # URL -> {"file" (relative to output_dir), "hash", "etag", "last_modified", "links"}
+        self.previous = {} # The pages of the crawl being refreshed
+        self.changes = {"added": [], "updated": [], "removed": [], "unchanged": 0}
+        self.failed = {} # URL -> error
+        self.fetched = 0
+        self.bytes = 0
+        self.stopped = False
+        self.session = None
+        self.robots = {} # host -> RobotFileParser
+        self.host_limits = {} # host -> asyncio.Semaphore
+        self.last_saved = 0.0
+
+    def normalize(self, url, base):
+        """Returns url resolved against base without its fragment, or None if it isn't an http(s) URL."""
+        url = urllib.parse.urljoin(base, url.strip())
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.netloc:
+            return None
+        return urllib.parse.urlunsplit((parts.scheme, parts.netloc.lower(), parts.path or '/', parts.query, ''))
+
+    def in_scope(self, url):
+        """Returns True if url is on the start URL's origin, under its path, and likely a page."""
+        parts = urllib.parse.urlsplit(url)
+        if (parts.scheme, parts.netloc) != self.origin or not (parts.path + '/').startswith(self.scope_path):
+            return False
+        return not parts.path.lower().endswith(self.SKIP_EXTENSIONS)
+
+    def file_for(self, url):
+        """Returns the .txt file for a page, relative to output_dir, mirroring the URL path."""
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path.strip('/')
+        path = path + '/index' if parts.path.endswith('/') and path else path or 'index'
+        path = re.sub(r'[^\w./-]', '_', path)
+        path = '/'.join(segment.lstrip('.') or '_' for segment in path.split('/')) # No hidden files or parent directories
+        if path.endswith(('.html', '.htm')):
+            path = path.rsplit('.', 1)[0]
+        if parts.query:
+            path += '_' + hashlib.sha256(parts.query.encode()).hexdigest()[:8]
+        return os.path.join(*path.split('/')) + '.txt'
+
+    def saved_state(self):
+        """Returns the saved state of the last crawl of this URL, or None."""
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def has_saved_state(self):
+        """Returns True if an unfinished crawl of this URL can be resumed."""
+        state = self.saved_state()
+        return state is not None and not state.get('finished', False)
+
+    def load_state(self, refresh=False):
+        """Loads the saved crawl, either to resume it or, with refresh, as the pages to compare a new crawl with."""
+        state = self.saved_state()
+        if refresh:
+            self.previous = state['pages']
+            return
+        self.queue.extend(state['pending'])
+        self.seen = set(state['seen'])
+        self.pages = state['pages']
+        self.previous = state.get('previous', {})
+        self.changes = state.get('changes', self.changes)
+        self.failed = state['failed']
+        self.fetched = state['fetched']
+        self.bytes = state['bytes']
+
+    def save_state(self, finished=False):
+        """Writes the crawl frontier and results to the state file."""
+        state = {
+            "start_url": self.start_url,
+            "finished": finished,
+            "pending": list(self.active) + list(self.queue), # Pages being fetched are fetched again on resume
+            "seen": sorted(self.seen),
+            "pages": self.pages,
+            "previous": {} if finished else self.previous, # Kept until a refresh finishes
+            "changes": self.changes,
+            "failed": self.failed,
+            "fetched": self.fetched,
+            "bytes": self.bytes,
+        }
+        temp_file = self.state_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_file, self.state_file)
+        self.last_saved = time.monotonic()
+
+    def stop(self):
+        """Stops the crawl after the pages being fetched, saving the state so it can be resumed."""
+        self.stopped = True
+
+    def report(self, url=None):
+        if self.progress:
+            self.progress({
+                "fetched": self.fetched, "queued": len(self.queue) + len(self.active), "bytes": self.bytes, "failed": len(self.failed),
+                "unchanged": self.changes["unchanged"], "url": url
+            })
+
+    def enqueue(self, url):
+        if url and url not in self.seen and self.in_scope(url):
+            self.seen.add(url)
+            self.queue.append(url)
+
+    async def run(self, resume=False, refresh=False):
+        """Crawls until every page in scope is fetched, max_pages is reached or stop() is called.
+
+        Args:
+            resume (bool): Continue the crawl saved in the state file instead of starting over.
+            refresh (bool): Crawl again, only downloading and rewriting the pages that changed since the saved crawl.
+
+        Returns:
+            dict: The crawl summary with the output directory, counters, changes, and whether it finished.
+        """
+        import requests # Only needed when scraping
+        from requests.adapters import HTTPAdapter
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        if resume and self.has_saved_state():
+            self.load_state()
+        else:
+            if refresh and self.saved_state():
+                self.load_state(refresh=True)
+            self.enqueue(self.start_url)
+        page_limit = self.fetched + self.max_pages
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = self.USER_AGENT
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.concurrency) # Keep-alive connections shared by all workers
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='scraper')
+        try:
+            await self.load_robots(self.start_url)
+            self.report()
+            await asyncio.gather(*(self.worker(page_limit) for _ in range(self.concurrency)))
+            finished = not self.stopped and not self.queue and not self.active
+            if finished:
+                self.remove_missing_pages()
+                self.write_changelog()
+            self.save_state(finished)
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.session.close()
+
+        return {
+            "url": self.start_url, "output_dir": self.output_dir, "finished": finished, "stopped": self.stopped,
+            "pages": len(self.pages), "fetched": self.fetched, "failed": len(self.failed), "bytes": self.bytes, "queued": len(self.queue),
+            "errors": dict(list(self.failed.items())[:5]), # A sample of the failures
+            "refresh": bool(self.previous), "changes": self.changes,
+        }
+
+    def remove_missing_pages(self):
+        """Deletes the files of refreshed pages that are no longer linked or no longer exist."""
+        current_files = {page['file'] for page in self.pages.values()}
+        for url, page in self.previous.items():
+            if url not in self.pages and page['file'] not in current_files:
+                try:
+                    os.remove(os.path.join(self.output_dir, page['file']))
+                except FileNotFoundError:
+                    pass
+                self.changes["removed"].append(page['file'])
+                current_files.add(page['file']) # Pages sharing a file are only removed once
+
+    def write_changelog(self):
+        """Appends the changes of the finished crawl to changelog.jsonl."""
+        entry = {"date": time.strftime('%Y-%m-%dT%H:%M:%S'), "url": self.start_url, "refresh": bool(self.previous), **self.changes}
+        with open(os.path.join(self.output_dir, 'changelog.jsonl'), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + "\n")
+
+    async def worker(self, page_limit):
+        """Fetches pages from the queue until the crawl is done or page_limit pages were fetched."""
+        while not self.stopped and self.fetched + len(self.active) < page_limit: # Pages being fetched count, so the limit isn't exceeded
+            if not self.queue:
+                if not self.active:
+                    return # Nothing queued and nothing being fetched that could queue more
+                await asyncio.sleep(0.05)
+                continue
+            url = self.queue.popleft()
+            self.active.add(url)
+            try:
+                await self.crawl_page(url)
+            finally:
+                self.active.discard(url)
+            if time.monotonic() - self.last_saved > self.SAVE_INTERVAL:
+                self.save_state()
+            self.report(url)
+
+    async def crawl_page(self, url):
+        """Fetches a page, saves its text if it changed and queues its links."""
+        host = urllib.parse.urlsplit(url).netloc
+        robots = self.robots.get(host)
+        if robots and not robots.can_fetch(self.USER_AGENT, url):
+            return
+        delay = robots.crawl_delay(self.USER_AGENT) if robots else None
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(1 if delay else self.per_host_concurrency) # A crawl delay means one request at a time
+        previous = self.previous.get(url)
+        async with self.host_limits[host]:
+            try:
+                response = await asyncio.get_running_loop().run_in_executor(self.executor, self.fetch, url, previous)
+            except Exception as e:
+                self.failed[url] = str(e)
+                status = getattr(getattr(e, 'response', None), 'status_code', None)
+                if previous and status not in (404, 410): # Keep the saved page until it can be fetched again
+                    self.pages[url] = previous
+                    for link in previous['links']:
+                        self.enqueue(link)
+                return
+            finally:
+                if delay:
+                    await asyncio.sleep(float(delay))
+
+        self.fetched += 1
+        if response['status'] == 304 and previous: # Not modified, reuse the saved page and its links
+            self.pages[url] = previous
+            self.changes["unchanged"] += 1
+            for link in previous['links']:
+                self.enqueue(link)
+            return
+
+        body = response['body']
+        self.bytes += len(body or '')
+        final_url = self.normalize(response['url'], url)
+        if body is None or not self.in_scope(final_url): # Not a page, or redirected out of scope
+            return
+        self.seen.add(final_url)
+
+        if response['content_type'] == 'text/plain':
+            title, text, links, base = '', body, [], final_url
+        else:
+            parser = PageTextParser()
+            parser.feed(body)
+            parser.close()
+            title, text, links, base = parser.title.strip(), parser.text(), parser.links, urllib.parse.urljoin(final_url, parser.base or '')
+        links = [link for link in (self.normalize(link, base) for link in links) if link and self.in_scope(link)]
+        for link in links:
+            self.enqueue(link)
+
+        relative_path = self.file_for(final_url)
+        page_text = f"Source: {final_url}\n" + (f"Title: {title}\n" if title else "") + "\n" + text + "\n"
+        digest = hashlib.sha256(page_text.encode('utf-8')).hexdigest()
+        old = self.previous.get(final_url)
+        path = os.path.join(self.output_dir, relative_path)
+        if old and old['hash'] == digest and old['file'] == relative_path and os.path.exists(path):
+            self.changes["unchanged"] += 1 # Served again, but the text is the same
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(page_text)
+            change = self.changes["updated" if old else "added"]
+            if relative_path not in change: # Aliases of a page, like docs/ and docs/index.html, share its file
+                change.append(relative_path)
+        self.pages[final_url] = {
+            "file": relative_path, "hash": digest, "etag": response['etag'], "last_modified": response['last_modified'], "links": list(dict.fromkeys(links))
+        }
+
+    def fetch(self, url, previous=None):
+        """Downloads a page on an executor thread, conditionally if the previous crawl saved validators for it.
+
+        Returns:
+            dict: The final URL, status, content type, etag, last_modified, and body text (None if it isn't a page or wasn't modified).
+        """
+        headers = {}
+        if previous and previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous and previous.get('last_modified'):
+            headers['If-Modified-Since'] = previous['last_modified']
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            result = {
+                "url": response.url, "status": response.status_code, "content_type": content_type,
+                "etag": response.headers.get('ETag'), "last_modified": response.headers.get('Last-Modified'), "body": None
+            }
+            if response.status_code == 304 or content_type not in self.PAGE_TYPES:
+                return result
+            data = bytearray()
+            for chunk in response.iter_content(65536):
+                data += chunk
+                if len(data) >= self.MAX_PAGE_BYTES:
+                    break
+            # Charset from the header, then from <meta charset>, then UTF-8
+            charset = re.search(r'charset=["\']?([\w-]+)', response.headers.get('Content-Type', ''), re.IGNORECASE)
+            charset = charset or re.search(rb'<meta[^>]+charset=["\']?([\w-]+)', bytes(data[:4096]), re.IGNORECASE)
+            charset = charset.group(1) if charset else 'utf-8'
+            charset = charset.decode('ascii') if isinstance(charset, bytes) else charset
+            try:
+                result["body"] = data.decode(charset, errors='replace')
+            except LookupError: # Unknown charset
+                result["body"] = data.decode('utf-8', errors='replace')
+            return result
+
+    async def load_robots(self, url):
+        """Fetches and parses robots.txt for the URL's host."""
+        import urllib.robotparser # Imports urllib.request, which is slow to import at startup
+        parts = urllib.parse.urlsplit(url)
+        robots = urllib.robotparser.RobotFileParser()
+        def fetch_robots():
+            return self.session.get(f"{parts.scheme}://{parts.netloc}/robots.txt", timeout=self.timeout)
+        try:
+            response = await asyncio.get_running_loop().run_in_executor(self.executor, fetch_robots)
+            if response.status_code in (401, 403):
+                robots.disallow_all = True
+            elif response.status_code >= 400:
+                robots.allow_all = True
+            else:
+                robots.parse(response.text.splitlines())
+        except Exception:
+            robots.allow_all = True # Unreachable robots.txt, crawl the site
+        self.robots[parts.netloc] = robots
+
+class PooledClient:
+    """Stands in for a GenerativeModel's client, forwarding to the shared client from GeminiClientPool.
+    Async clients are created on first use inside the running event loop, since gRPC asyncio channels are bound to a loop.
+    """
+    def __init__(self, pool, is_async):
+        self._pool = pool
+        self._is_async = is_async
+
+    def __getattr__(self, name):
+        attr = getattr(self._pool.get_client(self._is_async), name)
+        if callable(attr) and not name.startswith('_'):
+            self._pool.count_request()
+        return attr
+
+class GeminiClientPool:
+    """Long-lived Gemini API clients shared by the chat, token counting and any concurrent sessions.
+
+    genai.configure() drops every client the SDK has created, so it is only called when the API key changes.
+    The generative service clients use gRPC channels with keep-alive pings, which keeps idle connections open
+    between messages, and models are cached per configuration so switching settings back and forth reuses them.
+    """
+    KEEPALIVE_OPTIONS = [
+        ("grpc.keepalive_time_ms", 30_000), # Ping the server after 30 seconds without activity
+        ("grpc.keepalive_timeout_ms", 10_000), # Consider the connection dead if a ping isn't answered in 10 seconds
+        ("grpc.keepalive_permit_without_calls", 1), # Keep pinging while no request is in flight
+        ("grpc.http2.max_pings_without_data", 0), # Don't limit pings between requests
+    ]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.api_key = None
+        self.sync_client = None
+        self.async_clients = {} # Event loop -> async client
+        self.models = {}
+        self.stats = {
+            "configures": 0, # genai.configure calls, each one tears down the existing clients
+            "configures_skipped": 0, # Reconfigurations that reused the existing clients
+            "channels_created": 0,
+            "requests": 0,
+            "models_created": 0,
+            "models_reused": 0,
+        }
+
+    def configure(self, api_key):
+        """Configures the SDK for an API key, keeping the existing clients if the key hasn't changed."""
+        load_genai()
+        with self.lock:
+            if api_key == self.api_key:
+                self.stats["configures_skipped"] += 1
+                return
+            genai.configure(api_key=api_key)
+            self.api_key = api_key
+            self.sync_client = None
+            self.async_clients = {}
+            self.models = {}
+            self.stats["configures"] += 1
+
+    def get_model(self, model_name, generation_config, safety_settings, system_instruction):
+        """Returns a GenerativeModel for the settings that uses the shared clients."""
+        key = json.dumps([model_name, generation_config, safety_settings, system_instruction], sort_keys=True)
+        with self.lock:
+            model = self.models.get(key)
+            if model is not None:
+                self.stats["models_reused"] += 1
+                return model
+            model = genai.GenerativeModel(
+                model_name=model_name,
+                generation_config=generation_config,
+                safety_settings=safety_settings,
+                system_instruction=system_instruction,
+            )
+            model._client = PooledClient(self, is_async=False)
+            model._async_client = PooledClient(self, is_async=True)
+            self.models[key] = model
+            self.stats["models_created"] += 1
+            return model
+
+    def get_client(self, is_async):
+        """Returns the shared sync client, or the async client for the running event loop, creating it on first use."""
+        from google.ai import generativelanguage as glm
+        from google.api_core import gapic_v1
+        from google.generativeai.client import USER_AGENT
+
+        with self.lock:
+            if not is_async:
+                if self.sync_client is None:
+                    from google.ai.generativelanguage_v1beta.services.generative_service.transports.grpc import GenerativeServiceGrpcTransport
+                    self.sync_client = glm.GenerativeServiceClient(
+                        client_options={"api_key": self.api_key},
+                        client_info=gapic_v1.client_info.ClientInfo(user_agent=f"{USER_AGENT}/{genai.__version__}"),
+                        transport=lambda **kwargs: GenerativeServiceGrpcTransport(channel=self.keepalive_channel(GenerativeServiceGrpcTransport.create_channel), **kwargs),
+                    )
+                return self.sync_client
+
+            loop = asyncio.get_running_loop()
+            client = self.async_clients.get(loop)
+            if client is None:
+                from google.ai.generativelanguage_v1beta.services.generative_service.transports.grpc_asyncio import GenerativeServiceGrpcAsyncIOTransport
+                client = glm.GenerativeServiceAsyncClient(
+                    client_options={"api_key": self.api_key},
+                    client_info=gapic_v1.client_info.ClientInfo(user_agent=f"{USER_AGENT}/{genai.__version__}"),
+                    transport=lambda **kwargs: GenerativeServiceGrpcAsyncIOTransport(channel=self.keepalive_channel(GenerativeServiceGrpcAsyncIOTransport.create_channel), **kwargs),
+                )
+                self.async_clients[loop] = client
+            return client
+
+    def keepalive_channel(self, create_channel):
+        """Wraps a transport's create_channel to add the keep-alive options."""
+        def create(host, options=(), **kwargs):
+            self.stats["channels_created"] += 1
+            return create_channel(host, options=list(options) + self.KEEPALIVE_OPTIONS, **kwargs)
+        return create
+
+    def count_request(self):
+        with self.lock:
+            self.stats["requests"] += 1
+
+    def snapshot_stats(self):
+        """Returns the connection statistics, including requests served per channel."""
+        with self.lock:
+            stats = dict(self.stats)
+        stats["requests_per_channel"] = stats["requests"] / max(stats["channels_created"], 1)
+        return stats
+
+CLIENT_POOL = GeminiClientPool()
+
+class Telemetry:
+    """Records latency, throughput and cost of every model call.
+
+    The most recent calls of each kind are kept in memory for percentiles, and every call is appended
+    to logs/telemetry.jsonl. Thread-safe, calls are recorded from the request threads.
+    """
+    WINDOW = 1000 # Calls of each kind kept for percentiles
+    QUANTILES = (0.5, 0.95, 0.99)
+    FIELDS = ("latency", "ttft", "queue_time", "tokens_per_second") # Fields with percentiles
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.lock = threading.Lock()
+        self.windows = {} # (kind, model) -> deque of records
+        self.totals = {} # (kind, model) -> running totals since startup
+
+    def record(self, kind, model, latency, queue_time=0.0, ttft=None, input_tokens=0, output_tokens=0, retries=0, cost=0.0, error=None):
+        """Records one model call.
+
+        Args:
+            kind (str): The type of call, e.g. "chat" or "count_tokens".
+            model (str): The model name.
+            latency (float): Seconds from sending the request to receiving the full response.
+            queue_time (float): Seconds the request waited before being sent.
+            ttft (float): Seconds until the first token arrived. Defaults to latency for calls that aren't streamed.
+            input_tokens (int): Prompt tokens.
+            output_tokens (int): Response tokens.
+            retries (int): Times the request was retried.
+            cost (float): Cost of the call in dollars.
+            error (str): The error, if the call failed.
+        """
+        record = {
+            "time": time.time(),
+            "kind": kind,
+            "model": model,
+            "latency": latency,
+            "queue_time": queue_time,
+            "ttft": latency if ttft is None else ttft,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "tokens_per_second": output_tokens / latency if output_tokens and latency > 0 else None,
+            "retries": retries,
+            "cost": cost,
+            "error": error,
+        }
+        key = (kind, model)
+        with self.lock:
+            self.windows.setdefault(key, collections.deque(maxlen=self.WINDOW)).append(record)
+            totals = self.totals.setdefault(key, {"count": 0, "errors": 0, "retries": 0, "latency": 0.0, "ttft": 0.0, "queue_time": 0.0, "input_tokens": 0, "output_tokens": 0, "cost": 0.0})
+            totals["count"] += 1
+            totals["errors"] += error is not None
+            for field in ("retries", "latency", "ttft", "queue_time", "input_tokens", "output_tokens", "cost"):
+                totals[field] += record[field]
+            try:
+                os.makedirs(os.path.dirname(self.log_file), exist_ok=True)
+                with open(self.log_file, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            except OSError as e:
+                if DEBUG:
+                    print(f"Unable to write telemetry log: {e}", tag='Debug', tag_color='red')
+
+    def track(self, kind, model, **fields):
+        """Context manager timing a call, for calls where only latency (and optionally fields set on the yielded dict) matters."""
+        return TelemetryTimer(self, kind, model, fields)
+
+    @staticmethod
+    def quantile(values, q):
+        """Nearest-rank quantile of a sorted list."""
+        return values[min(len(values) - 1, max(0, int(round(q * len(values) + 0.5)) - 1))]
+
+    def summary(self):
+        """Returns {(kind, model): {"totals": {...}, "<field>": {0.5: p50, 0.95: p95, 0.99: p99}}} over the rolling window."""
+        with self.lock:
+            windows = {key: list(records) for key, records in self.windows.items()}
+            totals = {key: dict(t) for key, t in self.totals.items()}
+        summary = {}
+        for key, records in windows.items():
+            summary[key] = {"totals": totals[key], "window": len(records)}
+            for field in self.FIELDS:
+                values = sorted(r[field] for r in records if r[field] is not None and r["error"] is None)
+                summary[key][field] = {q: self.quantile(values, q) for q in self.QUANTILES} if values else {}
+        return summary
+
+    def render_prometheus(self, extra_gauges=None):
+        """Renders the metrics in the Prometheus text exposition format.
+
+        Args:
+            extra_gauges (dict): Additional {name: value} gauges to include.
+        """
+        lines = []
+        summary = self.summary()
+
+        def labels(kind, model, **extra):
+            pairs = {"kind": kind, "model": model, **extra}
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs.items()) + "}"
+
+        for field, help_text in (("latency", "Seconds from request to full response"), ("ttft", "Seconds to the first token"), ("queue_time", "Seconds waiting before the request was sent"), ("tokens_per_second", "Output tokens per second")):
+            name = f"gpa_request_{field}" + ("" if field == "tokens_per_second" else "_seconds")
+            lines.append(f"# HELP {name} {help_text} (quantiles over the last {self.WINDOW} requests).")
+            lines.append(f"# TYPE {name} summary")
+            for (kind, model), s in summary.items():
+                for q, value in s[field].items():
+                    lines.append(f"{name}{labels(kind, model, quantile=q)} {value}")
+                if field != "tokens_per_second":
+                    lines.append(f"{name}_sum{labels(kind, model)} {s['totals'][field]}")
+                    lines.append(f"{name}_count{labels(kind, model)} {s['totals']['count']}")
+
+        for field, help_text in (("count", "Model calls"), ("errors", "Failed model calls"), ("retries", "Retried model calls"), ("input_tokens", "Input tokens"), ("output_tokens", "Output tokens"), ("cost", "Cost in dollars")):
+            name = "gpa_requests_total" if field == "count" else f"gpa_{field}_total"
+            lines.append(f"# HELP {name} {help_text}.")
+            lines.append(f"# TYPE {name} counter")
+            for (kind, model), s in summary.items():
+                lines.append(f"{name}{labels(kind, model)} {s['totals'][field]}")
+
+        for name, value in (extra_gauges or {}).items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+class TelemetryTimer:
+    """Times the body of a `with` block and records it, along with any fields set on the yielded dict."""
+    def __init__(self, telemetry, kind, model, fields):
+        self.telemetry = telemetry
+        self.kind = kind
+        self.model = model
+        self.fields = fields
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self.fields
+
+    def __exit__(self, exc_type, exc, tb):
+        self.telemetry.record(self.kind, self.model, time.perf_counter() - self.started, error=None if exc is None else str(exc), **self.fields)
+        return False
+
+TELEMETRY = Telemetry(os.path.join(SCRIPT_DIR, 'logs', 'telemetry.jsonl'))
+
+class MetricsServer:
+    """Serves TELEMETRY in the Prometheus text format on http://127.0.0.1:<port>/metrics from a daemon thread."""
+    def __init__(self, port):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = TELEMETRY.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # Don't log every scrape
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+def estimate_tokens(text):
+    """Estimates a token count locally (roughly 4 characters per token) without calling the API.
+
+    Args:
+        text (str): The text to estimate.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return max(1, len(text) // 4) if text else 0
+
+def contents_text(contents):
+    """Flattens the text out of anything the Gemini SDK accepts as contents (str, part dicts, message dicts, lists, protos).
+
+    Args:
+        contents: The contents to flatten.
+
+    Returns:
+        str: All text parts joined with newlines.
+    """
+    if contents is None:
+        return ''
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, dict):
+        if 'parts' in contents:
+            return contents_text(contents['parts'])
+        return contents.get('text', '')
+    if isinstance(contents, (list, tuple)):
+        return '\n'.join(text for text in (contents_text(c) for c in contents) if text)
+    if hasattr(contents, 'parts'): # protos.Content
+        return contents_text(list(contents.parts))
+    return getattr(contents, 'text', '')
+
+# Options passed to every FakeGenerativeModel, see its docstring. Set from the --fake-* arguments or by benchmarks
+FAKE_BACKEND_OPTIONS = {}
+
+class FakeUsageMetadata:
+    """Mimics the usage_metadata of a Gemini response."""
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+class FakeCandidate:
+    """Mimics a response candidate, finish_reason 1 is STOP and 2 is MAX_TOKENS."""
+    def __init__(self, text, finish_reason=1):
+        self.content = {'role': 'model', 'parts': [{'text': text}]}
+        self.finish_reason = finish_reason
+
+class FakeResponse:
+    """Mimics a GenerateContentResponse, iterating it asynchronously yields the streamed chunks."""
+    def __init__(self, text, prompt_tokens, chunks=None, chunk_delay=0.0, finish_reason=1):
+        self.text = text
+        self.usage_metadata = FakeUsageMetadata(prompt_tokens, estimate_tokens(text))
+        self.candidates = [FakeCandidate(text, finish_reason)]
+        self._chunks = chunks if chunks is not None else [text]
+        self._chunk_delay = chunk_delay
+
+    async def __aiter__(self):
+        for i, chunk in enumerate(self._chunks):
+            if i and self._chunk_delay:
+                await asyncio.sleep(self._chunk_delay)
+            yield FakeResponse(chunk, 0, [])
+
+class FakeCountTokensResponse:
+    def __init__(self, total_tokens):
+        self.total_tokens = total_tokens
+
+class FakeGenerativeModel:
+    """A deterministic local stand-in for genai.GenerativeModel, used to run the app without the Gemini API.
+    Replies echo the last user message and token counts are estimated locally.
+
+    Args:
+        latency (float): Seconds before a response (or its first streamed chunk) arrives.
+        count_latency (float): Seconds each count_tokens call takes.
+        output_tokens (int): Pads replies to this many tokens. Replies are only the echo if None.
+        chunk_size (int): Characters per streamed chunk.
+        chunk_rate (float): Streamed chunks per second after the first, unlimited if None.
+        error_rate (float): Fraction of requests that fail, chosen by a random generator seeded with `seed`.
+        error (str): "timeout" to fail with DeadlineExceeded, "offline" with ConnectionError, anything else fails with RuntimeError.
+        seed (int): Seed for the error injection, so runs are repeatable.
+    """
+    def __init__(self, model_name='fake-gemini', system_instruction=None, generation_config=None, safety_settings=None,
+                 latency=0.0, count_latency=0.0, output_tokens=None, chunk_size=16, chunk_rate=None, error_rate=0.0, error='error', seed=0):
+        self.model_name = model_name
+        self._system_instruction = system_instruction or ''
+        self._generation_config = generation_config or {}
+        self._safety_settings = safety_settings
+        self.latency = latency
+        self.count_latency = count_latency
+        self.output_tokens = output_tokens
+        self.chunk_size = chunk_size
+        self.chunk_rate = chunk_rate
+        self.error_rate = error_rate
+        self.error = error
+        self.random = random.Random(seed)
+
+    def count_tokens(self, contents, **kwargs):
+        if self.count_latency:
+            time.sleep(self.count_latency)
+        # Like the real API, counts include the system instructions
+        return FakeCountTokensResponse(estimate_tokens(self._system_instruction) + estimate_tokens(contents_text(contents)) + self.attachment_tokens(contents))
+
+    async def count_tokens_async(self, contents, **kwargs):
+        if self.count_latency:
+            await asyncio.sleep(self.count_latency)
+        return FakeCountTokensResponse(estimate_tokens(self._system_instruction) + estimate_tokens(contents_text(contents)) + self.attachment_tokens(contents))
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+    @staticmethod
+    def attachment_tokens(contents):
+        """Counts attached files like the API counts an image, 258 tokens each."""
+        return 258 * json.dumps(contents, default=str).count('"file_uri"')
+
+    def make_reply(self, contents):
+        """Builds the reply text for the given contents."""
+        messages = contents if isinstance(contents, list) else [contents]
+        text = f"Echo: {contents_text(messages[-1])}"
+        if self.output_tokens:
+            text = (text + " " + "lorem ipsum " * self.output_tokens)[:self.output_tokens * 4] # estimate_tokens counts 4 characters per token
+        return text
+
+    async def generate_content_async(self, contents, stream=False, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            if self.error == 'timeout':
+                raise DeadlineExceeded("Injected timeout from the fake backend")
+            if self.error == 'offline':
+                raise ConnectionError("Injected connection error from the fake backend")
+            raise RuntimeError("Injected error from the fake backend")
+        text = self.make_reply(contents)
+        # Like the API, stop at the first stop sequence or cut the reply off at max_output_tokens
+        generation_config = kwargs.get('generation_config') or self._generation_config
+        finish_reason = 1
+        for stop in generation_config.get('stop_sequences') or []:
+            if stop and stop in text:
+                text = text[:text.index(stop)]
+        max_output_tokens = generation_config.get('max_output_tokens')
+        if max_output_tokens and estimate_tokens(text) > max_output_tokens:
+            text, finish_reason = text[:max_output_tokens * 4], 2
+        prompt_tokens = estimate_tokens(self._system_instruction) + estimate_tokens(contents_text(contents)) + self.attachment_tokens(contents)
+        chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)] if stream else None
+        return FakeResponse(text, prompt_tokens, chunks, 1 / self.chunk_rate if self.chunk_rate else 0.0, finish_reason)
+
+class FakeFilesAPI:
+    """A local stand-in for the Files API functions of genai (upload_file, get_file), used with the fake backend.
+    Files are "uploaded" by hashing them, and expire after 48 hours like real uploads.
+    """
+    def __init__(self):
+        self.files = {}
+
+    def upload_file(self, path, mime_type=None, display_name=None):
+        name = f"files/{UploadCache.file_hash(path)[:16]}"
+        self.files[name] = types.SimpleNamespace(
+            name=name, uri=f"https://fake-gemini.invalid/v1beta/{name}", mime_type=mime_type, display_name=display_name,
+            state=types.SimpleNamespace(name='ACTIVE'), expiration_time=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=48)
+        )
+        return self.files[name]
+
+    def get_file(self, name):
+        return self.files[name]
+
+class FakeChatSession:
+    """A stand-in for genai.ChatSession backed by a FakeGenerativeModel."""
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    async def send_message_async(self, content, stream=False, **kwargs):
+        message = content if isinstance(content, dict) else {'role': 'user', 'parts': [{'text': contents_text(content)}]}
+        response = await self.model.generate_content_async(self.history + [message], stream=stream)
+        self.history.append(message)
+        self.history.append({'role': 'model', 'parts': [{'text': response.text}]})
+        return response
+
+class ServerSession:
+    """A chat session belonging to one API client."""
+    def __init__(self, session_id, chat):
+        self.session_id = session_id
+        self.chat = chat
+        self.messages = MessageStore() # Used for cost calculation, the chat session keeps the API history
+        self.cost = 0.0
+        self.lock = asyncio.Lock() # Turns in one session must not interleave
+        self.last_used = time.time()
+
+class AssistantServer:
+    """Serves the configured model over a local HTTP API (Gemini-style and OpenAI-compatible endpoints).
+
+    Requests are queued to a pool of asyncio workers that share one model, and therefore one set of
+    upstream connections. Client connections are kept alive between requests.
+    """
+    SESSION_TTL = 3600 # Seconds before an idle session is dropped
+
+    def __init__(self, host='127.0.0.1', port=8765, workers=4, fake_backend=False):
+        self.host = host
+        self.port = port
+        self.worker_count = workers
+        self.fake_backend = fake_backend
+        self.sessions = {}
+        self.metrics = {
+            "requests_total": 0,
+            "errors_total": 0,
+            "connections_total": 0,
+            "connection_reuses_total": 0,
+            "streams_total": 0,
+            "input_tokens_total": 0,
+            "output_tokens_total": 0,
+            "cost_total": 0.0,
+            "latency_seconds_total": 0.0,
+            "queue_seconds_total": 0.0,
+            "requests_by_endpoint": {},
+        }
+
+        # Load the same settings the GUI uses
+        config = read_config_file()
+        self.model_name = config.get('model', 'gemini-1.5-pro-latest')
+        self.system_instructions = config.get('system_instructions', DEFAULT_SYSTEM_INSTRUCTIONS)
+        self.safety_settings = get_safety_settings(config.get('safety', 'medium'))
+        self.timeout = config.get('timeout', 60)
+        self.generation_config = {
+            "temperature": config.get('temperature', 1.0),
+            "max_output_tokens": config.get('max_output_tokens', 8192),
+            "stop_sequences": config.get('stop_sequences', [])
+        }
+
+    def initialize_model(self):
+        """Creates the shared model and counts the system instruction tokens."""
+        global SI_TOKENS, PRICING_DATE, PRICING_MODEL, INPUT_PRICING, OUTPUT_PRICING
+        PRICING_DATE, PRICING_MODEL, INPUT_PRICING, OUTPUT_PRICING = get_pricing(self.model_name)
+        if INPUT_PRICING is None: # Unknown model, fall back to the most expensive pricing
+            PRICING_DATE, PRICING_MODEL, INPUT_PRICING, OUTPUT_PRICING = get_pricing('gemini-1.5-pro-latest')
+
+        if self.fake_backend:
+            self.model = FakeGenerativeModel(self.model_name, self.system_instructions, self.generation_config, self.safety_settings, **FAKE_BACKEND_OPTIONS)
+        else:
+            CLIENT_POOL.configure(API_KEY)
+            self.model = CLIENT_POOL.get_model(self.model_name, self.generation_config, self.safety_settings, self.system_instructions)
+        SI_TOKENS = self.model.count_tokens(" ").total_tokens
+
+    def run(self):
+        """Runs the server until interrupted."""
+        self.initialize_model()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    async def serve(self):
+        """Starts the worker pool and the HTTP listener."""
+        self.queue = asyncio.Queue()
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.worker_count)]
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1] # Resolve port 0 to the real port
+        print(f"Serving {self.model_name} on http://{self.host}:{self.port} with {self.worker_count} workers", tag='Server', tag_color='green', color='white')
+        async with server:
+            await server.serve_forever()
+
+    async def worker(self):
+        """Executes queued jobs, one at a time per worker. Jobs are called with the seconds they spent queued."""
+        while True:
+            job, future, queued_at = await self.queue.get()
+            queue_time = time.perf_counter() - queued_at
+            self.metrics["queue_seconds_total"] += queue_time
+            try:
+                if not future.cancelled():
+                    future.set_result(await job(queue_time))
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, job):
+        """Queues a coroutine function taking the queue time for the worker pool and returns a future for its result."""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((job, future, time.perf_counter()))
+        return future
+
+    async def handle_connection(self, reader, writer):
+        """Reads HTTP/1.1 requests from one client connection until it is closed."""
+        self.metrics["connections_total"] += 1
+        served = 0
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                body = await reader.readexactly(length) if length else b''
+
+                if served:
+                    self.metrics["connection_reuses_total"] += 1
+                served += 1
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                keep_alive = await self.dispatch(method, path.split('?')[0], headers, body, writer) and keep_alive
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass # Client went away or sent garbage, drop the connection
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, headers, body, writer):
+        """Routes a request. Returns False if the connection can't be reused."""
+        started = time.perf_counter()
+        self.metrics["requests_total"] += 1
+        endpoint = f"{method} {path}"
+        self.metrics["requests_by_endpoint"][endpoint] = self.metrics["requests_by_endpoint"].get(endpoint, 0) + 1
+        try:
+            payload = json.loads(body) if body else {}
+            if not isinstance(payload, dict):
+                self.metrics["errors_total"] += 1
+                await self.send_json(writer, 400, {"error": "Request body must be a JSON object"})
+                return True
+            match (method, path):
+                case ('GET', '/health'):
+                    await self.send_json(writer, 200, {"status": "ok", "model": self.model_name})
+                case ('GET', '/metrics'):
+                    await self.send_text(writer, 200, self.render_prometheus(), 'text/plain; version=0.0.4')
+                case ('GET', '/v1/metrics'):
+                    await self.send_json(writer, 200, self.snapshot_metrics())
+                case ('GET', '/v1/models'):
+                    await self.send_json(writer, 200, {"object": "list", "data": [{"id": self.model_name, "object": "model", "owned_by": "google"}]})
+                case ('POST', '/v1/count_tokens'):
+                    await self.handle_count_tokens(payload, writer)
+                case ('POST', '/v1/chat'):
+                    return await self.handle_chat(payload, headers, writer)
+                case ('POST', '/v1/chat/completions'):
+                    return await self.handle_chat_completions(payload, writer)
+                case ('DELETE', _) if path.startswith('/v1/sessions/'):
+                    removed = self.sessions.pop(path.rsplit('/', 1)[-1], None)
+                    await self.send_json(writer, 200 if removed else 404, {"deleted": removed is not None})
+                case _:
+                    await self.send_json(writer, 404, {"error": f"Unknown endpoint: {endpoint}"})
+            return True
+        except json.JSONDecodeError:
+            self.metrics["errors_total"] += 1
+            await self.send_json(writer, 400, {"error": "Request body is not valid JSON"})
+            return True
+        except Exception as e:
+            self.metrics["errors_total"] += 1
+            if DEBUG:
+                traceback.print_exc()
+            await self.send_json(writer, 504 if type(e).__name__ == 'DeadlineExceeded' else 500, {"error": str(e)})
+            return True
+        finally:
+            self.metrics["latency_seconds_total"] += time.perf_counter() - started
+
+    async def send_json(self, writer, status, payload):
+        """Writes a JSON response that keeps the connection open."""
+        await self.send_text(writer, status, json.dumps(payload), 'application/json')
+
+    async def send_text(self, writer, status, text, content_type):
+        """Writes a response that keeps the connection open."""
+        body = text.encode()
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    async def start_event_stream(self, writer):
+        """Writes the headers of a server-sent events response. The stream ends by closing the connection."""
+        self.metrics["streams_total"] += 1
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+
+    async def send_event(self, writer, data):
+        writer.write(f"data: {data if isinstance(data, str) else json.dumps(data)}\n\n".encode())
+        await writer.drain()
+
+    def get_session(self, session_id):
+        """Returns the client's session, creating it if needed, and drops sessions that have been idle too long."""
+        now = time.time()
+        for expired in [sid for sid, s in self.sessions.items() if now - s.last_used > self.SESSION_TTL]:
+            del self.sessions[expired]
+        if not session_id or session_id not in self.sessions:
+            session_id = session_id or uuid.uuid4().hex
+            self.sessions[session_id] = ServerSession(session_id, self.model.start_chat())
+        session = self.sessions[session_id]
+        session.last_used = now
+        return session
+
+    def record_usage(self, session, message, response, latency, queue_time, ttft=None):
+        """Adds a completed turn to the session, the server totals and TELEMETRY, returning the usage summary."""
+        input_tokens = response.usage_metadata.prompt_token_count
+        output_tokens = response.usage_metadata.candidates_token_count
+        user_message = session.messages.append("User", message, max(input_tokens - SI_TOKENS, 0))
+        model_message = session.messages.append("Model", response.text, output_tokens)
+        user_message.cost = calculate_cost(input_tokens, INPUT_PRICING, session.messages)
+        model_message.cost = calculate_cost(output_tokens, OUTPUT_PRICING, session.messages)
+        cost = user_message.cost + model_message.cost
+        session.cost += cost
+        self.metrics["input_tokens_total"] += input_tokens
+        self.metrics["output_tokens_total"] += output_tokens
+        self.metrics["cost_total"] += cost
+        TELEMETRY.record('server_chat', self.model_name, latency, queue_time=queue_time, ttft=ttft, input_tokens=input_tokens, output_tokens=output_tokens, cost=cost)
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens, "cost": cost, "session_cost": session.cost}
+
+    async def handle_count_tokens(self, payload, writer):
+        contents = payload.get('contents', payload.get('text', ''))
+        async def job(queue_time):
+            with TELEMETRY.track('server_count_tokens', self.model_name, queue_time=queue_time):
+                return await self.model.count_tokens_async(contents)
+        response = await self.submit(job)
+        await self.send_json(writer, 200, {"total_tokens": response.total_tokens, "system_instruction_tokens": SI_TOKENS})
+
+    async def handle_chat(self, payload, headers, writer):
+        """Sends a message in a per-client session. Body: {"message": str, "session": str, "stream": bool}."""
+        message = payload.get('message', '')
+        if not message:
+            await self.send_json(writer, 400, {"error": "'message' is required"})
+            return True
+        session = self.get_session(payload.get('session') or headers.get('x-session-id'))
+        request_options = {'timeout': self.timeout}
+
+        if not payload.get('stream'):
+            async def job(queue_time):
+                async with session.lock:
+                    started = time.perf_counter()
+                    try:
+                        response = await session.chat.send_message_async(message, request_options=request_options, generation_config=self.generation_config, safety_settings=self.safety_settings)
+                    except Exception as e:
+                        TELEMETRY.record('server_chat', self.model_name, time.perf_counter() - started, queue_time=queue_time, error=str(e))
+                        raise
+                    return response, self.record_usage(session, message, response, time.perf_counter() - started, queue_time)
+            response, usage = await self.submit(job)
+            await self.send_json(writer, 200, {"session": session.session_id, "model": self.model_name, "text": response.text, "usage": usage})
+            return True
+
+        chunks = asyncio.Queue()
+        async def stream_job(queue_time):
+            async with session.lock:
+                started = time.perf_counter()
+                ttft = None
+                try:
+                    response = await session.chat.send_message_async(message, stream=True, request_options=request_options, generation_config=self.generation_config, safety_settings=self.safety_settings)
+                    async for chunk in response:
+                        ttft = ttft or time.perf_counter() - started
+                        await chunks.put({"session": session.session_id, "text": chunk.text})
+                except Exception as e:
+                    TELEMETRY.record('server_chat', self.model_name, time.perf_counter() - started, queue_time=queue_time, ttft=ttft, error=str(e))
+                    raise
+                return self.record_usage(session, message, response, time.perf_counter() - started, queue_time, ttft)
+        await self.stream_job(stream_job, chunks, writer, lambda usage: {"session": session.session_id, "done": True, "usage": usage})
+        return False
+
+    async def handle_chat_completions(self, payload, writer):
+        """OpenAI-compatible chat completions. Stateless, the history comes from the request; the configured system instructions are used."""
+        history = []
+        for m in payload.get('messages', []):
+            if m.get('role') in ('user', 'assistant'):
+                history.append({'role': 'model' if m['role'] == 'assistant' else 'user', 'parts': [{'text': m.get('content', '')}]})
+        if not history or history[-1]['role'] != 'user':
+            await self.send_json(writer, 400, {"error": "The last message must have the 'user' role"})
+            return True
+        message = history.pop()['parts'][0]['text']
+        session = ServerSession(f"chatcmpl-{uuid.uuid4().hex}", self.model.start_chat(history=history))
+        created = int(time.time())
+        request_options = {'timeout': self.timeout}
+
+        if not payload.get('stream'):
+            async def job(queue_time):
+                started = time.perf_counter()
+                try:
+                    response = await session.chat.send_message_async(message, request_options=request_options, generation_config=self.generation_config, safety_settings=self.safety_settings)
+                except Exception as e:
+                    TELEMETRY.record('server_chat', self.model_name, time.perf_counter() - started, queue_time=queue_time, error=str(e))
+                    raise
+                return response, self.record_usage(session, message, response, time.perf_counter() - started, queue_time)
+            response, usage = await self.submit(job)
+            await self.send_json(writer, 200, {
+                "id": session.session_id, "object": "chat.completion", "created": created, "model": self.model_name,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": response.text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": usage["input_tokens"], "completion_tokens": usage["output_tokens"], "total_tokens": usage["input_tokens"] + usage["output_tokens"]}
+            })
+            return True
+
+        chunks = asyncio.Queue()
+        def completion_chunk(delta, finish_reason=None):
+            return {"id": session.session_id, "object": "chat.completion.chunk", "created": created, "model": self.model_name,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        async def stream_job(queue_time):
+            started = time.perf_counter()
+            ttft = None
+            try:
+                response = await session.chat.send_message_async(message, stream=True, request_options=request_options, generation_config=self.generation_config, safety_settings=self.safety_settings)
+                async for chunk in response:
+                    ttft = ttft or time.perf_counter() - started
+                    await chunks.put(completion_chunk({"content": chunk.text}))
+            except Exception as e:
+                TELEMETRY.record('server_chat', self.model_name, time.perf_counter() - started, queue_time=queue_time, ttft=ttft, error=str(e))
+                raise
+            return self.record_usage(session, message, response, time.perf_counter() - started, queue_time, ttft)
+        await self.stream_job(stream_job, chunks, writer, lambda usage: completion_chunk({}, "stop"), done_marker="[DONE]")
+        return False
+
+    async def stream_job(self, job, chunks, writer, final_event, done_marker=None):
+        """Runs a streaming job on the worker pool, forwarding its chunks to the client as server-sent events."""
+        await self.start_event_stream(writer)
+        future = self.submit(job)
+        while True:
+            getter = asyncio.ensure_future(chunks.get())
+            done, _ = await asyncio.wait({getter, future}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                await self.send_event(writer, getter.result())
+                continue
+            getter.cancel()
+            while not chunks.empty(): # Flush chunks queued right before the job finished
+                await self.send_event(writer, chunks.get_nowait())
+            break
+        try:
+            await self.send_event(writer, final_event(future.result()))
+        except Exception as e:
+            self.metrics["errors_total"] += 1
+            await self.send_event(writer, {"error": str(e)})
+        if done_marker:
+            await self.send_event(writer, done_marker)
+
+    def snapshot_metrics(self):
+        """Returns the request metrics with derived averages."""
+        metrics = dict(self.metrics)
+        requests = max(metrics["requests_total"], 1)
+        metrics["average_latency_seconds"] = metrics["latency_seconds_total"] / requests
+        metrics["average_queue_seconds"] = metrics["queue_seconds_total"] / requests
+        metrics["active_sessions"] = len(self.sessions)
+        metrics["queue_depth"] = self.queue.qsize()
+        if not self.fake_backend:
+            metrics["upstream"] = CLIENT_POOL.snapshot_stats()
+        return metrics
+
+    def render_prometheus(self):
+        """Renders TELEMETRY plus the server's connection and session gauges in the Prometheus format."""
+        gauges = {
+            "gpa_server_connections_total": self.metrics["connections_total"],
+            "gpa_server_connection_reuses_total": self.metrics["connection_reuses_total"],
+            "gpa_server_requests_total": self.metrics["requests_total"],
+            "gpa_server_errors_total": self.metrics["errors_total"],
+            "gpa_server_active_sessions": len(self.sessions),
+            "gpa_server_queue_depth": self.queue.qsize(),
+        }
+        if not self.fake_backend:
+            stats = CLIENT_POOL.snapshot_stats()
+            gauges["gpa_upstream_channels_total"] = stats["channels_created"]
+            gauges["gpa_upstream_requests_total"] = stats["requests"]
+        return TELEMETRY.render_prometheus(gauges)
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error', 504: 'Gateway Timeout'}
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
-    window = MainWindow()
+    parser = argparse.ArgumentParser(description="Gemini Project Assistant")
+    parser.add_argument('--server', action='store_true', help="Serve the configured model over a local HTTP API instead of opening the GUI")
+    parser.add_argument('--host', default='127.0.0.1', help="Server mode: address to listen on")
+    parser.add_argument('--port', type=int, default=8765, help="Server mode: port to listen on")
+    parser.add_argument('--workers', type=int, default=4, help="Server mode: number of concurrent model requests")
+    parser.add_argument('--fake-backend', action='store_true', help="Use a local fake model instead of the Gemini API (for testing)")
+    parser.add_argument('--fake-latency', type=float, default=0.0, help="Fake backend: seconds before each response")
+    parser.add_argument('--fake-error-rate', type=float, default=0.0, help="Fake backend: fraction of requests that fail")
+    parser.add_argument('--fake-error', choices=['error', 'timeout', 'offline'], default='error', help="Fake backend: how failing requests fail")
+    parser.add_argument('--benchmark-startup', action='store_true', help=argparse.SUPPRESS) # Used by benchmarks/startup_benchmark.py
+    args, qt_args = parser.parse_known_args()
+    FAKE_BACKEND_OPTIONS.update(latency=args.fake_latency, error_rate=args.fake_error_rate, error=args.fake_error)
+
+    if args.server:
+        AssistantServer(args.host, args.port, args.workers, args.fake_backend).run()
+        sys.exit()
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    window = MainWindow(args.fake_backend, args.benchmark_startup)
     window.show()
     sys.exit(app.exec())
\ No newline at end of file
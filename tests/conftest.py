@@ -0,0 +1,20 @@
+"""Shared fixtures. The application script is imported once, with its logs and caches redirected to a temporary directory."""
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from app_loader import load_app
+
+APP = load_app()
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The application module, writing telemetry, blobs and uploads under tmp_path."""
+    monkeypatch.setattr(APP.TELEMETRY, 'log_file', str(tmp_path / 'logs' / 'telemetry.jsonl'))
+    monkeypatch.setattr(APP, 'BLOBS', APP.BlobStore(str(tmp_path / 'cache' / 'blobs')))
+    monkeypatch.setattr(APP, 'UPLOADS', APP.UploadCache(str(tmp_path / 'cache' / 'uploads.json')))
+    return APP
@@ -0,0 +1,47 @@
+"""Tests of BlobStore, the on-disk store of large message bodies."""
+import os
+import time
+
+def age(path, days):
+    old = time.time() - days * 86400
+    os.utime(path, (old, old))
+
+def blob_file(store, key):
+    return store.path(key, store.compress)
+
+def test_put_and_get(app, tmp_path):
+    store = app.BlobStore(str(tmp_path / 'blobs'))
+    key = store.put("body " * 1000)
+    assert store.put("body " * 1000) == key # Stored once
+    assert store.get(key) == "body " * 1000
+    assert os.path.getsize(blob_file(store, key)) < 1000 # Compressed
+
+def test_prune_keeps_bodies_in_use(app, tmp_path):
+    store = app.BlobStore(str(tmp_path / 'blobs'))
+    key = store.put("in use")
+    age(blob_file(store, key), 30)
+    assert store.prune() == 0
+    assert store.get(key) == "in use"
+
+def test_prune_deletes_unused_bodies(app, tmp_path):
+    key = app.BlobStore(str(tmp_path / 'blobs')).put("old session")
+    other = app.BlobStore(str(tmp_path / 'blobs')) # Another instance
+    age(other.path(key, True), 30)
+    assert other.prune() == 1
+    assert not os.path.exists(other.path(key, True))
+
+def test_get_marks_body_in_use(app, tmp_path):
+    key = app.BlobStore(str(tmp_path / 'blobs')).put("read later")
+    reader = app.BlobStore(str(tmp_path / 'blobs'))
+    path = reader.path(key, True)
+    age(path, 30)
+    reader.get(key)
+    assert time.time() - os.path.getmtime(path) < 60
+    assert app.BlobStore(str(tmp_path / 'blobs')).prune() == 0 # Another instance starting up
+
+def test_touch_in_use_protects_long_sessions(app, tmp_path):
+    session = app.BlobStore(str(tmp_path / 'blobs'))
+    key = session.put("open for a week")
+    age(session.path(key, True), 30)
+    session.touch_in_use()
+    assert app.BlobStore(str(tmp_path / 'blobs')).prune() == 0
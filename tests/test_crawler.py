@@ -0,0 +1,109 @@
+"""Tests of DocCrawler against a documentation site served by a local http.server."""
+import asyncio
+import hashlib
+import http.server
+import json
+import os
+import threading
+
+import pytest
+
+PAGES = {
+    '/robots.txt': "User-agent: *\nDisallow: /docs/private/\n",
+    '/docs/': '<html><title>Docs</title><body><a href="a.html">A</a> <a href="b.html">B</a> <a href="private/secret.html">Secret</a> <a href="/outside.html">Out</a></body></html>',
+    '/docs/a.html': '<html><title>A</title><body><p>Page A</p><a href="b.html">B</a></body></html>',
+    '/docs/b.html': '<html><title>B</title><body><p>Page B</p><a href="c.html">C</a></body></html>',
+    '/docs/c.html': '<html><title>C</title><body><p>Page C</p></body></html>',
+    '/docs/private/secret.html': '<html><body>Secret</body></html>',
+    '/outside.html': '<html><body>Outside</body></html>',
+}
+
+class DocsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves PAGES with ETags, answering 304 to a matching If-None-Match."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+        body = self.server.pages.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"' + hashlib.sha256(body.encode()).hexdigest()[:16] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain' if self.path.endswith('.txt') else 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def site():
+    """A local documentation site. server.requests lists the (path, If-None-Match) of each request."""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), DocsHandler)
+    server.pages = dict(PAGES)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def crawl(app, site, output_dir, max_pages=100, **kwargs):
+    crawler = app.DocCrawler(f"http://127.0.0.1:{site.server_port}/docs/", str(output_dir), concurrency=2, max_pages=max_pages)
+    return crawler, asyncio.run(crawler.run(**kwargs))
+
+def fetched_pages(site):
+    return [path for path, _ in site.requests if path != '/robots.txt']
+
+def test_crawl_respects_robots_and_scope(app, site, tmp_path):
+    _, result = crawl(app, site, tmp_path)
+    assert result["finished"]
+    assert result["pages"] == 4
+    assert sorted(fetched_pages(site)) == ['/docs/', '/docs/a.html', '/docs/b.html', '/docs/c.html']
+    assert sorted(os.listdir(tmp_path / 'docs')) == ['a.txt', 'b.txt', 'c.txt', 'index.txt']
+    assert "Page B" in (tmp_path / 'docs' / 'b.txt').read_text()
+    changelog = [json.loads(line) for line in (tmp_path / 'changelog.jsonl').read_text().splitlines()]
+    assert len(changelog[0]["added"]) == 4
+
+def test_robots_disallow_all(app, site, tmp_path):
+    site.pages['/robots.txt'] = "User-agent: *\nDisallow: /\n"
+    _, result = crawl(app, site, tmp_path)
+    assert result["fetched"] == 0
+    assert fetched_pages(site) == []
+
+def test_page_limit_and_resume(app, site, tmp_path):
+    crawler, result = crawl(app, site, tmp_path, max_pages=2)
+    assert result["fetched"] == 2
+    assert not result["finished"]
+    assert crawler.has_saved_state()
+
+    crawler, result = crawl(app, site, tmp_path, resume=True)
+    assert result["finished"]
+    assert result["pages"] == 4
+    assert not crawler.has_saved_state()
+    pages = fetched_pages(site)
+    assert sorted(pages) == sorted(set(pages)) # Pages fetched before the limit weren't fetched again
+
+def test_refresh_downloads_only_changed_pages(app, site, tmp_path):
+    crawl(app, site, tmp_path)
+    site.requests.clear()
+    site.pages['/docs/b.html'] = site.pages['/docs/b.html'].replace("Page B", "Page B, updated")
+
+    _, result = crawl(app, site, tmp_path, refresh=True)
+    assert result["finished"]
+    assert result["refresh"]
+    assert result["changes"]["updated"] == [os.path.join('docs', 'b.txt')]
+    assert result["changes"]["unchanged"] == 3
+    assert all(etag for _, etag in site.requests if _ != '/robots.txt') # Every page was requested conditionally
+    assert "updated" in (tmp_path / 'docs' / 'b.txt').read_text()
@@ -0,0 +1,84 @@
+"""Tests of UnifiedDiff, which parses the diffs of replies in diff-only mode and applies them, and of how diff paths are resolved."""
+import os
+import types
+
+import pytest
+
+SOURCE = "".join(f"line {n}\n" for n in range(1, 21))
+
+def diff(body, old="a/app.py", new="b/app.py"):
+    return f"Here is the change.\n```diff\n--- {old}\n+++ {new}\n{body}```\n"
+
+def window(project_dir, *files):
+    """A stand-in for the main window, with files sent as context in one user message."""
+    message = types.SimpleNamespace(role="User", content="".join(f"File: {path}\n```\ncontent\n```\n" for path in files))
+    return types.SimpleNamespace(messages=[message], project_dir=str(project_dir))
+
+def test_clean_apply(app):
+    patches = app.UnifiedDiff.parse(diff("@@ -4,3 +4,3 @@\n line 4\n-line 5\n+line five\n line 6\n"))
+    assert [(p['old_path'], p['new_path']) for p in patches] == [("app.py", "app.py")]
+    assert app.UnifiedDiff.apply(SOURCE, patches[0]['hunks']) == SOURCE.replace("line 5\n", "line five\n")
+
+def test_offset_hunk_is_found(app):
+    patches = app.UnifiedDiff.parse(diff("@@ -1,3 +1,4 @@\n line 14\n line 15\n+inserted\n line 16\n")) # Wrong line numbers
+    assert app.UnifiedDiff.apply(SOURCE, patches[0]['hunks']) == SOURCE.replace("line 15\n", "line 15\ninserted\n")
+
+def test_context_mismatch_is_rejected(app):
+    patches = app.UnifiedDiff.parse(diff("@@ -4,3 +4,3 @@\n line 4\n-line 50\n+line fifty\n line 6\n"))
+    with pytest.raises(ValueError, match="hunk 1"):
+        app.UnifiedDiff.apply(SOURCE, patches[0]['hunks'])
+
+def test_new_and_deleted_files(app):
+    text = diff("@@ -0,0 +1,2 @@\n+first\n+second\n", old="/dev/null", new="b/new.py") + diff("@@ -1,2 +0,0 @@\n-gone\n-too\n", old="a/old.py", new="/dev/null")
+    created, deleted = app.UnifiedDiff.parse(text)
+    assert (created['old_path'], created['new_path']) == (None, "new.py")
+    assert app.UnifiedDiff.apply('', created['hunks']) == "first\nsecond\n"
+    assert (deleted['old_path'], deleted['new_path']) == ("old.py", None)
+
+def test_malformed_diffs_are_rejected(app):
+    with pytest.raises(ValueError, match="malformed hunk header"):
+        app.UnifiedDiff.parse(diff("@@ -4 +4 oops\n line 4\n"))
+    with pytest.raises(ValueError, match="before its"):
+        app.UnifiedDiff.parse("```diff\n@@ -1,1 +1,1 @@\n-a\n+b\n```")
+    with pytest.raises(ValueError, match="no hunks"):
+        app.UnifiedDiff.parse(diff(""))
+
+def test_reply_without_diff(app):
+    assert app.UnifiedDiff.parse("No change is needed.") == []
+
+def test_paths_resolve_to_context_files_and_the_project(app, tmp_path):
+    project = tmp_path / 'project'
+    (project / 'src').mkdir(parents=True)
+    context = str(tmp_path / 'elsewhere' / 'util.py')
+    main = window(project, context)
+    resolve = app.MainWindow.resolve_diff_path
+    assert resolve(main, "util.py") == context
+    assert resolve(main, context) == context
+    assert resolve(main, "src/new.py") == os.path.join(os.path.realpath(project), 'src', 'new.py')
+    assert resolve(main, str(project / 'src' / 'app.py')) == os.path.join(os.path.realpath(project), 'src', 'app.py')
+
+@pytest.mark.parametrize("name", ["../../.bashrc", "../outside.py", "/etc/passwd", "src/../../outside.py", "link/escape.py"])
+def test_paths_outside_the_project_are_rejected(app, tmp_path, name):
+    project = tmp_path / 'project'
+    (project / 'src').mkdir(parents=True)
+    (tmp_path / 'outside').mkdir()
+    os.symlink(tmp_path / 'outside', project / 'link')
+    assert app.MainWindow.resolve_diff_path(window(project, str(project / 'src' / 'app.py')), name) is None
+
+def test_write_applies_all_files(app, tmp_path):
+    changed, created, deleted = tmp_path / 'changed.py', tmp_path / 'sub' / 'created.py', tmp_path / 'deleted.py'
+    changed.write_text("old\n")
+    deleted.write_text("gone\n")
+    app.UnifiedDiff.write({str(changed): ("old\n", "new\n"), str(created): (None, "created\n"), str(deleted): ("gone\n", None)})
+    assert changed.read_text() == "new\n"
+    assert created.read_text() == "created\n"
+    assert not deleted.exists()
+    assert sorted(os.listdir(tmp_path)) == ['changed.py', 'sub'] # No temporary files left
+
+def test_failed_write_changes_nothing(app, tmp_path):
+    first, missing = tmp_path / 'first.py', tmp_path / 'missing.py'
+    first.write_text("old\n")
+    with pytest.raises(OSError):
+        app.UnifiedDiff.write({str(first): ("old\n", "new\n"), str(missing): ("gone\n", None)}) # Deleting a missing file fails after first.py was replaced
+    assert first.read_text() == "old\n"
+    assert os.listdir(tmp_path) == ['first.py']
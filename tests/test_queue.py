@@ -0,0 +1,77 @@
+"""Tests of RequestQueue, the durable queue of requests that failed for lack of connectivity or quota, and is_retryable."""
+import json
+import time
+
+import pytest
+
+HISTORY = [{"role": "User", "content": "hello", "tokens": 2, "cost": 0.0}]
+
+def test_jobs_are_saved(app, tmp_path):
+    queue = app.RequestQueue(str(tmp_path / 'cache' / 'queue.json'))
+    job = queue.add("main", "gemini-1.5-pro-latest", HISTORY, "ConnectionError: offline", {"max_output_tokens": 1024}, True, "question")
+    saved = json.loads((tmp_path / 'cache' / 'queue.json').read_text())
+    assert saved == [job]
+    assert job["history"] == HISTORY
+    assert (job["generation_config"], job["diff_mode"], job["output_kind"]) == ({"max_output_tokens": 1024}, True, "question")
+
+def test_jobs_reload_after_restart(app, tmp_path):
+    path = str(tmp_path / 'queue.json')
+    first = app.RequestQueue(path).add("main", "model", HISTORY, "offline")
+    second = app.RequestQueue(path).add("alt", "model", HISTORY, "offline") # Loads the first job before adding
+
+    restarted = app.RequestQueue(path)
+    assert [job["id"] for job in restarted.pending()] == [first["id"], second["id"]]
+    assert [job["id"] for job in restarted.pending("alt")] == [second["id"]]
+
+def test_removing_the_last_job_deletes_the_file(app, tmp_path):
+    path = tmp_path / 'queue.json'
+    queue = app.RequestQueue(str(path))
+    job = queue.add("main", "model", HISTORY, "offline")
+    queue.remove(job)
+    assert queue.pending() == []
+    assert not path.exists()
+
+def test_jobs_are_sent_in_order(app, tmp_path):
+    queue = app.RequestQueue(str(tmp_path / 'queue.json'))
+    first = queue.add("main", "model", HISTORY, "offline")
+    second = queue.add("main", "model", HISTORY, "offline")
+    assert queue.next_due() is None # Not due before the first backoff
+    first["next_attempt"] = second["next_attempt"] = 0
+    assert queue.next_due() is first
+    second["next_attempt"] = 0
+    first["next_attempt"] = time.time() + 60
+    assert queue.next_due() is None # A later job never overtakes the oldest
+    queue.remove(first)
+    assert queue.next_due() is second
+
+def test_retry_later_backs_off(app, tmp_path):
+    queue = app.RequestQueue(str(tmp_path / 'queue.json'))
+    job = queue.add("main", "model", HISTORY, "offline")
+    assert job["next_attempt"] == pytest.approx(time.time() + app.RequestQueue.BACKOFF[0], abs=5)
+    for attempt in range(1, len(app.RequestQueue.BACKOFF) + 2):
+        queue.retry_later(job, "still offline")
+        delay = app.RequestQueue.BACKOFF[min(attempt, len(app.RequestQueue.BACKOFF) - 1)] # The last delay repeats
+        assert job["attempts"] == attempt
+        assert job["next_attempt"] == pytest.approx(time.time() + delay, abs=5)
+    assert job["error"] == "still offline"
+    saved = app.RequestQueue(queue.path).pending()[0]
+    assert saved["attempts"] == len(app.RequestQueue.BACKOFF) + 1
+
+def test_corrupt_queue_file_is_ignored(app, tmp_path):
+    path = tmp_path / 'queue.json'
+    path.write_text("{not json")
+    assert app.RequestQueue(str(path)).pending() == []
+
+@pytest.mark.parametrize("error", [
+    ConnectionError("offline"), ConnectionRefusedError(), TimeoutError(),
+    type('ServiceUnavailable', (Exception,), {})("503"), type('ResourceExhausted', (Exception,), {})("quota"),
+    type('ClientConnectorError', (ConnectionError,), {})("dns"),
+])
+def test_connectivity_and_quota_errors_are_retryable(app, error):
+    assert app.is_retryable(error)
+
+@pytest.mark.parametrize("error", [
+    ValueError("blocked"), RuntimeError("error"), FileNotFoundError("moved"), type('InvalidArgument', (Exception,), {})("bad request"),
+])
+def test_other_errors_are_not_retryable(app, error):
+    assert not app.is_retryable(error)
@@ -0,0 +1,134 @@
+"""Tests of the local HTTP API server (--server) against the fake backend."""
+import asyncio
+import http.client
+import json
+import threading
+import time
+
+import pytest
+
+@pytest.fixture
+def server(app):
+    """An AssistantServer on a free port, served from a background thread."""
+    server = app.AssistantServer(port=0, fake_backend=True)
+    server.initialize_model()
+    loop = asyncio.new_event_loop()
+    serving = loop.create_task(server.serve())
+    def run():
+        try:
+            loop.run_until_complete(serving)
+        except asyncio.CancelledError:
+            pass # Stopped by the fixture
+        tasks = asyncio.all_tasks(loop) # The workers
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    deadline = time.time() + 5
+    while not server.port and time.time() < deadline:
+        time.sleep(0.01)
+    yield server
+    loop.call_soon_threadsafe(serving.cancel)
+    thread.join(5)
+
+def request(server, method, path, payload=None, body=None, connection=None):
+    """Sends a request and returns (status, headers, body bytes)."""
+    connection = connection or http.client.HTTPConnection(server.host, server.port, timeout=10)
+    if payload is not None:
+        body = json.dumps(payload)
+    connection.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    return response.status, response.headers, response.read()
+
+def events(body):
+    """Parses a server-sent events body into the data of each event."""
+    assert body.endswith(b'\n\n')
+    data = []
+    for event in body.decode().split('\n\n')[:-1]:
+        assert event.startswith('data: ')
+        text = event[len('data: '):]
+        data.append(text if text == '[DONE]' else json.loads(text))
+    return data
+
+def test_chat_keeps_the_session(server):
+    status, _, body = request(server, 'POST', '/v1/chat', {"message": "first question"})
+    assert status == 200
+    first = json.loads(body)
+    assert first["text"] == "Echo: first question"
+
+    status, _, body = request(server, 'POST', '/v1/chat', {"message": "second question", "session": first["session"]})
+    second = json.loads(body)
+    assert status == 200
+    assert second["session"] == first["session"]
+    assert second["usage"]["input_tokens"] > first["usage"]["input_tokens"] # The first turn was sent again as history
+    assert second["usage"]["session_cost"] == pytest.approx(first["usage"]["cost"] + second["usage"]["cost"])
+    session = server.sessions[first["session"]]
+    assert [m.role for m in session.messages] == ["User", "Model", "User", "Model"]
+    assert len(session.chat.history) == 4
+
+def test_chat_session_from_header(server):
+    _, _, body = request(server, 'POST', '/v1/chat', {"message": "hello"})
+    session_id = json.loads(body)["session"]
+    connection = http.client.HTTPConnection(server.host, server.port, timeout=10)
+    connection.request('POST', '/v1/chat', body=json.dumps({"message": "again"}), headers={'X-Session-Id': session_id})
+    assert json.loads(connection.getresponse().read())["session"] == session_id
+
+def test_count_tokens(server, app):
+    status, _, body = request(server, 'POST', '/v1/count_tokens', {"text": "abcd" * 10})
+    result = json.loads(body)
+    assert status == 200
+    assert result["system_instruction_tokens"] == app.SI_TOKENS
+    assert result["total_tokens"] == app.estimate_tokens(server.system_instructions) + 10 # The fake backend counts 4 characters per token
+
+def test_chat_stream(server):
+    status, headers, body = request(server, 'POST', '/v1/chat', {"message": "stream this reply please", "stream": True})
+    assert status == 200
+    assert headers['Content-Type'] == 'text/event-stream'
+    data = events(body)
+    chunks, final = data[:-1], data[-1]
+    assert len(chunks) > 1
+    assert "".join(chunk["text"] for chunk in chunks) == "Echo: stream this reply please"
+    assert final["done"] is True
+    assert final["usage"]["output_tokens"] > 0
+    assert server.metrics["streams_total"] == 1
+
+def test_chat_completions_stream(server):
+    payload = {"messages": [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "Echo: hi"}, {"role": "user", "content": "stream me"}], "stream": True}
+    status, headers, body = request(server, 'POST', '/v1/chat/completions', payload)
+    assert status == 200
+    assert headers['Content-Type'] == 'text/event-stream'
+    data = events(body)
+    assert data[-1] == '[DONE]'
+    final = data[-2]
+    assert final["choices"][0]["finish_reason"] == "stop"
+    chunks = data[:-2]
+    assert all(chunk["object"] == "chat.completion.chunk" for chunk in chunks)
+    assert "".join(chunk["choices"][0]["delta"]["content"] for chunk in chunks) == "Echo: stream me"
+
+def test_chat_completions(server):
+    status, _, body = request(server, 'POST', '/v1/chat/completions', {"messages": [{"role": "user", "content": "hi"}]})
+    result = json.loads(body)
+    assert status == 200
+    assert result["choices"][0]["message"] == {"role": "assistant", "content": "Echo: hi"}
+    assert result["usage"]["total_tokens"] == result["usage"]["prompt_tokens"] + result["usage"]["completion_tokens"]
+
+def test_keep_alive_reuses_connections(server):
+    connection = http.client.HTTPConnection(server.host, server.port, timeout=10)
+    for _ in range(3):
+        status, headers, _ = request(server, 'GET', '/health', connection=connection)
+        assert status == 200
+        assert headers['Connection'] == 'keep-alive'
+    assert server.metrics["connections_total"] == 1
+    assert server.metrics["connection_reuses_total"] == 2
+
+@pytest.mark.parametrize("body", [b'{not json', b'[1, 2]', b'"text"', json.dumps({"session": "x"}).encode()])
+def test_bad_body_is_rejected(server, body):
+    status, _, response = request(server, 'POST', '/v1/chat', body=body)
+    assert status == 400
+    assert "error" in json.loads(response)
+
+def test_unknown_endpoint(server):
+    status, _, _ = request(server, 'GET', '/v2/nothing')
+    assert status == 404
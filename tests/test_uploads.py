@@ -0,0 +1,71 @@
+"""Tests of UploadCache, the Files API handle cache, against the FakeFilesAPI stub."""
+import time
+import types
+
+import pytest
+
+@pytest.fixture
+def uploads(app):
+    app.UPLOADS.api = app.FakeFilesAPI()
+    return app.UPLOADS
+
+@pytest.fixture
+def image(tmp_path):
+    path = tmp_path / 'diagram.png'
+    path.write_bytes(b'\x89PNG\r\n\x1a\n' + b'\0' * 100)
+    return path
+
+def test_reupload_reuses_handle(app, uploads, image):
+    attachment = app.UploadCache.attachment(str(image), 'image/png')
+    first = uploads.file_part(attachment)
+    second = uploads.file_part(dict(attachment)) # Attached again, identified by the same hash
+    assert first == second
+    assert first['file_data']['mime_type'] == 'image/png'
+    assert (uploads.uploads, uploads.reuses) == (1, 1)
+
+    # A later session reads the handle from the cache file
+    later = app.UploadCache(uploads.path)
+    later.api = app.FakeFilesAPI()
+    assert later.file_part(attachment) == first
+    assert (later.uploads, later.reuses) == (0, 1)
+
+def test_reupload_after_expiry(app, uploads, image, monkeypatch):
+    attachment = app.UploadCache.attachment(str(image), 'image/png')
+    uploads.file_part(attachment)
+    entry = uploads.entries[attachment['sha256']]
+    assert entry['expires'] == pytest.approx(time.time() + 48 * 3600, abs=60) # The fake API's expiration_time
+
+    # Shortly before expiry the handle is no longer used, the file is uploaded again from its path
+    later = entry['expires'] - app.UploadCache.EXPIRY_MARGIN + 1
+    monkeypatch.setattr(app, 'time', types.SimpleNamespace(time=lambda: later, sleep=time.sleep, perf_counter=time.perf_counter, monotonic=time.monotonic))
+    uploads.file_part(attachment)
+    assert (uploads.uploads, uploads.reuses) == (2, 0)
+    assert uploads.entries[attachment['sha256']]['expires'] > entry['expires']
+
+def test_changed_file_is_not_reused(app, uploads, image):
+    attachment = app.UploadCache.attachment(str(image), 'image/png')
+    first = uploads.file_part(attachment)
+    image.write_bytes(image.read_bytes() + b'changed')
+
+    # Attaching the changed file again uploads the new version
+    changed = app.UploadCache.attachment(str(image), 'image/png')
+    assert changed['sha256'] != attachment['sha256']
+    second = uploads.file_part(changed)
+    assert second != first
+    assert uploads.uploads == 2
+
+    # The old attachment can't be uploaded again once its handle is gone, the file no longer matches it
+    uploads.entries.clear()
+    with pytest.raises(ValueError, match="changed since it was attached"):
+        uploads.file_part(attachment)
+
+def test_missing_file_cannot_be_reuploaded(app, uploads, image):
+    attachment = app.UploadCache.attachment(str(image), 'image/png')
+    image.unlink()
+    with pytest.raises(FileNotFoundError):
+        uploads.file_part(attachment)
+
+def test_attachment_tokens_are_counted(app):
+    model = app.FakeGenerativeModel()
+    contents = [{'role': 'user', 'parts': [{'text': 'abcd'}, {'file_data': {'mime_type': 'image/png', 'file_uri': 'https://fake/files/1'}}]}]
+    assert model.count_tokens(contents).total_tokens == 1 + 258